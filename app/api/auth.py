@@ -1,3 +1,4 @@
+import uuid
 import logging
 import secrets
 from hashlib import md5
@@ -12,6 +13,7 @@ from entities import (
     Session as AccountSession, Credential as AccountCredential,
     Account, GrantedAccount, AnonymousAccount
 )
+from cache import Cache
 from reposiroty import (
     AccountCredentialRepository, AccountSessionRepository, AccountRepository
 )
@@ -68,27 +70,35 @@ class BaseAuth:
     ) -> Tuple[Optional[Account], Optional[AccountSession]]:
         account, session = None, None
         if isinstance(request, HttpRequest):
-            session_uid = request.COOKIES.get(cls.COOKIE_NAME)
-            if session_uid:
-                session: Optional[AccountSession] = await AccountSessionRepository.get(
-                    uid=session_uid
-                )
-                if session:
-                    account: Optional[Account] = await AccountRepository.get(
-                        uid=session.account_uid
-                    )
-                    if account is None:
-                        if session.account_uid:
-                            await cls.clean(
-                                session.account_uid, only_sessions=False
-                            )
-                        return None, None
-                    if not account.is_active:
-                        await cls.clean(
-                            session.account_uid, only_sessions=True
-                        )
-                        logging.critical(f'Account {account.uid} is deactivated')
-                        return None, None
+            session = await cls._load_session(request)
+            if session:
+                return await cls._auth_session(session)
+        return account, session
+
+    @classmethod
+    async def _load_session(
+        cls, request: HttpRequest
+    ) -> Optional[AccountSession]:
+        session_uid = request.COOKIES.get(cls.COOKIE_NAME)
+        if session_uid:
+            return await AccountSessionRepository.get(uid=session_uid)
+        return None
+
+    @classmethod
+    async def _auth_session(
+        cls, session: AccountSession
+    ) -> Tuple[Optional[Account], Optional[AccountSession]]:
+        account: Optional[Account] = await AccountRepository.get(
+            uid=session.account_uid
+        )
+        if account is None:
+            if session.account_uid:
+                await cls.clean(session.account_uid, only_sessions=False)
+            return None, None
+        if not account.is_active:
+            await cls.clean(session.account_uid, only_sessions=True)
+            logging.critical(f'Account {account.uid} is deactivated')
+            return None, None
         return account, session
 
     @classmethod
@@ -140,6 +150,9 @@ class BaseAuth:
         await AccountSessionRepository.delete(**filters)
         if not only_sessions:
             await AccountCredentialRepository.delete(**filters)
+            # версию меняем после удаления, иначе кеш успеет заполниться
+            # старыми данными
+            await TokenAuth.invalidate_cache()
 
 
 class TokenAuth(BaseAuth):
@@ -150,6 +163,11 @@ class TokenAuth(BaseAuth):
         token: str
 
     Schema = TokenCredential
+    # кеш uid аккаунта по дайджесту токена (в т.ч. отрицательный) общий
+    # для всех воркеров, сбрасывается сменой версии при отзыве токенов
+    CACHE_TTL_SEC = 30
+    CACHE_NEGATIVE_TTL_SEC = 5
+    _cache = Cache(pool=settings.REDIS_CONN_POOL, namespace='token-auth')
     UiSchema = [
         {
             'component': 'div',
@@ -183,14 +201,7 @@ class TokenAuth(BaseAuth):
     ) -> Tuple[Optional[Account], Optional[AccountSession]]:
         account, session = None, None
         if isinstance(request, HttpRequest):
-            data = None
-            lowered_headers = {
-                k.lower(): v for k, v in request.headers.items()
-            }
-            if cls.validate(request.GET):
-                data = cls.Schema.model_validate(request.GET).model_dump()
-            elif cls.validate(lowered_headers):
-                data = cls.Schema.model_validate(lowered_headers).model_dump()
+            data = cls._extract_credential(request)
             if data:
                 return await cls.auth(data)
             else:
@@ -198,13 +209,39 @@ class TokenAuth(BaseAuth):
         else:
             passed = cls.TokenCredential.model_validate(request)
             h = 'md5:' + md5(passed.token.encode()).hexdigest()
-            cred = await AccountCredentialRepository.get(
-                payload__token=h
-            )
-            if cred:
-                account = await AccountRepository.get(uid=cred.account_uid)
+            account = await cls._load_account(h)
         return account, session
 
+    @classmethod
+    async def _load_account(cls, digest: str) -> Optional[Account]:
+        key = f'digest:{digest}'
+        values = await cls._cache.get(['ver', key])
+        version, entry = values['ver'], values[key]
+        if entry and entry['ver'] == version:
+            uid = entry['uid']
+            # аккаунт - через версионный кеш репозитория, так что
+            # деактивация видна сразу
+            return await AccountRepository.get(uid=uid) if uid else None
+        account = await AccountRepository.get_by_credential_digest(digest)
+        await cls._cache.set(
+            key, {'ver': version, 'uid': account.uid if account else None},
+            ttl=cls.CACHE_TTL_SEC if account else cls.CACHE_NEGATIVE_TTL_SEC
+        )
+        return account
+
+    @classmethod
+    async def invalidate_cache(cls):
+        # без ttl: версия должна пережить все записи кеша
+        await cls._cache.set('ver', uuid.uuid4().hex)
+
+    @classmethod
+    def _extract_credential(cls, request: HttpRequest) -> Optional[Dict]:
+        # токен принимается из query string или из заголовка
+        token = request.GET.get('token') or request.headers.get('token')
+        if token:
+            return {'token': token}
+        return None
+
     @classmethod
     async def register(
         cls, account: Union[Account, str], payload: Dict
@@ -218,7 +255,9 @@ class TokenAuth(BaseAuth):
         )
         if cred and cred.account_uid != account_uid:
             raise ValueError(f'Token занят')
-        return await super().register(account, data.model_dump())
+        cred = await super().register(account, data.model_dump())
+        await cls.invalidate_cache()
+        return cred
 
 
 class LoginAuth(BaseAuth):
@@ -329,6 +368,8 @@ class ApiTokenAuth(BaseAuth):
         cls, request: Union[HttpRequest, Dict],
     ) -> Tuple[Optional[Account], Optional[AccountSession]]:
         cur_account: Optional[Account] = None
+        if not cls._detect(request):
+            return None, None
         if settings.API['AUTH']:
             auth_scheme = request.headers.get('Authorization')
             if auth_scheme:
@@ -358,6 +399,11 @@ class ApiTokenAuth(BaseAuth):
             )
         return cur_account, None
 
+    @classmethod
+    def _detect(cls, request: HttpRequest) -> bool:
+        headers = request.headers
+        return 'Authorization' in headers or cls.GRANT_ACCOUNT_HDR in headers
+
     @classmethod
     async def login(
         cls, resp: HttpResponse, account: Account
@@ -400,22 +446,23 @@ class AnonymousAuth(BaseAuth):
     ) -> Tuple[Optional[Account], Optional[AccountSession]]:
         account, session = None, None
         if isinstance(request, HttpRequest):
-            session_uid = request.COOKIES.get(cls.COOKIE_NAME)
-            if session_uid:
-                session: Optional[AccountSession] = await AccountSessionRepository.get(  # noqa
-                    uid=session_uid
-                )
-                if session and session.account_uid is None:
-                    uid = session.uid
-                    account = await AccountRepository.load_anonymous_account(uid)  # noqa
-                    if account:
-                        return account, session
-                    else:
-                        return AnonymousAccount(uid=session.uid), session
-                else:
-                    return None, None
+            session = await cls._load_session(request)
+            if session:
+                return await cls._auth_session(session)
         return account, session
 
+    @classmethod
+    async def _auth_session(
+        cls, session: AccountSession
+    ) -> Tuple[Optional[Account], Optional[AccountSession]]:
+        if session.account_uid is not None:
+            return None, None
+        account = await AccountRepository.load_anonymous_account(session.uid)
+        if account:
+            return account, session
+        else:
+            return AnonymousAccount(uid=session.uid), session
+
     @classmethod
     async def login(
         cls, resp: HttpResponse, account: Account
@@ -429,3 +476,32 @@ class AnonymousAuth(BaseAuth):
         )
         resp.set_cookie(cls.COOKIE_NAME, session.uid)
         return session
+
+
+async def authenticate(
+    request: HttpRequest
+) -> Tuple[Optional[Account], Optional[AccountSession]]:
+    """Аутентификация запроса с разбором его признаков один раз
+
+    Вместо последовательного опроса всех BaseAuth.Descendants выбирается
+    аутентификатор по признакам запроса (токен, cookie сессии, заголовок
+    Authorization), сессия из cookie загружается единожды. Приоритет тот же,
+    что и при переборе: Token, сессия аккаунта, ApiToken, анонимная сессия
+    """
+    token = TokenAuth._extract_credential(request)
+    if token:
+        account, session = await TokenAuth.auth(token)
+        if account:
+            return account, session
+    session = await BaseAuth._load_session(request)
+    if session and session.account_uid:
+        account, session_ = await BaseAuth._auth_session(session)
+        if account:
+            return account, session_
+    if ApiTokenAuth._detect(request):
+        account, _ = await ApiTokenAuth.auth(request)
+        if account:
+            return account, None
+    if session and session.account_uid is None:
+        return await AnonymousAuth._auth_session(session)
+    return None, None
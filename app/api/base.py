@@ -18,7 +18,7 @@ from entities import (
 from context import Context, context as app_context
 from cache import Cache
 from reposiroty.config import ExchangeConfigRepository
-from .auth import BaseAuth
+from .auth import authenticate
 
 
 METHOD_NAME = str
@@ -127,11 +127,13 @@ class ExchangeContextMixin:
         *args, **kwargs
     ) -> HttpResponse:
         try:
-            cfg = await ExchangeConfigRepository.get()
+            cfg = await ExchangeConfigRepository.current()
             context.config = cfg
             user = await self._extract_user(request)
             context.user = user
-            with Context.create_context(config=cfg, user=user):
+            with Context.create_context(
+                config=cfg, user=user, request=request
+            ):
                 if isinstance(self.controller, BaseExchangeController):
                     await self.controller.before(*args, **kwargs)
                 return await super().transport(
@@ -146,16 +148,14 @@ class ExchangeContextMixin:
 
     @classmethod
     async def _extract_user(cls, request: HttpRequest) -> Optional[Account]:
-        for auth in BaseAuth.Descendants:
-            auth: BaseAuth
-            account, session = await auth.auth(request)
-            if account:
-                if account.merchant_meta and Account.Permission.MERCHANT.value in account.permissions:
-                    account = MerchantAccount(
-                        meta=MerchantMeta.model_validate(account.merchant_meta),
-                        **dict(account)
-                    )
-                return account
+        account, _ = await authenticate(request)
+        if account:
+            if account.merchant_meta and Account.Permission.MERCHANT.value in account.permissions:
+                account = MerchantAccount(
+                    meta=MerchantMeta.model_validate(account.merchant_meta),
+                    **dict(account)
+                )
+            return account
         return None
 
 
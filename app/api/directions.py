@@ -1,5 +1,5 @@
 import logging
-from typing import Any, List, Optional, Dict, Union, Literal
+from typing import Any, List, Optional, Dict, Union, Literal, Tuple
 from collections import defaultdict
 
 import pydantic
@@ -13,7 +13,7 @@ from core import float_to_datetime, secs_delta, utc_now_float
 from cache import Cache
 from entities import (
     Direction, Payment, Currency, PaymentMethod, CashMethod, Network,
-    Correction
+    Correction, ExchangeConfig
 )
 from reposiroty import (
     DirectionRepository, CurrencyRepository, PaymentMethodRepository,
@@ -53,6 +53,67 @@ class OwnerIdMixin:
         return filters
 
 
+class DirectionCatalog:
+    """Справочник направлений, скомпилированный из ExchangeConfig
+
+    Строится один раз на версию конфига и владельца направлений, заменяя
+    выборки валют, методов и платежей на каждый запрос. Методы передаются
+    списком владельца: в cfg.methods коды разных владельцев схлопываются
+    """
+
+    def __init__(
+        self, cfg: ExchangeConfig, owner_did: str,
+        methods: List[Union[PaymentMethod, CashMethod, Network]]
+    ):
+        root_did = cfg.identity.did.root
+        if owner_did == root_did:
+            owners = {None, root_did}
+        else:
+            owners = {owner_did}
+
+        def _owned(items):
+            return [
+                i.model_copy(update={'owner_did': i.owner_did or root_did})
+                for i in items if i.owner_did in owners
+            ]
+
+        self.currencies: Dict[str, Currency] = {
+            cur.symbol: cur for cur in _owned(cfg.currencies)
+        }
+        self.methods: Dict[str, Union[PaymentMethod, CashMethod, Network]] = {
+            meth.code: meth for meth in _owned(methods)
+        }
+        self.payments: Dict[str, Payment] = {
+            p.code: p for p in _owned(cfg.payments)
+        }
+        # имена методов для внешних курсов, ключ - код платежа
+        self.method_names: Dict[str, str] = {
+            code: self.methods[p.method].name
+            for code, p in self.payments.items() if p.method in self.methods
+        }
+        self._skeletons: Dict[
+            Tuple[str, str], Tuple[ComplexPayment, ComplexPayment]
+        ] = {}
+
+    def skeleton(
+        self, src: str, dest: str
+    ) -> Tuple[ComplexPayment, ComplexPayment]:
+        key = (src, dest)
+        value = self._skeletons.get(key)
+        if value is None:
+            value = (self._build_payment(src), self._build_payment(dest))
+            self._skeletons[key] = value
+        return value
+
+    def _build_payment(self, code: str) -> ComplexPayment:
+        payment = self.payments[code]
+        return ComplexPayment(
+            code=code,
+            method=self.methods[payment.method],
+            cur=self.currencies[payment.cur]
+        )
+
+
 class DirectionResource(BaseResource):
 
     pk = 'id'
@@ -75,6 +136,7 @@ class DirectionController(OwnerIdMixin, BaseExchangeController):
     _cache = Cache(
         pool=settings.REDIS_CONN_POOL, namespace='exchange-directions'
     )
+    _catalogs: Dict[Tuple[Optional[str], str], 'DirectionCatalog'] = {}
 
     async def get_one(self, pk: str, **filters) -> Optional[Resource.Retrieve]:
         parts = pk.split('-')
@@ -108,6 +170,8 @@ class DirectionController(OwnerIdMixin, BaseExchangeController):
             return None
 
         owner_did = directions[0].owner_did
+        if owner_did is None:
+            owner_did = self.context.config.identity.did.root
 
         def _build_dir_id(src_: str, dest_: str) -> str:
             return f'{src_}-{dest_}'
@@ -120,83 +184,15 @@ class DirectionController(OwnerIdMixin, BaseExchangeController):
             rid = _build_dir_id(r.src, r.dest)
             ratios_map[rid].append(r)
 
-        if owner_did is None or owner_did == self.context.config.identity.did.root:
-            filters = {
-                'owner_did__in': [None, self.context.config.identity.did.root]
-            }
-        else:
-            filters = {'owner_did': owner_did}
-        # containers
-        currencies_map: Dict[str, Currency] = {}
-        payment_methods_map: Dict[str, Union[PaymentMethod, CashMethod, Network]] = {}  # noqa
-        payments_map: Dict[str, Payment] = {}
-        # currencies
-        _, currencies = await CurrencyRepository.get_many(**filters)
-        currencies: List[Currency]
-        self.__lazy_fill_empty_attrs(currencies)
-        for cur in currencies:
-            currencies_map[cur.symbol] = cur
-
-        # payment methods
-        _, payment_methods = await PaymentMethodRepository.get_many(**filters)
-        payment_methods: List[PaymentMethod]
-        self.__lazy_fill_empty_attrs(payment_methods)
-        for pm in payment_methods:
-            payment_methods_map[pm.code] = pm
-
-        # networks
-        _, networks = await NetworkRepository.get_many(**filters)
-        networks: List[Network]
-        self.__lazy_fill_empty_attrs(networks)
-        for net in networks:
-            payment_methods_map[net.code] = net
-
-        # cash
-        _, caches = await CashMethodRepository.get_many(**filters)
-        caches: List[CashMethod]
-        self.__lazy_fill_empty_attrs(caches)
-        for cash in caches:
-            payment_methods_map[cash.code] = cash
-
-        # payments
-        _, payments = await PaymentRepository.get_many(**filters)
-        payments: List[Payment]
-        self.__lazy_fill_empty_attrs(payments)
-        for p in payments:
-            payments_map[p.code] = p
+        catalog = await self._load_catalog(owner_did)
 
         result: List[DirectionResource.Retrieve] = []
         utc = utc_now_float()
         for item in directions:
-            src_payment = payments_map[item.src]
-            src = ComplexPayment(
-                code=item.src,
-                method=payment_methods_map[src_payment.method],
-                cur=currencies_map[src_payment.cur]
-            )
-            dest_payment = payments_map[item.dest]
-            dest = ComplexPayment(
-                code=item.dest,
-                method=payment_methods_map[dest_payment.method],
-                cur=currencies_map[dest_payment.cur]
-            )
+            src, dest = catalog.skeleton(item.src, item.dest)
             externals: List[ExternalRatio] = []
-            ratios = ratios_map[
-                _build_dir_id(
-                    src_payment.cur, dest_payment.cur
-                )
-            ]
+            ratios = ratios_map[_build_dir_id(src.cur.symbol, dest.cur.symbol)]
             for r in ratios:
-                sm = payments_map.get(r.src_method)
-                if sm:
-                    ratio_src = payment_methods_map[sm.method].name
-                else:
-                    ratio_src = r.src_method
-                dm = payments_map.get(r.dest_method)
-                if dm:
-                    ratio_dest = payment_methods_map[dm.method].name
-                else:
-                    ratio_dest = r.dest_method
                 _ = r.engine.split('.')
                 rate = r.rate if r.rate >= 1 else 1/r.rate
                 externals.append(
@@ -204,8 +200,12 @@ class DirectionController(OwnerIdMixin, BaseExchangeController):
                         rate=round(rate, 2),
                         scope=r.scope,
                         engine=_[-1],
-                        src=ratio_src,
-                        dest=ratio_dest,
+                        src=catalog.method_names.get(
+                            r.src_method, r.src_method
+                        ),
+                        dest=catalog.method_names.get(
+                            r.dest_method, r.dest_method
+                        ),
                         utc=str(float_to_datetime(r.utc)),
                         secs_ago=secs_delta(utc, r.utc)
                     )
@@ -220,6 +220,31 @@ class DirectionController(OwnerIdMixin, BaseExchangeController):
             result.append(res)
         return result
 
+    async def _load_catalog(self, owner_did: str) -> 'DirectionCatalog':
+        cfg = self.context.config
+        key = (cfg.version, owner_did)
+        catalog = self._catalogs.get(key)
+        if catalog is None:
+            if owner_did == cfg.identity.did.root:
+                filters = {'owner_did__in': [None, owner_did]}
+            else:
+                filters = {'owner_did': owner_did}
+            methods = []
+            for repo in (
+                PaymentMethodRepository, NetworkRepository,
+                CashMethodRepository
+            ):
+                _, items = await repo.get_many(**filters)
+                methods.extend(items)
+            catalog = DirectionCatalog(cfg, owner_did, methods)
+            if cfg.version:
+                # держим справочники только актуальной версии конфига
+                for k in list(self._catalogs.keys()):
+                    if k[0] != cfg.version:
+                        del self._catalogs[k]
+                self._catalogs[key] = catalog
+        return catalog
+
     async def _load_ratios(
         self, directions: List[Direction]
     ) -> List[Union[EngineVariable, P2PEngineVariable]]:
@@ -258,20 +283,20 @@ class DirectionController(OwnerIdMixin, BaseExchangeController):
 
     @classmethod
     def __clean(cls, items: List[Resource.Retrieve]):
+        # скелеты направлений разделяются между запросами,
+        # поэтому не мутируем их, а подменяем копиями
         for item in items:
-            item.src.cur.icon = None
-            item.dest.cur.icon = None
-            item.src.method.icon = None
-            item.dest.method.icon = None
-
-    def __lazy_fill_empty_attrs(
-        self, items: List[
-                Union[Currency, PaymentMethod, Network, Payment, CashMethod]
-            ]
-    ):
-        for item in items:
-            if item.owner_did is None:
-                item.owner_did = self.context.config.identity.did.root
+            item.src = cls.__without_icons(item.src)
+            item.dest = cls.__without_icons(item.dest)
+
+    @classmethod
+    def __without_icons(cls, p: ComplexPayment) -> ComplexPayment:
+        return p.model_copy(
+            update={
+                'cur': p.cur.model_copy(update={'icon': None}),
+                'method': p.method.model_copy(update={'icon': None})
+            }
+        )
 
 
 class CurrencyResource(BaseResource):
@@ -1,25 +1,37 @@
 import base64
+import json
 import uuid
 from datetime import datetime
+from decimal import Decimal, ROUND_HALF_EVEN
 from typing import Any, List, Optional, Tuple, Literal, Union
 
-from pydantic import AnyHttpUrl, BaseModel, Extra, Field
+from pydantic import AnyHttpUrl, BaseModel, Extra, Field, ValidationError
 from django.http import (
     HttpRequest, Http404, HttpResponseNotAllowed,
-    HttpResponse, HttpResponseForbidden, HttpResponseBadRequest
+    HttpResponse, HttpResponseForbidden, HttpResponseBadRequest,
+    StreamingHttpResponse
 )
 
+from channels.db import database_sync_to_async
+from django.conf import settings as _settings
+from django.db import connection
+
 from lib import BaseResource, action
 
 from exchange.models import MassPaymentBalance
 from microledger import (
-    MassPaymentMicroLedger, DatabasePaymentConsensus
+    MassPaymentMicroLedger, IndexedPaymentConsensus
 )
 from entities import (
     mass_payment, Account, MerchantAccount, StorageItem, Identity
 )
+from cache import Cache
+from context import context as app_context
+from core import utc_now_float
 from ratios import GarantexEngine
-from reposiroty import StorageRepository, AccountRepository, AtomicDelegator  # noqa
+from reposiroty import (
+    StorageRepository, AccountRepository, AtomicDelegator, BlobRepository
+)
 from api import BaseExchangeController, AuthControllerMixin
 from reports import QugoRegistry
 
@@ -96,6 +108,19 @@ class PayloadAttachments(BaseModel):
     attachments: List[PayloadAttachment]
 
 
+class StoredAttachment(BaseModel):
+    """Payload сообщения-вложения, байты лежат в BlobRepository"""
+    uid: str
+    name: Optional[str] = None
+    mime_type: Optional[str] = None
+    # старые сообщения хранят данные прямо в payload
+    data: Optional[str] = None
+    digest: Optional[str] = None
+    size: Optional[int] = None
+    # префикс data-URL: '' - чистый base64, None - исходная строка
+    data_header: Optional[str] = None
+
+
 class AssetsRatios(BaseModel):
     engine: str
     base: str
@@ -107,6 +132,16 @@ class MassPaymentAssetsResource(BaseResource):
     STORAGE_CATEGORY = 'mass-payment-settings'
     TYPE_DEPOSIT = 'mass-payment-deposit'
     TYPE_RESERVED = 'mass-payment-reserved'
+    # шаг фиксированной точки, совпадает с decimal_places модели баланса
+    BALANCE_QUANT = Decimal('0.00000001')
+    # статусы депозита, при которых сумма зачисляется на баланс
+    CREDIT_STATUSES = ('success', 'correction')
+    # ответ assets опрашивается дашбордами каждые несколько секунд
+    ASSETS_CACHE_TTL = 5
+    SETTINGS_CACHE_TTL = 5*60
+    _cache = Cache(
+        pool=_settings.REDIS_CONN_POOL, namespace='mass-payment-assets'
+    )
 
     class PersistentSettings(BaseModel, extra=Extra.ignore):
         webhook: Optional[AnyHttpUrl] = None
@@ -150,6 +185,10 @@ class MassPaymentAssetsResource(BaseResource):
 
     @classmethod
     async def read_settings(cls, account: MerchantAccount) -> PersistentSettings:
+        cache = cls._cache.namespace(account.uid)
+        cached = await cache.get('settings')
+        if cached is not None:
+            return cls.PersistentSettings.model_validate(cached)
         filters = dict(
             category=cls.STORAGE_CATEGORY,
             storage_id=account.meta.identity.did.root,
@@ -159,9 +198,13 @@ class MassPaymentAssetsResource(BaseResource):
             settings = cls.PersistentSettings.model_validate(
                 item.payload
             )
-            return settings
         else:
-            return cls.PersistentSettings()
+            settings = cls.PersistentSettings()
+        await cache.set(
+            'settings', settings.model_dump(mode='json'),
+            ttl=cls.SETTINGS_CACHE_TTL
+        )
+        return settings
 
     @classmethod
     async def write_settings(
@@ -177,66 +220,158 @@ class MassPaymentAssetsResource(BaseResource):
         )
         actual = await StorageRepository.update_or_create(item, **filters)
         settings = cls.PersistentSettings.model_validate(actual.payload)
+        await cls._cache.namespace(account.uid).delete(['settings', 'assets'])
         return settings
 
+    @classmethod
+    async def read_cached_assets(
+        cls, account: MerchantAccount
+    ) -> Optional['MassPaymentAssetsResource.Retrieve']:
+        cached = await cls._cache.namespace(account.uid).get('assets')
+        if cached is not None:
+            return cls.Retrieve.model_validate(cached)
+        return None
+
+    @classmethod
+    async def cache_assets(
+        cls, account: MerchantAccount,
+        assets: 'MassPaymentAssetsResource.Retrieve'
+    ):
+        await cls._cache.namespace(account.uid).set(
+            'assets', assets.model_dump(mode='json'),
+            ttl=cls.ASSETS_CACHE_TTL
+        )
+
+    @classmethod
+    async def invalidate_cache(cls):
+        ks = await cls._cache.keys()
+        await cls._cache.delete(ks)
+
+    @classmethod
+    async def invalidate_assets(cls, account: MerchantAccount):
+        # вызывать после коммита изменения балансов
+        await cls._cache.namespace(account.uid).delete('assets')
+
     @classmethod
     async def read_balances(
         cls, account: MerchantAccount
     ) -> Tuple[float, float]:
-        deposit, reserved = 0.0, 0.0
-        # 1
-        deposit_rec = await MassPaymentBalance.objects.filter(
-            account_uid=account.uid, type=cls.TYPE_DEPOSIT
-        ).afirst()
-        if deposit_rec:
-            deposit = deposit_rec.value
-        # 2
-        reserved_rec = await MassPaymentBalance.objects.filter(
-            account_uid=account.uid, type=cls.TYPE_RESERVED
-        ).afirst()
-        if reserved_rec:
-            reserved = reserved_rec.value
-        return deposit, reserved
+        values = {}
+        async for type_, value in MassPaymentBalance.objects.filter(
+            account_uid=account.uid,
+            type__in=[cls.TYPE_DEPOSIT, cls.TYPE_RESERVED]
+        ).values_list('type', 'value'):
+            values[type_] = float(value)
+        return (
+            values.get(cls.TYPE_DEPOSIT, 0.0),
+            values.get(cls.TYPE_RESERVED, 0.0)
+        )
 
     @classmethod
     def update_balances(
         cls, account: MerchantAccount,
-        balance_increment: float, reserved_increment: float
+        balance_increment: Union[float, Decimal],
+        reserved_increment: Union[float, Decimal]
     ) -> Tuple[float, float]:
-        # 1
-        deposit_rec, _ = MassPaymentBalance.objects.update_or_create(
-            account_uid=account.uid, type=cls.TYPE_DEPOSIT
+        return cls._upsert_balances(
+            account, balance_increment, reserved_increment, increment=True
         )
-        deposit_rec.value += balance_increment
-        deposit_rec.save(update_fields=['value'])
-        # 2
-        reserved_rec, _ = MassPaymentBalance.objects.update_or_create(
-            account_uid=account.uid, type=cls.TYPE_RESERVED
-        )
-        reserved_rec.value += reserved_increment
-        reserved_rec.save(update_fields=['value'])
-        # 3
-        return deposit_rec.value, reserved_rec.value
 
     @classmethod
     def set_balances(
         cls, account: MerchantAccount,
-        balance: float, reserved: float
+        balance: Union[float, Decimal], reserved: Union[float, Decimal]
+    ) -> Tuple[float, float]:
+        return cls._upsert_balances(
+            account, balance, reserved, increment=False
+        )
+
+    @classmethod
+    def to_fixed(cls, value: Union[float, Decimal, None]) -> Decimal:
+        if value is None:
+            return Decimal(0)
+        # через str, чтобы 0.1 не превратилось в 0.1000000000000000055...
+        return Decimal(str(value)).quantize(
+            cls.BALANCE_QUANT, rounding=ROUND_HALF_EVEN
+        )
+
+    @classmethod
+    def project_deposit(
+        cls, deposits: List[MassPaymentMicroLedger.Message]
+    ) -> Decimal:
+        """Депозит, восстановленный из истории сообщений микро-леджера
+
+        Каждое сообщение со статусом из CREDIT_STATUSES зачисляло
+        сумму транзакции (см. MassPaymentController.deposit_one)
+        """
+        total = Decimal(0)
+        for msg in deposits:
+            if msg.status and msg.status.status in cls.CREDIT_STATUSES:
+                if msg.transaction:
+                    total += cls.to_fixed(msg.transaction.amount)
+        return total
+
+    @classmethod
+    async def verify_balances(
+        cls, merchant: MerchantAccount, rebuild: bool = False
+    ) -> Tuple[Decimal, Decimal]:
+        """Сверяет депозит с проекцией по микро-леджеру
+
+        Возвращает (хранимое значение, проекция). При rebuild=True
+        расхождение списывается/зачисляется атомарным инкрементом,
+        так что параллельные операции не теряются
+        """
+        ledger = MassPaymentMicroLedger.create_from_ledger(
+            src=merchant.meta.mass_payments.ledger,
+            me=merchant.meta.identity,
+            consensus_cls=IndexedPaymentConsensus
+        )
+        msgs = await ledger.load_deposits(aggregate=False)
+        projected = cls.project_deposit(msgs)
+        deposit, _ = await cls.read_balances(merchant)
+        stored = cls.to_fixed(deposit)
+        if rebuild and stored != projected:
+            deposit, _ = await database_sync_to_async(cls.update_balances)(
+                merchant, projected - stored, 0
+            )
+            stored = cls.to_fixed(deposit)
+            await cls.invalidate_assets(merchant)
+        return stored, projected
+
+    @classmethod
+    def _upsert_balances(
+        cls, account: MerchantAccount,
+        deposit: Union[float, Decimal], reserved: Union[float, Decimal],
+        increment: bool
     ) -> Tuple[float, float]:
-        # 1
-        deposit_rec, _ = MassPaymentBalance.objects.update_or_create(
-            account_uid=account.uid, type=cls.TYPE_DEPOSIT
+        # обе строки одним INSERT ... ON CONFLICT: сумма считается в БД
+        # под блокировкой строки, параллельные изменения не теряются,
+        # порядок строк фиксирован - взаимных блокировок нет
+        qn = connection.ops.quote_name
+        table = qn(MassPaymentBalance._meta.db_table)
+        if increment:
+            value = f'{table}.{qn("value")} + EXCLUDED.{qn("value")}'
+        else:
+            value = f'EXCLUDED.{qn("value")}'
+        sql = (
+            f'INSERT INTO {table} '
+            f'({qn("account_uid")}, {qn("type")}, {qn("value")}) '
+            f'VALUES (%s, %s, %s), (%s, %s, %s) '
+            f'ON CONFLICT ({qn("account_uid")}, {qn("type")}) '
+            f'DO UPDATE SET {qn("value")} = {value} '
+            f'RETURNING {qn("type")}, {qn("value")}'
         )
-        deposit_rec.value = balance
-        deposit_rec.save(update_fields=['value'])
-        # 2
-        reserved_rec, _ = MassPaymentBalance.objects.update_or_create(
-            account_uid=account.uid, type=cls.TYPE_RESERVED
+        params = [
+            account.uid, cls.TYPE_DEPOSIT, cls.to_fixed(deposit),
+            account.uid, cls.TYPE_RESERVED, cls.to_fixed(reserved)
+        ]
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            values = dict(cursor.fetchall())
+        return (
+            float(values[cls.TYPE_DEPOSIT]),
+            float(values[cls.TYPE_RESERVED])
         )
-        reserved_rec.value = reserved
-        reserved_rec.save(update_fields=['value'])
-        # 3
-        return deposit_rec.value, reserved_rec.value
 
 
 class AtomicChangeBalances(AtomicDelegator):
@@ -272,6 +407,12 @@ class MassPaymentController(AuthControllerMixin, BaseExchangeController):
     Resource = MassPaymentResource
 
     EDITABLE_STATUSES = ['attachment']
+    # статусы, которые пишутся в key-value состояния леджера
+    STATE_STATUSES = ['pending', 'success', 'processing', 'error']
+    # строк NDJSON в одной пачке bulk-загрузки статусов
+    BULK_CHUNK_SIZE = 500
+    # вложения крупнее отдаются потоком по чанкам из BlobRepository
+    STREAM_THRESHOLD = 1024 * 1024
 
     class ParticipantContext(BaseExchangeController.Context):
         identity: Optional[Identity] = None
@@ -298,7 +439,7 @@ class MassPaymentController(AuthControllerMixin, BaseExchangeController):
             self._ledger = MassPaymentMicroLedger.create_from_ledger(
                 src=self.context.merchant.meta.mass_payments.ledger,
                 me=self.context.identity,
-                consensus_cls=DatabasePaymentConsensus
+                consensus_cls=IndexedPaymentConsensus
             )
         return self._ledger
 
@@ -421,7 +562,7 @@ class MassPaymentController(AuthControllerMixin, BaseExchangeController):
         else:
             attach_items = []
             status_items = []
-            state_statuses = ['pending', 'success', 'processing', 'error']
+            state_statuses = self.STATE_STATUSES
             status_msg_with_attachments: List[
                 MassPaymentMicroLedger.Message] = []
             states = {}
@@ -510,6 +651,177 @@ class MassPaymentController(AuthControllerMixin, BaseExchangeController):
             )
             return [self._cast_storage_item_to_status(p) for p in payments]
 
+    @action(methods=['POST'], detail=False, url_path='status-bulk')
+    async def order_status_bulk(self, **filters):
+        """Потоковая загрузка статусов
+
+        Тело - NDJSON, строка = StatusResource.Update. Строки
+        обрабатываются пачками по BULK_CHUNK_SIZE, ответ - NDJSON
+        с результатом по каждой строке в порядке запроса: строки
+        каждой пачки отдаются клиенту сразу после ее обработки
+        """
+        # ответ итерируется после выхода из обработчика,
+        # контекст запроса к этому моменту уже сброшен
+        request = app_context.request
+
+        async def _process(chunk_: List[Tuple[int, bytes]]) -> bytes:
+            # статус ответа уже отправлен: ошибку пачки отдаем
+            # строками, а не обрывом потока
+            try:
+                rows = await self._ingest_statuses(chunk_)
+            except Exception as e:
+                rows = [self._bulk_row(n, error=str(e)) for n, _ in chunk_]
+            return self._ndjson(rows)
+
+        async def _stream():
+            chunk = []
+            for n, line in enumerate(request, start=1):
+                line = line.strip()
+                if not line:
+                    continue
+                chunk.append((n, line))
+                if len(chunk) >= self.BULK_CHUNK_SIZE:
+                    yield await _process(chunk)
+                    chunk = []
+            if chunk:
+                yield await _process(chunk)
+
+        return StreamingHttpResponse(
+            _stream(), content_type='application/x-ndjson'
+        )
+
+    @classmethod
+    def _ndjson(cls, rows: List[dict]) -> bytes:
+        return b''.join(json.dumps(r).encode() + b'\n' for r in rows)
+
+    async def _ingest_statuses(self, chunk: List[Tuple[int, bytes]]) -> List[dict]:  # noqa
+        results = {}
+        parsed: List[Tuple[int, StatusResource.Update]] = []
+        for n, line in chunk:
+            try:
+                s = StatusResource.Update.model_validate_json(line)
+            except ValidationError as e:
+                results[n] = self._bulk_row(n, error=e.errors()[0]['msg'])
+                continue
+            if self.EDITABLE_STATUSES is not None:
+                if s.status not in self.EDITABLE_STATUSES:
+                    results[n] = self._bulk_row(
+                        n, s.uid, error='Status is not editable'
+                    )
+                    continue
+            parsed.append((n, s))
+
+        # выплаты и вложения пачки - по одному запросу
+        _, payouts = await self.ledger.load_payments(
+            uid=list({s.uid for _, s in parsed})
+        )
+        payouts = {p.uid: p for p in payouts}
+        attachment_uids = set()
+        for _, s in parsed:
+            container = self._payload_attachments(s.payload)
+            if container:
+                attachment_uids |= {a.uid for a in container.attachments}
+        stored_attachments = await self._attachments_by_uid(
+            list(attachment_uids)
+        )
+
+        utc = datetime.utcnow()
+        msgs, states, accepted = [], {}, []
+        for n, s in parsed:
+            if s.uid not in payouts:
+                results[n] = self._bulk_row(
+                    n, s.uid, error='Payment not found'
+                )
+                continue
+            status = mass_payment.PaymentStatus(**dict(s))
+            container = self._payload_attachments(s.payload)
+            if container:
+                missed = [
+                    a.uid for a in container.attachments
+                    if a.uid not in stored_attachments
+                ]
+                if missed:
+                    results[n] = self._bulk_row(
+                        n, s.uid,
+                        error=f'Attachment with UID: {missed[0]} not found'
+                    )
+                    continue
+                status.payload['attachments'] = [
+                    stored_attachments[a.uid] for a in container.attachments
+                ]
+            if s.status in self.STATE_STATUSES:
+                states[s.uid] = s.status
+            msgs.append(
+                MassPaymentMicroLedger.Message(
+                    uid=s.uid, type='status', status=status, utc=utc
+                )
+            )
+            accepted.append((n, s.uid, status))
+
+        if msgs:
+            try:
+                await self.ledger.send_batch(msgs, states=states)
+            except RuntimeError as e:
+                for n, uid, _ in accepted:
+                    results[n] = self._bulk_row(n, uid, error=str(e))
+                accepted = []
+        # ответ строится из проекции и записанных статусов, без перечитывания
+        for n, uid, status in accepted:
+            payout = payouts[uid]
+            if status.status in MassPaymentMicroLedger.PROJECTED_STATUSES:
+                payout.status = status
+                payout.utc = utc
+            results[n] = self._bulk_row(
+                n, uid,
+                status=self._cast_storage_item_to_status(payout).model_dump(
+                    mode='json'
+                )
+            )
+        return [results[n] for n, _ in chunk]
+
+    @classmethod
+    def _bulk_row(
+        cls, line: int, uid: str = None,
+        status: dict = None, error: str = None
+    ) -> dict:
+        return {
+            'line': line, 'uid': uid, 'success': error is None,
+            'status': status, 'error': error
+        }
+
+    @classmethod
+    def _payload_attachments(
+        cls, payload: Optional[dict]
+    ) -> Optional[PayloadAttachments]:
+        if not payload:
+            return None
+        try:
+            return PayloadAttachments.model_validate(payload)
+        except ValueError:
+            return None
+
+    async def _attachments_by_uid(self, uid: List[str]) -> dict:
+        """Сведения о вложениях для payload статуса одним запросом
+        (сообщение вложения имеет uid самого вложения)
+        """
+        if not uid:
+            return {}
+        _, loaded = await self.ledger.load(
+            uid=uid, type_='attachment', sort='desc'
+        )
+        result = {}
+        for msg in loaded:
+            try:
+                e = StoredAttachment.model_validate(msg.status.payload)
+            except ValueError:
+                continue
+            if e.uid not in result:
+                result[e.uid] = AttachmentsResource.Retrieve(
+                    name=e.name, data=None, mime_type=e.mime_type,
+                    uid=e.uid, utc=msg.utc
+                ).model_dump(mode='json')
+        return result
+
     @action(
         methods=['GET', 'POST'],
         detail=False, url_path='assets', resource=MassPaymentAssetsResource
@@ -592,6 +904,10 @@ class MassPaymentController(AuthControllerMixin, BaseExchangeController):
                 states={msg.uid: msg.status.status},
                 atomic=atomic
             )
+            if atomic:
+                await MassPaymentAssetsResource.invalidate_assets(
+                    self.context.merchant
+                )
             msgs = await self.ledger.load_deposits(
                 aggregate=True, uid=msg.uid
             )
@@ -702,19 +1018,14 @@ class MassPaymentController(AuthControllerMixin, BaseExchangeController):
         )
         if loaded:
             msg = loaded[0]
-            e = AttachmentsResource.Create.model_validate(msg.status.payload)
-            if e.data.startswith('data:') and 'base64' in e.data[:512]:
-                header, encoded = e.data.split("base64,", 1)
-                binaries = base64.b64decode(encoded)
-            else:
-                try:
-                    binaries = base64.b64decode(e.data)
-                except Exception:
-                    binaries = e.data.encode()
+            e = StoredAttachment.model_validate(msg.status.payload)
             if e.mime_type:
                 self.metadata.content_type = e.mime_type
             if e.name:
                 self.metadata.content_name = 'attachment; filename=' + e.name
+            if e.digest:
+                return await self._blob_response(e)
+            _, binaries = self._decode_attachment_data(e.data or '')
             return HttpResponse(content=binaries, content_type=e.mime_type)
         else:
             return None
@@ -764,18 +1075,24 @@ class MassPaymentController(AuthControllerMixin, BaseExchangeController):
     async def _read_assets(
         cls, merchant: MerchantAccount
     ) -> MassPaymentAssetsResource.Retrieve:
+        cached = await MassPaymentAssetsResource.read_cached_assets(merchant)
+        if cached:
+            return cached
         settings = await MassPaymentAssetsResource.read_settings(
             account=merchant
         )
+        base = merchant.meta.mass_payments.ratios.base
+        quote = merchant.meta.mass_payments.ratios.quote
         engine = GarantexEngine()
-        ratio = await engine.ratio(
-            base=merchant.meta.mass_payments.ratios.base,
-            quote=merchant.meta.mass_payments.ratios.quote
-        )
+        # снимок курса обновляет cron, биржа - только если он устарел
+        ratio = await engine.ratio(base=base, quote=quote, cache_only=True)
+        stale_at = (ratio.utc or 0) + engine.CACHE_TTL if ratio else 0
+        if stale_at < utc_now_float():
+            ratio = await engine.ratio(base=base, quote=quote)
         deposit, reserved = await MassPaymentAssetsResource.read_balances(
             merchant
         )
-        return MassPaymentAssetsResource.Retrieve(
+        assets = MassPaymentAssetsResource.Retrieve(
             webhook=settings.webhook,
             balance=deposit - reserved,
             deposit=deposit,
@@ -784,11 +1101,13 @@ class MassPaymentController(AuthControllerMixin, BaseExchangeController):
             address=merchant.meta.mass_payments.asset.address,
             ratios=AssetsRatios(
                 engine=merchant.meta.mass_payments.ratios.engine.replace('Engine', ''),  # noqa
-                base=merchant.meta.mass_payments.ratios.base,
-                quote=merchant.meta.mass_payments.ratios.quote,
+                base=base,
+                quote=quote,
                 ratio=round(ratio.ratio, 2) if ratio else None
             )
         )
+        await MassPaymentAssetsResource.cache_assets(merchant, assets)
+        return assets
 
     @classmethod
     def _cast_storage_item_to_status(
@@ -860,14 +1179,18 @@ class MassPaymentController(AuthControllerMixin, BaseExchangeController):
             result = []
             for msg in loaded:
                 try:
-                    a = AttachmentsResource.Retrieve.model_validate(
-                        dict(**msg.status.payload, utc=msg.utc)
+                    e = StoredAttachment.model_validate(msg.status.payload)
+                    a = AttachmentsResource.Retrieve(
+                        name=e.name,
+                        mime_type=e.mime_type,
+                        uid=e.uid,
+                        utc=msg.utc
                     )
                 except ValueError:
                     ...
                 else:
-                    if 'full' not in filters:
-                        a.data = None
+                    if 'full' in filters:
+                        a.data = await self._load_attachment_data(e)
                     result.append(a)
             return result
         elif data:
@@ -877,7 +1200,13 @@ class MassPaymentController(AuthControllerMixin, BaseExchangeController):
                 items = [data]
                 return_as_list = False
 
-            msgs = self._attachments_to_messages(items)
+            # blob пишется до send_batch и вне его транзакции: при ошибке
+            # отправки он остается без ссылок. Это безопасно - blob
+            # адресуется хешем и будет переиспользован повторной загрузкой,
+            # а удалять его здесь нельзя: на тот же хеш может ссылаться
+            # параллельная запись
+            msgs = await self._attachments_to_messages(items)
+            echo = {i.uid: i.data for i in items}
             await self.ledger.send_batch(msgs)
             _, loaded = await self.ledger.load(
                 status='attachment',
@@ -891,14 +1220,14 @@ class MassPaymentController(AuthControllerMixin, BaseExchangeController):
         uid_set = set()
         for msg in loaded:
             msg: MassPaymentMicroLedger.Message
-            e = AttachmentsResource.Create.model_validate(msg.status.payload)
+            e = StoredAttachment.model_validate(msg.status.payload)
             if e.uid in uid_set:
                 continue
             uid_set.add(e.uid)
             attachments.append(
                 AttachmentsResource.Retrieve(
                     name=e.name,
-                    data=None if mute_data else e.data,
+                    data=None if mute_data else echo.get(e.uid, e.data),
                     mime_type=e.mime_type,
                     uid=e.uid,
                     utc=msg.utc
@@ -921,7 +1250,7 @@ class MassPaymentController(AuthControllerMixin, BaseExchangeController):
             return False
 
     @classmethod
-    def _attachments_to_messages(
+    async def _attachments_to_messages(
         cls, items: List[AttachmentsResource.Create]
     ) -> List[MassPaymentMicroLedger.Message]:
         msgs = []
@@ -936,18 +1265,139 @@ class MassPaymentController(AuthControllerMixin, BaseExchangeController):
                     item.mime_type = header.replace(';', '').split('data:')[-1]
                 except Exception:
                     ...
+            stored = StoredAttachment(
+                uid=item.uid, name=item.name, mime_type=item.mime_type
+            )
+            header, binaries = cls._decode_attachment_data(item.data)
+            if cls._encode_attachment_data(header, binaries) == item.data:
+                # в леджер (и в каждую копию участника) идет только хеш
+                blob = await BlobRepository.put(binaries, item.mime_type)
+                stored.digest = blob.digest
+                stored.size = blob.size
+                stored.data_header = header
+            else:
+                # строку не восстановить байт-в-байт - храним как есть
+                stored.data = item.data
             msgs.append(
                 MassPaymentMicroLedger.Message(
                     uid=item.uid,
                     type='attachment',
                     status=mass_payment.PaymentStatus(
                         status='attachment',
-                        payload=item.model_dump(mode='json')
+                        payload=stored.model_dump(
+                            mode='json', exclude_none=True
+                        )
                     )
                 )
             )
         return msgs
 
+    @classmethod
+    def _decode_attachment_data(
+        cls, data: str
+    ) -> Tuple[Optional[str], bytes]:
+        if data.startswith('data:') and 'base64' in data[:512]:
+            header, encoded = data.split("base64,", 1)
+            return header + 'base64,', base64.b64decode(encoded)
+        try:
+            return '', base64.b64decode(data)
+        except Exception:
+            return None, data.encode()
+
+    @classmethod
+    def _encode_attachment_data(
+        cls, header: Optional[str], binaries: bytes
+    ) -> Optional[str]:
+        if header is None:
+            try:
+                return binaries.decode()
+            except UnicodeDecodeError:
+                return None
+        return header + base64.b64encode(binaries).decode()
+
+    @classmethod
+    async def _load_attachment_data(
+        cls, e: StoredAttachment
+    ) -> Optional[str]:
+        if not e.digest:
+            return e.data
+        binaries = await BlobRepository.read(e.digest)
+        if binaries is None:
+            return None
+        return cls._encode_attachment_data(e.data_header, binaries)
+
+    @classmethod
+    async def _blob_response(cls, e: StoredAttachment):
+        blob = await BlobRepository.get(digest=e.digest)
+        if blob is None:
+            return None
+        byte_range = cls._parse_range(
+            app_context.request.headers.get('Range'), blob.size
+        )
+        if byte_range:
+            start, end = byte_range
+            if start > end:
+                resp = HttpResponse(status=416)
+                resp['Content-Range'] = f'bytes */{blob.size}'
+                return resp
+            length = end - start + 1
+            if length > cls.STREAM_THRESHOLD:
+                resp = StreamingHttpResponse(
+                    BlobRepository.iter_chunks(e.digest, (start, end)),
+                    status=206, content_type=e.mime_type
+                )
+                resp['Content-Length'] = str(length)
+            else:
+                resp = HttpResponse(
+                    content=await BlobRepository.read(
+                        e.digest, start, length
+                    ),
+                    status=206, content_type=e.mime_type
+                )
+            resp['Content-Range'] = f'bytes {start}-{end}/{blob.size}'
+        elif blob.size > cls.STREAM_THRESHOLD:
+            resp = StreamingHttpResponse(
+                BlobRepository.iter_chunks(e.digest),
+                content_type=e.mime_type
+            )
+            resp['Content-Length'] = str(blob.size)
+        else:
+            resp = HttpResponse(
+                content=await BlobRepository.read(e.digest),
+                content_type=e.mime_type
+            )
+        resp['Accept-Ranges'] = 'bytes'
+        return resp
+
+    @classmethod
+    def _parse_range(
+        cls, header: Optional[str], size: int
+    ) -> Optional[Tuple[int, int]]:
+        """Один диапазон "bytes=a-b" из заголовка Range
+
+        None - заголовка нет, он не поддерживается или синтаксически
+        неверен (RFC 9110: игнорируем и отдаем целиком),
+        start > end - диапазон не пересекается с файлом (416)
+        """
+        if not header or not header.startswith('bytes=') or ',' in header:
+            return None
+        first, sep, last = header[len('bytes='):].strip().partition('-')
+        if not sep or not (first + last).isdigit():
+            return None
+        if first:
+            start = int(first)
+            end = int(last) if last else size - 1
+            if end < start:
+                # например bytes=20-10
+                return None
+        else:
+            suffix = int(last)
+            if suffix == 0:
+                return size, size - 1
+            start = max(size - suffix, 0)
+            end = size - 1
+        return start, min(end, size - 1)
+
     @classmethod
     def _msg2deposit_entity(
         cls, m: MassPaymentMicroLedger.Message,
@@ -1031,21 +1481,25 @@ class ControlPanelMassPaymentController(MassPaymentController):
         methods=['GET'], detail=False, url_path='export'
     )
     async def export_to_external_system(self, **filters):
-        _, payment_orders = await self.ledger.load_payments(
-            status='processing'
-        )
         engine = filters.get('engine')
         if engine == 'qugo':
-            exporter = QugoRegistry(payments=payment_orders)
-            binary = await exporter.export_to_buffer()
-            self.metadata.content_type = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'  # noqa
-            self.metadata.content_name = 'attachment; filename=' + 'Qugo Payment-registry.xlsx'  # noqa
-            print('======== XXX =======')
-            print(self.metadata.content_name)
-            print('======================')
-            return HttpResponse(
-                content=binary, content_type=self.metadata.content_type
+            format_ = filters.get('format') or 'xlsx'
+            if format_ not in QugoRegistry.formats():
+                return HttpResponseBadRequest(
+                    content=f'Unsupported format "{format_}"'.encode()
+                )
+            # выплаты читаются порциями по ходу отдачи ответа
+            exporter = QugoRegistry(
+                payments=self.ledger.iter_payments(status='processing')
+            )
+            self.metadata.content_type = QugoRegistry.CONTENT_TYPES[format_]
+            self.metadata.content_name = 'attachment; filename=' + f'Qugo Payment-registry.{format_}'  # noqa
+            resp = StreamingHttpResponse(
+                exporter.stream(format_),
+                content_type=self.metadata.content_type
             )
+            resp['Content-Disposition'] = self.metadata.content_name
+            return resp
 
     async def _detailed_check_permission(self) -> bool:
         if self.context.merchant is None:
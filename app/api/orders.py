@@ -22,7 +22,7 @@ from reposiroty import (
 from api import BaseExchangeController, AuthControllerMixin
 from microledger import (
     MassPaymentMicroLedger, DatabasePaymentConsensus,
-    PaymentRequestMicroLedger
+    IndexedPaymentConsensus, PaymentRequestMicroLedger, PaymentRequestContract
 )
 
 
@@ -107,7 +107,7 @@ class OrderController(
     _min_order_value = 4500
 
     async def get_one(self, pk: Any, **filters) -> Optional[Resource.Retrieve]:
-        res = await self.get_many()
+        res = await self._load_orders(id_=pk)
         for i in res:
             if i.id == pk:
                 return self.Resource.Retrieve.model_validate(dict(i))
@@ -117,6 +117,14 @@ class OrderController(
         self, order_by: Any = 'id', limit: int = None,
         offset: int = None, **filters
     ) -> List[Resource.Retrieve]:
+        return await self._load_orders(**filters)
+
+    async def _load_orders(
+        self, id_: str = None, **filters
+    ) -> List[Resource.Retrieve]:
+        """Ордера по всем леджерам identity за фиксированное число
+        запросов (не зависит от количества леджеров)
+        """
         result = []
         type_ = filters.get('type')
         if isinstance(type_, str):
@@ -131,84 +139,13 @@ class OrderController(
             # 1. Mass payments
             if 'payments' in type_:
                 mass_payment_ledgers = await LedgerRepository.load(
-                    self.identity, tag='payments'
+                    self.identity, tag='payments', id_=id_
                 )
             else:
                 mass_payment_ledgers = []
-            for ledger in mass_payment_ledgers:
-                if 'payments' in ledger.tags:
-                    dlt: MassPaymentMicroLedger = MassPaymentMicroLedger.create_from_ledger(  # noqa
-                        src=ledger, me=self.identity,
-                        consensus_cls=DatabasePaymentConsensus
-                    )
-                    _, payment_orders = await dlt.load_payments(
-                        status='processing'
-                    )
-                    _, statuses = await dlt.load(
-                        uid=[p.uid for p in payment_orders]
-                    )
-                    if ledger.role_by_did(self.identity.did.root) == 'processing':
-                        pending_deposits = await dlt.load_deposits(
-                            aggregate=True, status='pending'
-                        )
-                    else:
-                        pending_deposits = []
-                    attachments = []
-                    attachments_ids = set()
-                    for p in payment_orders + statuses:
-                        try:
-                            container = PayloadAttachmentsSchema.model_validate(p.status.payload)
-                            for a in container.attachments:
-                                if a.uid not in attachments_ids:
-                                    attachments.append(a)
-                                    attachments_ids.add(a.uid)
-                        except Exception:
-                            pass
-                    batch_deposits = []
-                    for msg in pending_deposits:
-                        attachments_container = None
-                        if msg.status.payload:
-                            try:
-                                attachments_container = PayloadAttachmentsSchema.model_validate(
-                                    msg.status.payload
-                                )
-                            except ValueError:
-                                ...
-                        if attachments_container:
-                            deposit_attachments = [
-                                a.model_dump(mode='json')
-                                for a in attachments_container.attachments
-                            ]
-                        else:
-                            deposit_attachments = []
-                        dep = Deposit(
-                            uid=msg.uid,
-                            utc=msg.utc,
-                            amount=msg.transaction.amount,
-                            currency=msg.transaction.currency,
-                            address=msg.transaction.address,
-                            pay_method_code=msg.transaction.pay_method_code,
-                            attachments=deposit_attachments
-                        )
-                        batch_deposits.append(dep)
-
-                    if payment_orders or batch_deposits:
-                        result.append(
-                            self.Resource.Retrieve(
-                                id=ledger.id,
-                                type='mass-payment',
-                                batch=Batch(
-                                    orders=[
-                                        self._cast_dlt_msg_to_order(
-                                            src=msg
-                                        ) for msg in payment_orders
-                                    ],
-                                    ledger=await self._load_batch_ledger_meta(ledger),  # noqa
-                                    attachments=attachments,
-                                    deposits=batch_deposits
-                                )
-                            )
-                        )
+            result.extend(
+                await self._load_mass_payment_orders(mass_payment_ledgers)
+            )
             # 2. Payment Request
             if 'payment-request' in type_:
                 ledger_filters = {}
@@ -242,19 +179,128 @@ class OrderController(
                         ledger_filters['id_'] = ledger_filters_uid
                 elif ledger_filters_status:
                     ledger_filters['id_'] = ledger_filters_status
-                payment_requests_ledgers = await LedgerRepository.load(
-                    self.identity, tag='payment-request', **ledger_filters
-                )
+                if id_:
+                    allowed = ledger_filters['id_']
+                    if allowed is None or id_ in allowed:
+                        ledger_filters['id_'] = [id_]
+                    else:
+                        ledger_filters['id_'] = []
+                if id_ and not ledger_filters['id_']:
+                    payment_requests_ledgers = []
+                else:
+                    payment_requests_ledgers = await LedgerRepository.load(
+                        self.identity, tag='payment-request', **ledger_filters
+                    )
             else:
                 payment_requests_ledgers = []
+            # контракты всех леджеров одним запросом
+            contracts = await PaymentRequestContract.fetch_many(
+                me=self.identity,
+                ledger_ids=[
+                    self._get_payment_request_dlt(ledger).ledger_id()
+                    for ledger in payment_requests_ledgers
+                ]
+            )
             for ledger in payment_requests_ledgers:
                 dlt: PaymentRequestMicroLedger = self._get_payment_request_dlt(ledger)  # noqa
-                order = await dlt.contract.fetch()
                 result.append(
                     OrderResource.Retrieve(
                         id=dlt.ledger_id(),
                         type='payment-request',
-                        payment_request=order
+                        payment_request=contracts.get(dlt.ledger_id())
+                    )
+                )
+        return result
+
+    async def _load_mass_payment_orders(
+        self, ledgers: List[Ledger]
+    ) -> List[Resource.Retrieve]:
+        ledgers = [ledger for ledger in ledgers if 'payments' in ledger.tags]
+        if not ledgers:
+            return []
+        me = self.identity.did.root
+        consensus = IndexedPaymentConsensus(me=me, participants=[])
+        # владельцы всех пакетов одним запросом
+        await AccountRepository.load_many(did=list({
+            ledger.participants_by_role('owner')[0]
+            for ledger in ledgers
+            if ledger.participants_by_role('owner')
+        }))
+        payments = await MassPaymentMicroLedger.load_payments_many(
+            ledger_ids=[ledger.id for ledger in ledgers], status='processing'
+        )
+        statuses = await MassPaymentMicroLedger.load_many(
+            consensus, uid={
+                ledger_id: [p.uid for p in items]
+                for ledger_id, items in payments.items()
+            }
+        )
+        deposits = await MassPaymentMicroLedger.load_deposits_many(
+            consensus,
+            ledger_ids=[
+                ledger.id for ledger in ledgers
+                if ledger.role_by_did(me) == 'processing'
+            ],
+            status='pending'
+        )
+        result = []
+        for ledger in ledgers:
+            payment_orders = payments[ledger.id]
+            pending_deposits = deposits.get(ledger.id, [])
+            attachments = []
+            attachments_ids = set()
+            for p in payment_orders + statuses[ledger.id]:
+                try:
+                    container = PayloadAttachmentsSchema.model_validate(p.status.payload)  # noqa
+                    for a in container.attachments:
+                        if a.uid not in attachments_ids:
+                            attachments.append(a)
+                            attachments_ids.add(a.uid)
+                except Exception:
+                    pass
+            batch_deposits = []
+            for msg in pending_deposits:
+                attachments_container = None
+                if msg.status.payload:
+                    try:
+                        attachments_container = PayloadAttachmentsSchema.model_validate(  # noqa
+                            msg.status.payload
+                        )
+                    except ValueError:
+                        ...
+                if attachments_container:
+                    deposit_attachments = [
+                        a.model_dump(mode='json')
+                        for a in attachments_container.attachments
+                    ]
+                else:
+                    deposit_attachments = []
+                dep = Deposit(
+                    uid=msg.uid,
+                    utc=msg.utc,
+                    amount=msg.transaction.amount,
+                    currency=msg.transaction.currency,
+                    address=msg.transaction.address,
+                    pay_method_code=msg.transaction.pay_method_code,
+                    attachments=deposit_attachments
+                )
+                batch_deposits.append(dep)
+
+            if payment_orders or batch_deposits:
+                result.append(
+                    self.Resource.Retrieve(
+                        id=ledger.id,
+                        type='mass-payment',
+                        batch=Batch(
+                            orders=[
+                                self._cast_dlt_msg_to_order(
+                                    src=msg
+                                ) for msg in payment_orders
+                            ],
+                            ledger=await self._load_batch_ledger_meta(ledger),  # noqa
+                            attachments=attachments,
+                            deposits=batch_deposits
+                        )
                     )
                 )
         return result
@@ -409,7 +455,7 @@ class OrderController(
         if not owners:
             return None
         owner_did = owners[0]
-        account: Account = await AccountRepository.get(did=owner_did)
+        account: Account = await AccountRepository.load(did=owner_did)
         if account:
             if account.merchant_meta:
                 kwargs['title'] = account.merchant_meta.get('title')
@@ -1,16 +1,19 @@
-from typing import Any, List, Optional
+import gzip
+from typing import Any, List, Optional, Dict
 from xml.etree.ElementTree import (
     Element as XmlElement, SubElement as XmlSubElement,
     tostring as xml_tostring
 )
 
 from pydantic import BaseModel
-from django.http import HttpResponse
+from django.http import HttpResponse, HttpRequest
 
 from lib import BaseResource
+from reposiroty import ExchangeConfigRepository
 from core.utils import float_to_datetime
 from context import context
 from api import BaseExchangeController
+from api.base import ExchangeManyResourceTransport
 from merchants import (
     MerchantRatios, load_directions
 )
@@ -132,3 +135,98 @@ class XMLEngineRateController(EngineRateController):
             content_type='application/xml',
             content=xml_tostring(root)
         )
+
+
+class RenderedDocument(BaseModel):
+    """Готовый к отдаче документ для конкретной версии конфига
+    и набора курсов
+    """
+    version: str
+    content_type: str
+    body: bytes
+    gzip_body: bytes
+
+    @property
+    def etag(self) -> str:
+        # weak: одно и то же содержимое отдается и сжатым, и нет
+        return f'W/"{self.version}"'
+
+    def matches(self, if_none_match: Optional[str]) -> bool:
+        if not if_none_match:
+            return False
+        for tag in if_none_match.split(','):
+            tag = tag.strip()
+            if tag == '*' or tag.removeprefix('W/') == self.etag[2:]:
+                return True
+        return False
+
+
+class RatesManyResourceTransport(ExchangeManyResourceTransport):
+    """Отдает выгрузку курсов агрегаторам из заранее отрендеренных байт
+
+    Документ рендерится один раз на пару версий конфига и набора курсов
+    (см. ExchangeConfig.version, MerchantRatios.ratios_version) и хранится
+    в памяти процесса вместе со сжатой копией. Неизменившиеся опросы
+    получают 304 без рендера и обращения к хранилищу курсов
+    """
+
+    # ключ - класс контроллера, храним только последнюю версию
+    _rendered: Dict[str, RenderedDocument] = {}
+
+    async def transport(
+        self, handler, resource, request: HttpRequest, context,
+        *args, **kwargs
+    ) -> HttpResponse:
+        if request.method != 'GET' or request.GET or args or kwargs:
+            return await super().transport(
+                handler, resource, request, context, *args, **kwargs
+            )
+        key = self.controller.__class__.__name__
+        version = await self._document_version()
+        doc = self._rendered.get(key)
+        if doc is None or doc.version != version:
+            resp = await super().transport(
+                handler, resource, request, context, *args, **kwargs
+            )
+            if not version or resp.status_code != 200:
+                return resp
+            # курсы или конфиг могли обновиться во время рендера
+            if version != await self._document_version():
+                return resp
+            body = resp.content
+            doc = RenderedDocument(
+                version=version,
+                content_type=resp['Content-Type'],
+                body=body,
+                gzip_body=gzip.compress(body)
+            )
+            self._rendered[key] = doc
+        return self._build_response(request, doc)
+
+    @classmethod
+    async def _document_version(cls) -> Optional[str]:
+        cfg = await ExchangeConfigRepository.current()
+        engine = MerchantRatios(settings=MerchantRatios.Settings())
+        ratios_version = await engine.ratios_version()
+        if not cfg.version or not ratios_version:
+            return None
+        return f'{cfg.version}-{ratios_version}'
+
+    @classmethod
+    def _build_response(
+        cls, request: HttpRequest, doc: RenderedDocument
+    ) -> HttpResponse:
+        if doc.matches(request.headers.get('If-None-Match')):
+            resp = HttpResponse(status=304)
+        elif 'gzip' in request.headers.get('Accept-Encoding', ''):
+            resp = HttpResponse(
+                content=doc.gzip_body, content_type=doc.content_type
+            )
+            resp['Content-Encoding'] = 'gzip'
+        else:
+            resp = HttpResponse(
+                content=doc.body, content_type=doc.content_type
+            )
+        resp['ETag'] = doc.etag
+        resp['Vary'] = 'Accept-Encoding'
+        return resp
@@ -3,7 +3,9 @@ from .kyc import KYCController, MTSKYCController
 from .account import (
     AccountController, RegistrationController, ContactsVerifyController
 )
-from .ratios import EngineRateController, XMLEngineRateController
+from .ratios import (
+    EngineRateController, XMLEngineRateController, RatesManyResourceTransport
+)
 from .storage import StorageController
 from .ledgers import LedgerController
 from .directions import (
@@ -32,7 +34,9 @@ api_router.register(
 )
 api_router.register('orders', OrderController)
 
-rates_router = ExchangeHttpRouter('ratios')
+rates_router = ExchangeHttpRouter(
+    'ratios', many_transport=RatesManyResourceTransport
+)
 rates_router.register('external', EngineRateController)
 rates_router.register('external.xml', XMLEngineRateController)
 api_router.append(rates_router)
@@ -1,8 +1,10 @@
 import weakref
-from typing import Optional
+from typing import Optional, Dict
 from contextvars import ContextVar
 from contextlib import contextmanager
 
+from django.http import HttpRequest
+
 from entities import Account, ExchangeConfig, Session
 
 
@@ -11,6 +13,9 @@ class Context:
     user: Optional[Account]
     session: Optional[Session]
     config: ExchangeConfig
+    # мемоизация чтений в пределах одного запроса
+    memo: Dict
+    request: Optional[HttpRequest]
     _proxy = ContextVar('context', default=None)
 
     def __getattr__(self, item):
@@ -23,12 +28,15 @@ class Context:
     @contextmanager
     def create_context(
         cls, config: ExchangeConfig,
-        user: Account = None, session: Session = None
+        user: Account = None, session: Session = None,
+        request: HttpRequest = None
     ):
         inst = Context()
         inst.config = config
         inst.user = user
         inst.session = session
+        inst.memo = {}
+        inst.request = request
         token = cls._proxy.set(weakref.proxy(inst))
         try:
             yield inst
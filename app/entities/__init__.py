@@ -17,7 +17,7 @@ from .auth import (
     GrantedAccount, Credential, Session, MerchantMeta,
     MerchantAccount, MassPaymentRatios
 )
-from .storage import StorageItem
+from .storage import StorageItem, Blob
 from .order import (
     PaymentDetails, Order, CardDetails, PaymentRequest
 )
@@ -33,8 +33,8 @@ __all__ = [
     "AccountKYCPhotos", "GrantedAccount", "BestChangeMethodMapping",
     "BestChangeCodeRule", "OrganizationDocument", "CashMethod",
     "Credential", "Session", "MerchantMeta", "UrlPaths", "AnonymousAccount",
-    "StorageItem", "mass_payment", "Identity", "DIDSettings", "MerchantAccount",
-    "Ledger", "PaymentDetails", "Order", "CardDetails", "ReportsConfig",
+    "StorageItem", "Blob", "mass_payment", "Identity", "DIDSettings",
+    "MerchantAccount", "Ledger", "PaymentDetails", "Order", "CardDetails", "ReportsConfig",
     "MassPaymentRatios", "AccountVerifiedFields", "SMSGatewayConfig",
     "PaymentRequest"
 ]
@@ -27,6 +27,8 @@ class ExchangeConfig(pydantic.BaseModel, extra=pydantic.Extra.ignore):
     sms: Optional[SMSGatewayConfig] = pydantic.Field(
         default_factory=SMSGatewayConfig
     )
+    # отпечаток содержимого, заполняется репозиторием при сборке из БД
+    version: Optional[str] = None
 
 
 class BestChangeCodeRule(pydantic.BaseModel):
@@ -19,3 +19,10 @@ class StorageItem(BaseEntity):
     created_at: Optional[datetime] = Field(default_factory=datetime.utcnow)
     payload: Dict
     storage_ids: Optional[List[str]] = Field(default_factory=list)
+
+
+class Blob(BaseEntity):
+    digest: str
+    size: int
+    mime_type: Optional[str] = None
+    created_at: Optional[datetime] = None
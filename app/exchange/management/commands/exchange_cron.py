@@ -11,8 +11,10 @@ from ratios import (
     GarantexEngine, GarantexP2P, HTXP2P
 )
 from api.kyc import MTSKYCController
+from api.mass_payment import MassPaymentAssetsResource
 from context import Context, context
-from reposiroty import ExchangeConfigRepository
+from entities import MerchantAccount
+from reposiroty import ExchangeConfigRepository, AccountRepository
 from merchants import MerchantRatios, load_directions
 
 
@@ -53,6 +55,7 @@ class Command(BaseCommand):
                 kyc_tsk = asyncio.create_task(self._refresh_kyc_records_cyclic())
                 try:
                     await self._refresh_ratios(cache)
+                    await self._refresh_mass_payments()
                     await cache.set(
                         key=cache_key,
                         value={'flag': 'ok'},
@@ -175,6 +178,44 @@ class Command(BaseCommand):
         await engine.build_ratios(directions)
         logging.critical('Successfully Merchant ratios was refreshed')
 
+    @classmethod
+    async def _refresh_mass_payments(cls):
+        logging.critical('Refresh Mass-payments')
+        merchants = await AccountRepository.get_merchants(ignore_cache=True)
+        for merchant in merchants:
+            mass_payments = merchant.meta.mass_payments
+            if not mass_payments or not mass_payments.enabled:
+                continue
+            if not mass_payments.ledger or not merchant.meta.identity:
+                continue
+            try:
+                await cls._refresh_mass_payment_ratio(merchant)
+                await cls._verify_mass_payment_balances(merchant)
+            except Exception:
+                logging.exception('EXC')
+        logging.critical('Successfully Mass-payments was refreshed')
+
+    @classmethod
+    async def _refresh_mass_payment_ratio(cls, merchant: MerchantAccount):
+        # прогрев снимка курса, который читает эндпоинт assets
+        ratios = merchant.meta.mass_payments.ratios
+        if ratios:
+            engine = GarantexEngine()
+            await engine.ratio(base=ratios.base, quote=ratios.quote)
+
+    @classmethod
+    async def _verify_mass_payment_balances(cls, merchant: MerchantAccount):
+        # только сверка: расхождение исправляется вручную через
+        # exchange_mass_payment_balances --rebuild
+        stored, projected = await MassPaymentAssetsResource.verify_balances(
+            merchant
+        )
+        if stored != projected:
+            logging.critical(
+                f'Mass-payment balance drift for {merchant.uid}: '
+                f'deposit {stored}, ledger {projected}'
+            )
+
     @classmethod
     async def _refresh_kyc_records(cls):
         logging.critical('Refresh KYC records')
@@ -0,0 +1,28 @@
+# Generated by Django 4.2.9 on 2026-10-19 12:00
+
+from django.db import migrations, models
+
+
+def fill_digest(apps, schema_editor):
+    Credential = apps.get_model('exchange', 'Credential')
+    for cred in Credential.objects.filter(payload__has_key='token').iterator():
+        token = cred.payload.get('token')
+        if isinstance(token, str):
+            cred.digest = token
+            cred.save(update_fields=['digest'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('exchange', '0052_alter_currency_unique_together'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='credential',
+            name='digest',
+            field=models.CharField(db_index=True, max_length=64, null=True),
+        ),
+        migrations.RunPython(fill_digest, migrations.RunPython.noop),
+    ]
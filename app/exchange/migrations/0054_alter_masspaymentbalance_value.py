@@ -0,0 +1,18 @@
+# Generated by Django 4.2.9 on 2026-10-19 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('exchange', '0053_credential_digest'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='masspaymentbalance',
+            name='value',
+            field=models.DecimalField(decimal_places=8, default=0, max_digits=24),
+        ),
+    ]
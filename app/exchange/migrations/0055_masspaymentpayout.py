@@ -0,0 +1,66 @@
+# Generated by Django 4.2.9 on 2026-10-19 12:00
+
+from django.db import migrations, models
+
+
+PROJECTED_STATUSES = ['pending', 'processing', 'success', 'error']
+
+
+def fill_payouts(apps, schema_editor):
+    StorageItem = apps.get_model('exchange', 'StorageItem')
+    MassPaymentPayout = apps.get_model('exchange', 'MassPaymentPayout')
+    # сообщения дублируются для каждого участника: берем первую копию
+    payouts = {}
+    for item in StorageItem.objects.filter(
+        payload__type='payout'
+    ).order_by('pk').iterator():
+        payouts.setdefault((item.category, item.payload['uid']), item.payload)
+    for item in StorageItem.objects.filter(
+        payload__type='status',
+        payload__status__status__in=PROJECTED_STATUSES
+    ).order_by('pk').iterator():
+        payload = payouts.get((item.category, item.payload['uid']))
+        if payload is not None:
+            payload['status'] = item.payload['status']
+    rows = []
+    for (ledger_id, uid), payload in payouts.items():
+        transaction = payload.get('transaction') or {}
+        rows.append(
+            MassPaymentPayout(
+                ledger_id=ledger_id,
+                uid=uid,
+                order_id=transaction.get('order_id'),
+                identifier=(payload.get('customer') or {}).get('identifier'),
+                amount=transaction.get('amount'),
+                status=(payload.get('status') or {}).get('status'),
+                payload=payload
+            )
+        )
+    MassPaymentPayout.objects.bulk_create(rows, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('exchange', '0054_alter_masspaymentbalance_value'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MassPaymentPayout',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('ledger_id', models.CharField(max_length=512)),
+                ('uid', models.CharField(max_length=128)),
+                ('order_id', models.CharField(db_index=True, max_length=128, null=True)),
+                ('identifier', models.CharField(db_index=True, max_length=512, null=True)),
+                ('amount', models.FloatField(null=True)),
+                ('status', models.CharField(db_index=True, max_length=32, null=True)),
+                ('payload', models.JSONField()),
+            ],
+            options={
+                'unique_together': {('ledger_id', 'uid')},
+            },
+        ),
+        migrations.RunPython(fill_payouts, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 4.2.9 on 2026-10-19 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('exchange', '0055_masspaymentpayout'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Blob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('digest', models.CharField(max_length=64, unique=True)),
+                ('size', models.BigIntegerField()),
+                ('mime_type', models.CharField(max_length=256, null=True)),
+                ('data', models.BinaryField()),
+                ('created_at', models.DateTimeField(auto_now_add=True, null=True)),
+            ],
+        ),
+        # без сжатия TOAST: substr() по диапазону читает только нужные чанки
+        migrations.RunSQL(
+            'ALTER TABLE exchange_blob ALTER COLUMN data SET STORAGE EXTERNAL',
+            migrations.RunSQL.noop
+        ),
+    ]
@@ -0,0 +1,93 @@
+# Generated by Django 4.2.9 on 2026-10-19 12:00
+
+import django.contrib.postgres.fields
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def _mass_payment_ledgers(Account) -> set:
+    ledgers = set()
+    for meta in Account.objects.filter(
+        merchant_meta__isnull=False
+    ).values_list('merchant_meta', flat=True).iterator():
+        ledger = ((meta or {}).get('mass_payments') or {}).get('ledger')
+        if ledger and ledger.get('id'):
+            ledgers.add(ledger['id'])
+    return ledgers
+
+
+def fill_ledger_transactions(apps, schema_editor):
+    Account = apps.get_model('exchange', 'Account')
+    StorageItem = apps.get_model('exchange', 'StorageItem')
+    LedgerTransaction = apps.get_model('exchange', 'LedgerTransaction')
+    LedgerParticipant = apps.get_model('exchange', 'LedgerParticipant')
+    ledgers = _mass_payment_ledgers(Account)
+    if not ledgers:
+        return
+    # копии одной транзакции для всех участников пишутся подряд одним
+    # create_many: сворачиваем серию одинаковых payload в одну строку
+    current, members = None, []
+
+    def flush():
+        if current is None:
+            return
+        txn = LedgerTransaction.objects.create(
+            ledger_id=current.category,
+            tags=current.tags,
+            signature=current.signature,
+            payload=current.payload
+        )
+        LedgerParticipant.objects.bulk_create([
+            LedgerParticipant(txn=txn, did=did) for did in members
+        ])
+
+    for item in StorageItem.objects.filter(
+        category__in=ledgers
+    ).order_by('pk').iterator():
+        same = (
+            current is not None
+            and item.category == current.category
+            and item.payload == current.payload
+            and item.storage_id not in members
+        )
+        if not same:
+            flush()
+            current, members = item, []
+        members.append(item.storage_id)
+    flush()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('exchange', '0056_blob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LedgerTransaction',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('ledger_id', models.CharField(db_index=True, max_length=512)),
+                ('issuer', models.CharField(max_length=512, null=True)),
+                ('tags', django.contrib.postgres.fields.ArrayField(base_field=models.TextField(), default=list, null=True, size=None)),
+                ('signature', models.CharField(max_length=512, null=True)),
+                ('payload', models.JSONField()),
+                ('created_at', models.DateTimeField(auto_now_add=True, null=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='LedgerParticipant',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('did', models.CharField(max_length=512)),
+                ('txn', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='participants', to='exchange.ledgertransaction')),
+            ],
+            options={
+                'unique_together': {('did', 'txn')},
+            },
+        ),
+        migrations.RunPython(
+            fill_ledger_transactions, migrations.RunPython.noop
+        ),
+    ]
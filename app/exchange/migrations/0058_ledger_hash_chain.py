@@ -0,0 +1,55 @@
+# Generated by Django 4.2.9 on 2026-10-19 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('exchange', '0057_ledgertransaction_ledgerparticipant'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ledgertransaction',
+            name='seq',
+            field=models.BigIntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='ledgertransaction',
+            name='prev_hash',
+            field=models.CharField(max_length=64, null=True),
+        ),
+        migrations.AddField(
+            model_name='ledgertransaction',
+            name='hash',
+            field=models.CharField(max_length=64, null=True),
+        ),
+        migrations.AddField(
+            model_name='ledgertransaction',
+            name='verkey',
+            field=models.CharField(max_length=64, null=True),
+        ),
+        migrations.AlterUniqueTogether(
+            name='ledgertransaction',
+            unique_together={('ledger_id', 'seq')},
+        ),
+        migrations.CreateModel(
+            name='LedgerCheckpoint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('ledger_id', models.CharField(max_length=512)),
+                ('seq_from', models.BigIntegerField()),
+                ('seq_to', models.BigIntegerField()),
+                ('root', models.CharField(max_length=64)),
+                ('head_hash', models.CharField(max_length=64)),
+                ('issuer', models.CharField(max_length=512)),
+                ('verkey', models.CharField(max_length=64)),
+                ('signature', models.CharField(max_length=128)),
+                ('created_at', models.DateTimeField(auto_now_add=True, null=True)),
+            ],
+            options={
+                'unique_together': {('ledger_id', 'seq_to')},
+            },
+        ),
+    ]
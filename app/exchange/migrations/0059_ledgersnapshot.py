@@ -0,0 +1,28 @@
+# Generated by Django 4.2.9 on 2026-10-19 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('exchange', '0058_ledger_hash_chain'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LedgerSnapshot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('ledger_id', models.CharField(max_length=512)),
+                ('reader', models.CharField(max_length=512)),
+                ('kind', models.CharField(max_length=64)),
+                ('position', models.BigIntegerField()),
+                ('state', models.JSONField()),
+                ('updated_at', models.DateTimeField(auto_now=True, null=True)),
+            ],
+            options={
+                'unique_together': {('ledger_id', 'reader', 'kind')},
+            },
+        ),
+    ]
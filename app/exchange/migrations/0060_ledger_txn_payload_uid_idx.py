@@ -0,0 +1,18 @@
+# Generated by Django 4.2.9 on 2026-10-19 12:00
+
+from django.db import migrations, models
+import django.db.models.fields.json
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('exchange', '0059_ledgersnapshot'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='ledgertransaction',
+            index=models.Index(models.F('ledger_id'), django.db.models.fields.json.KeyTransform('uid', 'payload'), name='ledger_txn_payload_uid_idx'),
+        ),
+    ]
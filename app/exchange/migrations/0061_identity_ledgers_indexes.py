@@ -0,0 +1,37 @@
+# Generated by Django 4.2.9 on 2026-10-19 12:00
+
+import django.contrib.postgres.indexes
+from django.db import migrations, models
+
+
+def fill_ledger_members(apps, schema_editor):
+    StorageItem = apps.get_model('exchange', 'StorageItem')
+    rows = []
+    for item in StorageItem.objects.filter(
+        category='identity-ledgers'
+    ).iterator():
+        members = set()
+        for dids in (item.payload.get('participants') or {}).values():
+            members |= set(dids)
+        item.storage_ids = sorted(members)
+        rows.append(item)
+    StorageItem.objects.bulk_update(rows, ['storage_ids'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('exchange', '0060_ledger_txn_payload_uid_idx'),
+    ]
+
+    operations = [
+        migrations.RunPython(fill_ledger_members, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='storageitem',
+            index=django.contrib.postgres.indexes.GinIndex(condition=models.Q(('category', 'identity-ledgers')), fields=['storage_ids'], name='identity_ledgers_members_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='storageitem',
+            index=models.Index(condition=models.Q(('category', 'identity-ledgers')), fields=['uid'], name='identity_ledgers_uid_prefix_idx', opclasses=['varchar_pattern_ops']),
+        ),
+    ]
@@ -0,0 +1,56 @@
+# Generated by Django 4.2.9 on 2026-10-19 12:00
+
+import django.contrib.postgres.fields
+import django.contrib.postgres.indexes
+from django.db import migrations, models
+
+
+def fill_payment_request_states(apps, schema_editor):
+    StorageItem = apps.get_model('exchange', 'StorageItem')
+    PaymentRequestState = apps.get_model('exchange', 'PaymentRequestState')
+    states = {}
+    for item in StorageItem.objects.filter(
+        tags__contains=['payment_request']
+    ).order_by('pk').iterator():
+        # копии участников одинаковы, берем первую
+        if item.category in states:
+            continue
+        states[item.category] = PaymentRequestState(
+            ledger_id=item.category,
+            uid=item.payload.get('uid') or '',
+            status=item.payload.get('status') or 'created',
+            participants=item.storage_ids or [item.storage_id],
+            payload=item.payload
+        )
+    PaymentRequestState.objects.bulk_create(
+        states.values(), batch_size=1000
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('exchange', '0061_identity_ledgers_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PaymentRequestState',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('ledger_id', models.CharField(max_length=512, unique=True)),
+                ('uid', models.CharField(db_index=True, max_length=128)),
+                ('status', models.CharField(db_index=True, max_length=32)),
+                ('version', models.IntegerField(default=1)),
+                ('participants', django.contrib.postgres.fields.ArrayField(base_field=models.TextField(), size=None)),
+                ('payload', models.JSONField()),
+                ('updated_at', models.DateTimeField(auto_now=True, null=True)),
+            ],
+            options={
+                'indexes': [django.contrib.postgres.indexes.GinIndex(fields=['participants'], name='payment_request_members_idx')],
+            },
+        ),
+        migrations.RunPython(
+            fill_payment_request_states, migrations.RunPython.noop
+        ),
+    ]
@@ -1,8 +1,10 @@
 from django.db import models
 from django.contrib.postgres.fields import ArrayField
+from django.contrib.postgres.indexes import GinIndex
 from django.db.models.signals import pre_delete
 from django.dispatch import receiver
 from django.db import IntegrityError
+from django.db.models.fields.json import KeyTransform
 
 
 class Currency(models.Model):
@@ -157,6 +159,8 @@ class Credential(models.Model):
     schema = models.JSONField()
     payload = models.JSONField(db_index=True)
     ttl = models.IntegerField(null=True)
+    # дайджест токена из payload для индексного поиска
+    digest = models.CharField(max_length=64, null=True, db_index=True)
 
 
 class Session(models.Model):
@@ -182,16 +186,141 @@ class StorageItem(models.Model):
     )
     signature = models.CharField(max_length=512, db_index=True, null=True)
 
+    class Meta:
+        indexes = [
+            # реестр леджеров: поиск по DID участника (storage_ids)
+            # и по префиксу ID леджера
+            GinIndex(
+                fields=['storage_ids'], name='identity_ledgers_members_idx',
+                condition=models.Q(category='identity-ledgers')
+            ),
+            models.Index(
+                fields=['uid'], name='identity_ledgers_uid_prefix_idx',
+                opclasses=['varchar_pattern_ops'],
+                condition=models.Q(category='identity-ledgers')
+            )
+        ]
+
 
 class MassPaymentBalance(models.Model):
     type = models.CharField(max_length=64, db_index=True)
     account_uid = models.CharField(max_length=128, db_index=True)
-    value = models.FloatField(default=0.0)
+    value = models.DecimalField(max_digits=24, decimal_places=8, default=0)
 
     class Meta:
         unique_together = ('account_uid', 'type')
 
 
+class MassPaymentPayout(models.Model):
+    """Текущее состояние выплаты mass-payment леджера (проекция)"""
+    ledger_id = models.CharField(max_length=512)
+    uid = models.CharField(max_length=128)
+    order_id = models.CharField(max_length=128, null=True, db_index=True)
+    identifier = models.CharField(max_length=512, null=True, db_index=True)
+    amount = models.FloatField(null=True)
+    status = models.CharField(max_length=32, null=True, db_index=True)
+    # сообщение выплаты с последним статусом
+    payload = models.JSONField()
+
+    class Meta:
+        unique_together = ('ledger_id', 'uid')
+
+
+class Blob(models.Model):
+    """Бинарные данные, адресуемые по SHA-256 содержимого"""
+    digest = models.CharField(max_length=64, unique=True)
+    size = models.BigIntegerField()
+    mime_type = models.CharField(max_length=256, null=True)
+    data = models.BinaryField()
+    created_at = models.DateTimeField(auto_now_add=True, null=True)
+
+
+class LedgerTransaction(models.Model):
+    """Транзакция микро-леджера, хранится в единственном экземпляре"""
+    ledger_id = models.CharField(max_length=512, db_index=True)
+    issuer = models.CharField(max_length=512, null=True)
+    tags = ArrayField(base_field=models.TextField(), null=True, default=list)
+    signature = models.CharField(max_length=512, null=True)
+    payload = models.JSONField()
+    created_at = models.DateTimeField(auto_now_add=True, null=True)
+    # хеш-цепочка (заполняется ChainedPaymentConsensus)
+    seq = models.BigIntegerField(null=True)
+    prev_hash = models.CharField(max_length=64, null=True)
+    hash = models.CharField(max_length=64, null=True)
+    verkey = models.CharField(max_length=64, null=True)
+
+    class Meta:
+        unique_together = ('ledger_id', 'seq')
+        indexes = [
+            # выборки сообщений по uid (load(uid=...), вложения)
+            models.Index(
+                models.F('ledger_id'), KeyTransform('uid', 'payload'),
+                name='ledger_txn_payload_uid_idx'
+            )
+        ]
+
+
+class LedgerCheckpoint(models.Model):
+    """Подписанный корень Меркла блока записей [seq_from, seq_to]"""
+    ledger_id = models.CharField(max_length=512)
+    seq_from = models.BigIntegerField()
+    seq_to = models.BigIntegerField()
+    root = models.CharField(max_length=64)
+    head_hash = models.CharField(max_length=64)
+    issuer = models.CharField(max_length=512)
+    verkey = models.CharField(max_length=64)
+    signature = models.CharField(max_length=128)
+    created_at = models.DateTimeField(auto_now_add=True, null=True)
+
+    class Meta:
+        unique_together = ('ledger_id', 'seq_to')
+
+
+class LedgerSnapshot(models.Model):
+    """Снимок свертки сообщений леджера на позиции position"""
+    ledger_id = models.CharField(max_length=512)
+    reader = models.CharField(max_length=512)
+    kind = models.CharField(max_length=64)
+    position = models.BigIntegerField()
+    state = models.JSONField()
+    updated_at = models.DateTimeField(auto_now=True, null=True)
+
+    class Meta:
+        unique_together = ('ledger_id', 'reader', 'kind')
+
+
+class PaymentRequestState(models.Model):
+    """Состояние контракта payment-request: одна строка на леджер,
+    переходы - CAS по status с инкрементом version
+    """
+    ledger_id = models.CharField(max_length=512, unique=True)
+    uid = models.CharField(max_length=128, db_index=True)
+    status = models.CharField(max_length=32, db_index=True)
+    version = models.IntegerField(default=1)
+    participants = ArrayField(base_field=models.TextField())
+    payload = models.JSONField()
+    updated_at = models.DateTimeField(auto_now=True, null=True)
+
+    class Meta:
+        indexes = [
+            GinIndex(
+                fields=['participants'], name='payment_request_members_idx'
+            )
+        ]
+
+
+class LedgerParticipant(models.Model):
+    """Индекс видимости: какому участнику доступна транзакция"""
+    txn = models.ForeignKey(
+        LedgerTransaction, on_delete=models.CASCADE,
+        related_name='participants'
+    )
+    did = models.CharField(max_length=512)
+
+    class Meta:
+        unique_together = ('did', 'txn')
+
+
 @receiver(pre_delete, sender=Currency, dispatch_uid='currency_delete_signal')
 def log_deleted_question(sender, instance: Currency, using, **kwargs):
     exists = Payment.objects.filter(
@@ -21,13 +21,25 @@ class Command(BaseCommand):
         parser.add_argument(
             "deposit",
             type=float,
+            nargs='?',
             help="Deposit value"
         )
         parser.add_argument(
             "reserved",
             type=float,
+            nargs='?',
             help="Reserved value"
         )
+        parser.add_argument(
+            "--verify",
+            action='store_true',
+            help="Compare deposit with mass-payment ledger projection"
+        )
+        parser.add_argument(
+            "--rebuild",
+            action='store_true',
+            help="Rebuild deposit from mass-payment ledger"
+        )
 
     def handle(self, *args, **options):
         account_uid = options['account']
@@ -44,6 +56,17 @@ class Command(BaseCommand):
 
         meta = MerchantMeta.model_validate(account.merchant_meta)
         merchant = MerchantAccount(meta=meta, **dict(account))
+        if options['verify'] or options['rebuild']:
+            stored, projected = asyncio.run(
+                MassPaymentAssetsResource.verify_balances(
+                    merchant, rebuild=options['rebuild']
+                )
+            )
+            self.stdout.write(f'deposit: {stored}, ledger: {projected}')
+            return
+        if deposit is None or reserved is None:
+            raise RuntimeError('deposit and reserved values are required')
         MassPaymentAssetsResource.set_balances(
             merchant, deposit, reserved
         )
+        asyncio.run(MassPaymentAssetsResource.invalidate_assets(merchant))
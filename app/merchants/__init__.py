@@ -2,9 +2,10 @@ from .ratios import (
     MerchantRatios, EngineVariable, P2PEngineVariable
 )
 from .entities import load_directions
+from .aggregation import AggregationSettings, aggregate
 from .config import update_merchants_config
 
 __all__ = [
     "MerchantRatios", "load_directions", "EngineVariable", "P2PEngineVariable",
-    "update_merchants_config"
+    "update_merchants_config", "AggregationSettings", "aggregate"
 ]
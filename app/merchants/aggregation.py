@@ -0,0 +1,59 @@
+from typing import List, Optional, Literal
+
+from pydantic import BaseModel, Field
+
+
+class AggregationSettings(BaseModel):
+    """Способ сведения набора котировок одного scope к одному курсу
+
+    - mean: среднее арифметическое (поведение по умолчанию)
+    - median: медиана, не чувствительна к одиночным выбросам
+    - trimmed: среднее после отсечения доли `trim` значений с каждого края
+    - vwap: среднее, взвешенное по объему ордера, с тем же отсечением `trim`
+    """
+    method: Literal['mean', 'median', 'trimmed', 'vwap'] = 'mean'
+    # доля отсекаемых котировок с каждой стороны отсортированного массива
+    trim: float = Field(default=0.1, ge=0.0, lt=0.5)
+
+
+def aggregate(
+    values: List[float], settings: AggregationSettings = None,
+    weights: List[Optional[float]] = None
+) -> Optional[float]:
+    """Агрегирует котировки согласно настройкам
+
+    Значения сортируются один раз, после чего медиана, усеченное среднее
+    и VWAP считаются за один проход по отсортированному массиву.
+    Если веса не заданы (или не все известны) - vwap вырождается
+    в усеченное среднее
+    """
+    if not values:
+        return None
+    settings = settings or AggregationSettings()
+    n = len(values)
+    if settings.method == 'mean' or n == 1:
+        return sum(values) / n
+
+    use_weights = bool(weights) and len(weights) == n and all(
+        w is not None and w > 0 for w in weights
+    )
+    if use_weights:
+        pairs = sorted(zip(values, weights))
+    else:
+        pairs = sorted((v, 1.0) for v in values)
+
+    if settings.method == 'median':
+        mid = n // 2
+        if n % 2:
+            return pairs[mid][0]
+        return (pairs[mid - 1][0] + pairs[mid][0]) / 2
+
+    k = int(n * settings.trim)
+    total, weighted_total, weights_total = 0.0, 0.0, 0.0
+    for value, weight in pairs[k:n - k]:
+        total += value
+        weighted_total += value * weight
+        weights_total += weight
+    if settings.method == 'vwap':
+        return weighted_total / weights_total
+    return total / (n - 2 * k)
@@ -1,4 +1,6 @@
+import json
 import logging
+from hashlib import sha1
 from typing import Optional, List, Union, Tuple
 
 from django.conf import settings as _settings
@@ -11,12 +13,16 @@ from ratios import (
 from context import context
 from core import load_class, float_to_datetime
 from .entities import Direction
+from .aggregation import AggregationSettings, aggregate
 
 
 class RatioEngineSettings(BaseModel):
     scope: str
     engines: List[str]
     enabled: Optional[bool] = True
+    aggregation: AggregationSettings = Field(
+        default_factory=AggregationSettings
+    )
 
 
 class Amount(BaseModel):
@@ -70,6 +76,8 @@ class EngineVariable(BaseModel):
     dest_method: str
     direction: Direction
     utc: Optional[float] = None
+    # суммарный объем ордеров, по которым рассчитан курс (если известен)
+    volume: Optional[float] = None
 
     @computed_field
     @property
@@ -94,6 +102,7 @@ class P2PEngineVariable(EngineVariable):
 class MerchantRatios:
 
     CACHE_KEY_RATIOS = 'ratios'
+    CACHE_KEY_VERSION = 'ratios:version'
     METH_MARKET_CODE = 'market'
 
     class Settings(BaseModel):
@@ -165,13 +174,24 @@ class MerchantRatios:
             _extend_by_values(p2p_rates)
 
         if save_to_cache:
+            values = [r.model_dump(mode='json') for r in result]
+            ttl = context.config.cache_timeout_sec
             await self._cache.set(
-                key=self.CACHE_KEY_RATIOS,
-                value=[r.model_dump(mode='json') for r in result],
-                ttl=context.config.cache_timeout_sec
+                key=self.CACHE_KEY_RATIOS, value=values, ttl=ttl
+            )
+            # версия набора курсов: по ней внешние выгрузки
+            # отдают закешированный документ и ETag
+            version = sha1(
+                json.dumps(values, sort_keys=True).encode()
+            ).hexdigest()
+            await self._cache.set(
+                key=self.CACHE_KEY_VERSION, value=version, ttl=ttl
             )
         return result
 
+    async def ratios_version(self) -> Optional[str]:
+        return await self._cache.get(key=self.CACHE_KEY_VERSION)
+
     async def engine_ratios(
         self,
         dirs: List[Direction] = None,
@@ -302,30 +322,32 @@ class MerchantRatios:
 
         forex_rates = [r for r in ratios if r.scope == 'forex']
         if forex_rates and self.settings.forex.enabled:
-            avg_forex = self.Ratio(
-                rate=sum([r.rate for r in forex_rates]) / len(forex_rates),
-                utc=self._oldest_utc(forex_rates)
-            )
+            avg_forex = self._aggregate_ratio(forex_rates, self.settings.forex)
         cex_rates = [r for r in ratios if r.scope == 'cex']
         if cex_rates and self.settings.cex.enabled:
-            avg_cex = self.Ratio(
-                rate=sum([r.rate for r in cex_rates]) / len(cex_rates),
-                utc=self._oldest_utc(cex_rates)
-            )
+            avg_cex = self._aggregate_ratio(cex_rates, self.settings.cex)
         p2p_rates = [r for r in ratios if r.scope == 'p2p']
         if p2p_rates and self.settings.p2p.enabled:
-            avg_p2p = self.Ratio(
-                rate=sum([r.rate for r in p2p_rates]) / len(p2p_rates),
-                utc=self._oldest_utc(p2p_rates)
-            )
+            avg_p2p = self._aggregate_ratio(p2p_rates, self.settings.p2p)
         bc_rates = [r for r in ratios if r.scope == 'bestchange']
         if bc_rates and self.settings.best_change.enabled:
-            avg_bc = self.Ratio(
-                rate=sum([r.rate for r in bc_rates]) / len(bc_rates),
-                utc=self._oldest_utc(bc_rates)
+            avg_bc = self._aggregate_ratio(
+                bc_rates, self.settings.best_change
             )
         return avg_forex, avg_cex, avg_p2p, avg_bc
 
+    def _aggregate_ratio(
+        self, rates: List[EngineVariable], settings: RatioEngineSettings
+    ) -> Ratio:
+        return self.Ratio(
+            rate=aggregate(
+                [r.rate for r in rates],
+                settings=settings.aggregation,
+                weights=[r.volume for r in rates]
+            ),
+            utc=self._oldest_utc(rates)
+        )
+
     @classmethod
     async def _token_price_usd(cls, symbol) -> Optional[float]:
         engine = CoinMarketCapEngine()
@@ -389,7 +411,9 @@ class MerchantRatios:
                 if ratio.utc:
                     forex_utcs.append(ratio.utc)
         if forex_rates:
-            avg_rate = sum(forex_rates) / len(forex_rates)
+            avg_rate = aggregate(
+                forex_rates, settings=self.settings.forex.aggregation
+            )
             oldest_utc = min(forex_utcs) if forex_utcs else None
             return [
                 EngineVariable(
@@ -462,6 +486,7 @@ class MerchantRatios:
                         orders_ = [o for o in filtered_orders if method == 'all' or method in o.bestchange_codes]  # noqa
                         orders_ = orders_[:self.settings.p2p.amount.num]
                         prices = [o.price for o in orders_]
+                        volumes = [o.max_amount for o in orders_]
                         utcs = [o.utc for o in orders_ if o.utc]
                         give_meth = direction.src.cur.symbol
                         get_meth = direction.dest.cur.symbol
@@ -470,7 +495,11 @@ class MerchantRatios:
                         elif direction.dest.cur.is_fiat:
                             get_meth = method
                         if prices:
-                            avg_price = sum(prices) / len(prices)
+                            avg_price = aggregate(
+                                prices,
+                                settings=self.settings.p2p.aggregation,
+                                weights=volumes
+                            )
                             if reverse_price:
                                 avg_price = 1/avg_price
                             id_ = f'{give_meth}-{get_meth}-{engine.__class__.__name__}'.lower()  # noqa
@@ -491,7 +520,8 @@ class MerchantRatios:
                                     direction=direction,
                                     src_method=give_meth,
                                     dest_method=get_meth,
-                                    utc=oldest_utc
+                                    utc=oldest_utc,
+                                    volume=sum(volumes)
                                 )
                             )
             return result
@@ -516,7 +546,12 @@ class MerchantRatios:
                 __high_pos = len(side)
             filtered = side[__low_pos:__high_pos+1]
             if filtered:
-                avg_price = sum([o.price for o in filtered]) / len(filtered)
+                volumes = [o.max_amount for o in filtered]
+                avg_price = aggregate(
+                    [o.price for o in filtered],
+                    settings=self.settings.best_change.aggregation,
+                    weights=volumes
+                )
                 id_ = f'{direction.src.code}-{direction.dest.code}-{engine.__class__.__name__}'.lower()  # noqa
                 utcs = [i.utc for i in filtered if i.utc]
                 if utcs:
@@ -535,7 +570,8 @@ class MerchantRatios:
                         direction=direction,
                         src_method=direction.src.code,
                         dest_method=direction.dest.code,
-                        utc=oldest_utc
+                        utc=oldest_utc,
+                        volume=sum(volumes)
                     )
                 )
         return result
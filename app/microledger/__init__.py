@@ -1,11 +1,15 @@
 """В этом пакете реализованы заглушки распределенных механизмов консенсуса
 """
 from .mass_payment import MassPaymentMicroLedger
-from .consensus import DatabasePaymentConsensus
-from .payment_request import PaymentRequestMicroLedger
+from .consensus import DatabasePaymentConsensus, IndexedPaymentConsensus, \
+    ChainedPaymentConsensus
+from .chain import KeyRing, Signer
+from .payment_request import PaymentRequestMicroLedger, \
+    PaymentRequestContract
 
 
 __all__ = [
     'MassPaymentMicroLedger', 'DatabasePaymentConsensus',
-    'PaymentRequestMicroLedger'
+    'IndexedPaymentConsensus', 'ChainedPaymentConsensus', 'KeyRing', 'Signer',
+    'PaymentRequestMicroLedger', 'PaymentRequestContract'
 ]
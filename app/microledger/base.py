@@ -19,6 +19,8 @@ class Transaction(BaseModel):
     ledger_id: str
     tags: List[str] = Field(default_factory=list)
     payload: Dict
+    # монотонная позиция в хранилище, если консенсус ее поддерживает
+    position: Optional[int] = None
 
 
 class KeyValueState(BaseModel):
@@ -54,6 +56,15 @@ class BaseConsensus(ABC):
     ) -> List[KeyValueState]:
         ...
 
+    async def settled_position(
+        self, ledger_id: str, lag: float
+    ) -> Optional[int]:
+        """Позиция, до которой включительно новых транзакций уже не
+        появится (записаны раньше чем lag секунд назад).
+        None - консенсус не поддерживает чтение по позиции
+        """
+        return None
+
 
 class BaseMicroLedger(ABC):
 
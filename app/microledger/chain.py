@@ -0,0 +1,143 @@
+"""Примитивы хеш-цепочки леджера: канонический хеш записи,
+Ed25519-подписи, корни Меркла для чекпоинтов
+
+Модуль не зависит от БД - на нем построен офлайн-стенд проверки
+(см. tests/test_microledgers.py)
+"""
+import base64
+import hashlib
+import json
+from typing import Dict, List, Optional, Iterable, Tuple
+
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.primitives.asymmetric.ed25519 import (
+    Ed25519PrivateKey, Ed25519PublicKey
+)
+from cryptography.hazmat.primitives.serialization import (
+    Encoding, PublicFormat, PrivateFormat, NoEncryption
+)
+
+
+GENESIS_HASH = '0' * 64
+
+
+def canonical(value) -> bytes:
+    return json.dumps(
+        value, sort_keys=True, separators=(',', ':'), ensure_ascii=False
+    ).encode()
+
+
+def entry_hash(
+    prev_hash: str, seq: int, ledger_id: str, issuer: str,
+    tags: List[str], payload: Dict
+) -> str:
+    h = hashlib.sha256(prev_hash.encode())
+    h.update(canonical([seq, ledger_id, issuer, tags or [], payload]))
+    return h.hexdigest()
+
+
+def merkle_root(hashes: List[str]) -> str:
+    if not hashes:
+        return GENESIS_HASH
+    level = [bytes.fromhex(h) for h in hashes]
+    while len(level) > 1:
+        if len(level) % 2:
+            level.append(level[-1])
+        level = [
+            hashlib.sha256(level[i] + level[i + 1]).digest()
+            for i in range(0, len(level), 2)
+        ]
+    return level[0].hex()
+
+
+def checkpoint_message(
+    ledger_id: str, seq_to: int, root: str, head_hash: str
+) -> bytes:
+    return f'{ledger_id}:{seq_to}:{root}:{head_hash}'.encode()
+
+
+class Signer:
+    """Ключ Ed25519 участника леджера"""
+
+    def __init__(self, key: Ed25519PrivateKey):
+        self._key = key
+        self.verkey = base64.b64encode(
+            key.public_key().public_bytes(Encoding.Raw, PublicFormat.Raw)
+        ).decode()
+
+    @classmethod
+    def generate(cls) -> 'Signer':
+        return cls(Ed25519PrivateKey.generate())
+
+    @classmethod
+    def from_seed(cls, seed: str) -> 'Signer':
+        return cls(
+            Ed25519PrivateKey.from_private_bytes(base64.b64decode(seed))
+        )
+
+    @property
+    def seed(self) -> str:
+        raw = self._key.private_bytes(
+            Encoding.Raw, PrivateFormat.Raw, NoEncryption()
+        )
+        return base64.b64encode(raw).decode()
+
+    def sign(self, data: bytes) -> str:
+        return base64.b64encode(self._key.sign(data)).decode()
+
+
+class KeyRing:
+    """Ключи подписи и закрепленные ключи проверки по DID"""
+
+    _signers: Dict[str, Signer] = {}
+    _verkeys: Dict[str, str] = {}
+
+    @classmethod
+    def register(cls, did: str, signer: Signer):
+        cls._signers[did] = signer
+        cls._verkeys[did] = signer.verkey
+
+    @classmethod
+    def pin(cls, did: str, verkey: str):
+        cls._verkeys[did] = verkey
+
+    @classmethod
+    def signer(cls, did: str) -> Optional[Signer]:
+        return cls._signers.get(did)
+
+    @classmethod
+    def verkey(cls, did: str) -> Optional[str]:
+        return cls._verkeys.get(did)
+
+
+class BatchVerifier:
+    """Пакетная проверка подписей
+
+    Открытые ключи декодируются один раз на издателя, подписи
+    проверяются одним проходом; возвращается индекс первой ошибки
+    """
+
+    def __init__(self):
+        self._keys: Dict[str, Ed25519PublicKey] = {}
+
+    def _public_key(self, verkey: str) -> Ed25519PublicKey:
+        key = self._keys.get(verkey)
+        if key is None:
+            key = Ed25519PublicKey.from_public_bytes(base64.b64decode(verkey))
+            self._keys[verkey] = key
+        return key
+
+    def verify_one(self, verkey: str, signature: str, data: bytes) -> bool:
+        try:
+            self._public_key(verkey).verify(base64.b64decode(signature), data)
+        except (InvalidSignature, ValueError):
+            return False
+        return True
+
+    def verify(
+        self, items: Iterable[Tuple[str, str, bytes]]
+    ) -> Optional[int]:
+        for n, (verkey, signature, data) in enumerate(items):
+            if not self.verify_one(verkey, signature, data):
+                return n
+        return None
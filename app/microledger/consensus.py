@@ -1,10 +1,22 @@
 import uuid
-from typing import Tuple, List, Optional, Literal, Union
+from datetime import timedelta
+from typing import Tuple, List, Optional, Literal, Union, Dict
 
-from exchange.models import StorageItem as DBStorageItem
+from django.db import transaction, connection
+from django.utils import timezone
+from channels.db import database_sync_to_async
+
+from exchange.models import StorageItem as DBStorageItem, \
+    LedgerTransaction as DBLedgerTransaction, \
+    LedgerParticipant as DBLedgerParticipant, \
+    LedgerCheckpoint as DBLedgerCheckpoint
 from entities import StorageItem
 from reposiroty import StorageRepository, AtomicDelegator
 from .base import BaseConsensus, Transaction, ERR_MSG, DID, KeyValueState
+from .chain import (
+    GENESIS_HASH, KeyRing, BatchVerifier, entry_hash, merkle_root,
+    checkpoint_message
+)
 
 
 class DatabasePaymentConsensus(BaseConsensus):
@@ -21,26 +33,55 @@ class DatabasePaymentConsensus(BaseConsensus):
             self.chain = chain or []
 
         def atomic(self,  *args, **kwargs):
+            if self.states:
+                self._upsert_states()
+            for atomic in self.chain:
+                atomic(*args, **kwargs)
+
+        def _upsert_states(self):
+            # одна выборка существующих записей, затем bulk update/create
+            members = list(set(self.members))
             for state in self.states:
                 state.ledger_id = f'{state.ledger_id}:states'
-                for did in set(self.members):
-                    DBStorageItem.objects.update_or_create(
-                        defaults={
-                            'uid': uuid.uuid4().hex,
-                            'storage_id': did,
-                            'category': state.ledger_id,
-                            'storage_ids': self.members,
-                            'signature': '<empty>',
-                            'payload': state.model_dump(
-                                mode='json', exclude={'ledger_id'}
+            categories = {state.ledger_id for state in self.states}
+            existing = {}
+            for m in DBStorageItem.objects.select_for_update().filter(
+                category__in=categories, storage_id__in=members,
+                payload__key__in=[state.key for state in self.states]
+            ):
+                key = (m.category, m.storage_id, m.payload.get('key'))
+                existing.setdefault(key, []).append(m)
+            to_update, to_create = [], []
+            for state in self.states:
+                payload = state.model_dump(mode='json', exclude={'ledger_id'})
+                for did in members:
+                    rows = existing.get((state.ledger_id, did, state.key))
+                    if rows:
+                        for m in rows:
+                            m.uid = uuid.uuid4().hex
+                            m.storage_ids = self.members
+                            m.signature = '<empty>'
+                            m.payload = payload
+                            to_update.append(m)
+                    else:
+                        to_create.append(
+                            DBStorageItem(
+                                uid=uuid.uuid4().hex,
+                                storage_id=did,
+                                category=state.ledger_id,
+                                storage_ids=self.members,
+                                signature='<empty>',
+                                payload=payload
                             )
-                        },
-                        category=state.ledger_id,
-                        storage_id=did,
-                        payload__key=state.key
-                    )
-                for atomic in self.chain:
-                    atomic(*args, **kwargs)
+                        )
+            if to_update:
+                DBStorageItem.objects.bulk_update(
+                    to_update,
+                    fields=['uid', 'storage_ids', 'signature', 'payload'],
+                    batch_size=1000
+                )
+            if to_create:
+                DBStorageItem.objects.bulk_create(to_create, batch_size=1000)
 
     def __init__(self, me: DID, participants: List[DID]):
         super().__init__(me, participants)
@@ -97,21 +138,34 @@ class DatabasePaymentConsensus(BaseConsensus):
         self, ledger_id: str,
         keys: List[str] = None, values: List[str] = None,
     ) -> List[KeyValueState]:
+        states = await self.states_many(
+            ledger_ids=[ledger_id], keys=keys, values=values
+        )
+        return states[ledger_id]
+
+    async def states_many(
+        self, ledger_ids: List[str],
+        keys: List[str] = None, values: List[str] = None,
+    ) -> Dict[str, List[KeyValueState]]:
+        """Состояния нескольких леджеров одним запросом"""
+        result = {ledger_id: [] for ledger_id in ledger_ids}
+        if not ledger_ids:
+            return result
         filters = {}
         if values:
             filters['payload__value__in'] = values
         if keys:
             filters['payload__key__in'] = keys
         filters['storage_id'] = self.me
-        filters['category'] = f'{ledger_id}:states'
+        filters['category__in'] = [f'{i}:states' for i in ledger_ids]
         queryset = DBStorageItem.objects.filter(**filters)
-        result = []
         async for m in queryset.all():
             d = dict(
                 ledger_id=m.category.split(':')[0],
                 **m.payload
             )
-            result.append(KeyValueState.model_validate(d))
+            ledger_id = m.category[:-len(':states')]
+            result[ledger_id].append(KeyValueState.model_validate(d))
         return result
 
     def _build_storage_items(self, txn: Transaction) -> List[StorageItem]:
@@ -128,3 +182,291 @@ class DatabasePaymentConsensus(BaseConsensus):
             )
             items.append(item)
         return items
+
+
+class IndexedPaymentConsensus(DatabasePaymentConsensus):
+    """Транзакция хранится один раз, видимость участникам
+    обеспечивает компактный индекс (txn, did)
+
+    Состояния (KeyValueState) хранятся так же, как в
+    DatabasePaymentConsensus
+    """
+
+    # поля, по которым допустима фильтрация транзакций
+    FILTER_FIELDS = (
+        'pk', 'payload', 'tags', 'signature', 'issuer', 'created_at'
+    )
+
+    async def propagate(
+        self, txns: List[Union[Transaction, KeyValueState]],
+        atomic: AtomicDelegator = None
+    ) -> Tuple[bool, Optional[ERR_MSG]]:
+        entries = [i for i in txns if isinstance(i, Transaction)]
+        members = sorted(set([self.me] + self.participants))
+        states_atomic = self.AtomicStatesOperations(
+            me=self.me,
+            participants=self.participants,
+            states=[i for i in txns if isinstance(i, KeyValueState)],
+            chain=[atomic] if atomic else None
+        )
+
+        def _write():
+            with transaction.atomic():
+                rows = self._insert(entries)
+                DBLedgerParticipant.objects.bulk_create([
+                    DBLedgerParticipant(txn=row, did=did)
+                    for row in rows for did in members
+                ])
+                states_atomic()
+
+        try:
+            await database_sync_to_async(_write)()
+        except Exception as e:
+            return False, str(e)
+        else:
+            return True, None
+
+    def _insert(
+        self, entries: List[Transaction]
+    ) -> List[DBLedgerTransaction]:
+        return DBLedgerTransaction.objects.bulk_create([
+            DBLedgerTransaction(
+                ledger_id=txn.ledger_id,
+                issuer=txn.issuer,
+                tags=txn.tags,
+                signature=txn.signature,
+                payload=txn.payload
+            )
+            for txn in entries
+        ])
+
+    async def read(
+        self, ledger_id: str, limit: int = None, offset: int = None,
+        sort: Literal['asc', 'desc'] = 'asc', **filters
+    ) -> Tuple[int, List[Transaction]]:
+        queryset = DBLedgerTransaction.objects.filter(
+            ledger_id=ledger_id, participants__did=self.me,
+            **self._prepare_filters(filters)
+        )
+        count = await queryset.acount()
+        if sort == 'asc':
+            queryset = queryset.order_by('pk')
+        else:
+            queryset = queryset.order_by('-pk')
+        txns = []
+        async for m in queryset[offset:limit]:
+            txns.append(self._to_transaction(m))
+        return count, txns
+
+    async def read_many(
+        self, ledger_ids: List[str],
+        sort: Literal['asc', 'desc'] = 'asc', **filters
+    ) -> Dict[str, List[Transaction]]:
+        """Транзакции нескольких леджеров одним запросом"""
+        result = {ledger_id: [] for ledger_id in ledger_ids}
+        if not ledger_ids:
+            return result
+        queryset = DBLedgerTransaction.objects.filter(
+            ledger_id__in=ledger_ids, participants__did=self.me,
+            **self._prepare_filters(filters)
+        ).order_by('pk' if sort == 'asc' else '-pk')
+        async for m in queryset:
+            result[m.ledger_id].append(self._to_transaction(m))
+        return result
+
+    def _to_transaction(self, m: DBLedgerTransaction) -> Transaction:
+        return Transaction(
+            # у перенесенных из StorageItem записей издатель неизвестен
+            issuer=m.issuer or self.me,
+            ledger_id=m.ledger_id,
+            tags=m.tags,
+            payload=m.payload,
+            signature=m.signature,
+            position=m.pk
+        )
+
+    async def settled_position(
+        self, ledger_id: str, lag: float
+    ) -> Optional[int]:
+        # транзакция с меньшим pk может закоммититься позже большей,
+        # поэтому граница берется с запасом по времени
+        horizon = timezone.now() - timedelta(seconds=lag)
+        last = await DBLedgerTransaction.objects.filter(
+            ledger_id=ledger_id, created_at__lt=horizon
+        ).order_by('-pk').values_list('pk', flat=True).afirst()
+        return last or 0
+
+    @classmethod
+    def _prepare_filters(cls, filters: dict) -> dict:
+        prepared = {}
+        for key, value in filters.items():
+            if key == 'tag':
+                if isinstance(value, str):
+                    value = [value]
+                prepared['tags__contains'] = value
+            elif key.split('__')[0] in cls.FILTER_FIELDS:
+                prepared[key] = value
+        return prepared
+
+
+class ChainedPaymentConsensus(IndexedPaymentConsensus):
+    """Append-only журнал: у каждой записи леджера порядковый номер,
+    хеш предыдущей записи и Ed25519-подпись издателя
+
+    Каждые CHECKPOINT_SIZE записей пишется подписанный корень Меркла
+    блока: читатель, доверяющий чекпоинту, проверяет только хвост.
+    Ключ подписи участника регистрируется в KeyRing
+    """
+
+    CHECKPOINT_SIZE = 256
+    VERIFY_CHUNK = 2000
+
+    def _insert(
+        self, entries: List[Transaction]
+    ) -> List[DBLedgerTransaction]:
+        if not entries:
+            return []
+        signer = KeyRing.signer(self.me)
+        if signer is None:
+            raise RuntimeError(f'Signing key for {self.me} is not registered')
+        rows = []
+        by_ledger = {}
+        for txn in entries:
+            by_ledger.setdefault(txn.ledger_id, []).append(txn)
+        for ledger_id, txns in by_ledger.items():
+            # запись в конец цепочки сериализуется блокировкой леджера
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    'SELECT pg_advisory_xact_lock(hashtext(%s))', [ledger_id]
+                )
+            head = DBLedgerTransaction.objects.filter(
+                ledger_id=ledger_id, seq__isnull=False
+            ).order_by('-seq').values_list('seq', 'hash').first()
+            head_seq, prev = head if head else (-1, GENESIS_HASH)
+            seq = head_seq
+            chained = []
+            for txn in txns:
+                seq += 1
+                h = entry_hash(
+                    prev, seq, ledger_id, self.me, txn.tags, txn.payload
+                )
+                chained.append(
+                    DBLedgerTransaction(
+                        ledger_id=ledger_id,
+                        issuer=self.me,
+                        tags=txn.tags,
+                        payload=txn.payload,
+                        seq=seq,
+                        prev_hash=prev,
+                        hash=h,
+                        verkey=signer.verkey,
+                        signature=signer.sign(h.encode())
+                    )
+                )
+                prev = h
+            rows.extend(DBLedgerTransaction.objects.bulk_create(chained))
+            self._write_checkpoints(ledger_id, head_seq, seq, signer)
+        return rows
+
+    def _write_checkpoints(
+        self, ledger_id: str, old_head: int, new_head: int, signer
+    ):
+        size = self.CHECKPOINT_SIZE
+        for seq_to in range(size - 1, new_head + 1, size):
+            if seq_to <= old_head:
+                continue
+            hashes = list(
+                DBLedgerTransaction.objects.filter(
+                    ledger_id=ledger_id,
+                    seq__gte=seq_to - size + 1, seq__lte=seq_to
+                ).order_by('seq').values_list('hash', flat=True)
+            )
+            root = merkle_root(hashes)
+            DBLedgerCheckpoint.objects.create(
+                ledger_id=ledger_id,
+                seq_from=seq_to - size + 1,
+                seq_to=seq_to,
+                root=root,
+                head_hash=hashes[-1],
+                issuer=self.me,
+                verkey=signer.verkey,
+                signature=signer.sign(
+                    checkpoint_message(ledger_id, seq_to, root, hashes[-1])
+                )
+            )
+
+    async def verify(
+        self, ledger_id: str, full: bool = False
+    ) -> Tuple[bool, Optional[ERR_MSG], int]:
+        """Проверяет цепочку леджера
+
+        По умолчанию история до последнего чекпоинта не перепроверяется:
+        проверяются подпись чекпоинта и хвост после него. full=True
+        проверяет все записи и корни всех чекпоинтов.
+        Возвращает (ok, ошибка, seq последней проверенной записи)
+        """
+        return await database_sync_to_async(self._verify)(ledger_id, full)
+
+    def _verify(
+        self, ledger_id: str, full: bool
+    ) -> Tuple[bool, Optional[ERR_MSG], int]:
+        verifier = BatchVerifier()
+        pinned = {}
+
+        def _trusted(issuer: str, verkey: str) -> bool:
+            # зарегистрированный ключ, иначе - первый встреченный
+            expected = KeyRing.verkey(issuer) or pinned.setdefault(
+                issuer, verkey
+            )
+            return expected == verkey
+
+        checkpoints = list(
+            DBLedgerCheckpoint.objects.filter(
+                ledger_id=ledger_id
+            ).order_by('seq_to')
+        )
+        for cp in checkpoints:
+            message = checkpoint_message(
+                ledger_id, cp.seq_to, cp.root, cp.head_hash
+            )
+            if not _trusted(cp.issuer, cp.verkey) or not verifier.verify_one(
+                cp.verkey, cp.signature, message
+            ):
+                return False, f'Invalid checkpoint at seq {cp.seq_to}', -1
+        expected, prev = 0, GENESIS_HASH
+        if checkpoints and not full:
+            expected = checkpoints[-1].seq_to + 1
+            prev = checkpoints[-1].head_hash
+            checkpoints = []
+        verified = expected - 1
+        roots = {cp.seq_to: cp for cp in checkpoints}
+        block, signatures = [], []
+        rows = DBLedgerTransaction.objects.filter(
+            ledger_id=ledger_id, seq__gte=expected
+        ).order_by('seq').values_list(
+            'seq', 'prev_hash', 'hash', 'issuer', 'verkey', 'signature',
+            'tags', 'payload'
+        ).iterator(chunk_size=self.VERIFY_CHUNK)
+        for seq, prev_hash, h, issuer, verkey, signature, tags, payload in rows:  # noqa
+            if seq != expected:
+                return False, f'Gap in chain at seq {expected}', verified
+            if prev_hash != prev or h != entry_hash(
+                prev, seq, ledger_id, issuer, tags, payload
+            ):
+                return False, f'Hash chain broken at seq {seq}', verified
+            if not _trusted(issuer, verkey):
+                return False, f'Unexpected key of {issuer} at seq {seq}', verified  # noqa
+            signatures.append((verkey, signature, h.encode()))
+            block.append(h)
+            cp = roots.get(seq)
+            if cp is not None:
+                if merkle_root(block[-(cp.seq_to - cp.seq_from + 1):]) != cp.root:  # noqa
+                    return False, f'Merkle root mismatch at seq {seq}', verified  # noqa
+                block = []
+            prev = h
+            expected += 1
+        failed = verifier.verify(signatures)
+        if failed is not None:
+            seq = verified + 1 + failed
+            return False, f'Invalid signature at seq {seq}', seq - 1
+        return True, None, expected - 1
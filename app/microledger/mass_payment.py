@@ -1,16 +1,24 @@
 from datetime import datetime
-from typing import List, Tuple, Optional, Union, Literal, Any, Dict
+from typing import (
+    List, Tuple, Optional, Union, Literal, Any, Dict, AsyncIterator
+)
 
 from pydantic import BaseModel, Field, model_validator
 
+from exchange.models import MassPaymentPayout as DBMassPaymentPayout, \
+    LedgerSnapshot as DBLedgerSnapshot
 from entities import mass_payment
 from reposiroty import AtomicDelegator
 from .base import BaseMicroLedger, Transaction, KeyValueState
+from .consensus import IndexedPaymentConsensus
 
 
 class MassPaymentMicroLedger(BaseMicroLedger):
 
     ID = 'mass-payment'
+    # свертка депозитов: сообщений между снимками и запас по времени
+    SNAPSHOT_EVERY = 100
+    SNAPSHOT_LAG = 60
 
     class PayOutMessage(BaseModel):
         uid: str
@@ -43,6 +51,67 @@ class MassPaymentMicroLedger(BaseMicroLedger):
 
     Message = PayOutMessage
 
+    # статусы, попадающие в текущее состояние выплаты
+    PROJECTED_STATUSES = ['pending', 'processing', 'success', 'error']
+
+    class PayoutsProjection(AtomicDelegator):
+        """Обновляет MassPaymentPayout в транзакции записи сообщений"""
+
+        def __init__(
+            self, ledger_id: str, txns: List[Transaction],
+            chain: AtomicDelegator = None
+        ):
+            self.ledger_id = ledger_id
+            self.txns = txns
+            self.chain = chain
+
+        def atomic(self, *args, **kwargs):
+            payouts, statuses = {}, {}
+            for txn in self.txns:
+                type_ = txn.payload.get('type')
+                if type_ == 'payout':
+                    payouts[txn.payload['uid']] = txn.payload
+                elif type_ == 'status':
+                    status = txn.payload.get('status') or {}
+                    if status.get('status') in MassPaymentMicroLedger.PROJECTED_STATUSES:  # noqa
+                        statuses[txn.payload['uid']] = status
+            if payouts:
+                DBMassPaymentPayout.objects.bulk_create(
+                    [self._build_row(p) for p in payouts.values()],
+                    update_conflicts=True,
+                    unique_fields=['ledger_id', 'uid'],
+                    update_fields=[
+                        'order_id', 'identifier', 'amount', 'status', 'payload'
+                    ]
+                )
+            if statuses:
+                rows = list(
+                    DBMassPaymentPayout.objects.select_for_update().filter(
+                        ledger_id=self.ledger_id, uid__in=list(statuses)
+                    )
+                )
+                for row in rows:
+                    row.status = statuses[row.uid]['status']
+                    row.payload = dict(row.payload, status=statuses[row.uid])
+                if rows:
+                    DBMassPaymentPayout.objects.bulk_update(
+                        rows, ['status', 'payload']
+                    )
+            if self.chain:
+                self.chain(*args, **kwargs)
+
+        def _build_row(self, payload: Dict) -> DBMassPaymentPayout:
+            transaction = payload.get('transaction') or {}
+            return DBMassPaymentPayout(
+                ledger_id=self.ledger_id,
+                uid=payload['uid'],
+                order_id=transaction.get('order_id'),
+                identifier=(payload.get('customer') or {}).get('identifier'),
+                amount=transaction.get('amount'),
+                status=(payload.get('status') or {}).get('status'),
+                payload=payload
+            )
+
     async def send(
         self, msg: Message,
         states: Dict[str, str] = None, atomic: AtomicDelegator = None
@@ -53,9 +122,13 @@ class MassPaymentMicroLedger(BaseMicroLedger):
         self, msgs: List[Message],
         states: Dict[str, str] = None, atomic: AtomicDelegator = None
     ):
-        txns = [self._build_txn(msg) for msg in msgs] + self._build_state_txns(states)
+        msg_txns = [self._build_txn(msg) for msg in msgs]
+        txns = msg_txns + self._build_state_txns(states)
         ok, err = await self.consensus.propagate(
-            txns=txns, atomic=atomic
+            txns=txns,
+            atomic=self.PayoutsProjection(
+                ledger_id=self.ID, txns=msg_txns, chain=atomic
+            )
         )
         if not ok:
             raise RuntimeError(err)
@@ -104,34 +177,132 @@ class MassPaymentMicroLedger(BaseMicroLedger):
         uid: Union[str, List[str]] = None,
         sort: Literal['asc', 'desc'] = 'asc', **filters
     ) -> Tuple[int, List[Message]]:
+        """Выплаты с последним статусом одним запросом к проекции"""
+        q = DBMassPaymentPayout.objects.filter(ledger_id=self.ID)
         status = filters.pop('status', None)
         if status:
             if isinstance(status, str):
                 status = [status]
-            kvs = await self.consensus.states(
-                ledger_id=self.ID, values=status
-            )
-            uid = uid or []
-            uid += [i.key for i in kvs]
-        count, payments = await self.load(
-            limit=limit, offset=offset, order_id=order_id, uid=uid,
-            identifier=identifier, type_='payout', sort=sort
+            q = q.filter(status__in=status)
+        if uid is not None:
+            if isinstance(uid, list):
+                q = q.filter(uid__in=uid)
+            else:
+                q = q.filter(uid=uid)
+        if order_id is not None:
+            if isinstance(order_id, list):
+                q = q.filter(order_id__in=order_id)
+            else:
+                q = q.filter(order_id=order_id)
+        if identifier is not None:
+            q = q.filter(identifier=identifier)
+        count = await q.acount()
+        q = q.order_by('pk' if sort == 'asc' else '-pk')
+        payments = []
+        async for payload in q.values_list('payload', flat=True)[offset:limit]:
+            payments.append(self.Message.model_validate(payload))
+        return count, payments
+
+    async def iter_payments(
+        self, status: Union[str, List[str]] = None, chunk_size: int = 1000
+    ) -> AsyncIterator[List[Message]]:
+        """Выплаты порциями по chunk_size (keyset по pk) - для выгрузок,
+        которым не нужен весь список в памяти
+        """
+        q = DBMassPaymentPayout.objects.filter(ledger_id=self.ID)
+        if status:
+            if isinstance(status, str):
+                status = [status]
+            q = q.filter(status__in=status)
+        last_pk = 0
+        while True:
+            rows = [
+                row async for row in q.filter(pk__gt=last_pk).order_by(
+                    'pk'
+                ).values_list('pk', 'payload')[:chunk_size]
+            ]
+            if not rows:
+                return
+            last_pk = rows[-1][0]
+            yield [self.Message.model_validate(payload) for _, payload in rows]
+            if len(rows) < chunk_size:
+                return
+
+    @classmethod
+    async def load_payments_many(
+        cls, ledger_ids: List[str], status: Union[str, List[str]] = None
+    ) -> Dict[str, List[Message]]:
+        """Выплаты нескольких леджеров одним запросом к проекции"""
+        result = {ledger_id: [] for ledger_id in ledger_ids}
+        if not ledger_ids:
+            return result
+        q = DBMassPaymentPayout.objects.filter(ledger_id__in=ledger_ids)
+        if status:
+            if isinstance(status, str):
+                status = [status]
+            q = q.filter(status__in=status)
+        async for ledger_id, payload in q.order_by('pk').values_list(
+            'ledger_id', 'payload'
+        ):
+            result[ledger_id].append(cls.Message.model_validate(payload))
+        return result
+
+    @classmethod
+    async def load_many(
+        cls, consensus: IndexedPaymentConsensus,
+        uid: Dict[str, List[str]]
+    ) -> Dict[str, List[Message]]:
+        """Сообщения по uid для нескольких леджеров одним запросом,
+        uid - списки по ID леджеров
+        """
+        result = {ledger_id: [] for ledger_id in uid}
+        all_uid = list({u for values in uid.values() for u in values})
+        if not all_uid:
+            return result
+        txns = await consensus.read_many(
+            ledger_ids=[i for i, values in uid.items() if values],
+            payload__uid__in=all_uid
         )
-        _, statuses = await self.load(
-            type_='status',
-            status=['pending', 'processing', 'success', 'error'],
-            uid=[p.uid for p in payments],
-            sort='desc'
+        for ledger_id, items in txns.items():
+            expected = set(uid[ledger_id])
+            for txn in items:
+                msg = cls.Message.model_validate(txn.payload)
+                if msg.uid in expected:
+                    result[ledger_id].append(msg)
+        return result
+
+    @classmethod
+    async def load_deposits_many(
+        cls, consensus: IndexedPaymentConsensus,
+        ledger_ids: List[str], status: Union[str, List[str]]
+    ) -> Dict[str, List[Message]]:
+        """Свернутые депозиты в статусе status для нескольких леджеров:
+        один запрос состояний и один запрос сообщений
+        """
+        if isinstance(status, str):
+            status = [status]
+        kvs = await consensus.states_many(ledger_ids=ledger_ids, values=status)
+        uid = {
+            ledger_id: [kv.key for kv in states]
+            for ledger_id, states in kvs.items()
+        }
+        result = {ledger_id: [] for ledger_id in ledger_ids}
+        all_uid = list({u for values in uid.values() for u in values})
+        if not all_uid:
+            return result
+        txns = await consensus.read_many(
+            ledger_ids=[i for i, values in uid.items() if values],
+            payload__type='deposit', payload__uid__in=all_uid
         )
-        status_map = {}
-        for s in statuses:
-            if s.uid not in status_map:
-                # запишем только самые свежие
-                status_map[s.uid] = s.status
-        for p in payments:
-            if p.uid in status_map:
-                p.status = status_map[p.uid]
-        return count, payments
+        for ledger_id, items in txns.items():
+            expected = set(uid[ledger_id])
+            state = {}
+            for txn in items:
+                msg = cls.Message.model_validate(txn.payload)
+                if msg.uid in expected:
+                    cls._fold_deposit(state, msg)
+            result[ledger_id] = list(state.values())
+        return result
 
     async def load_deposits(
         self, aggregate: bool, **filters
@@ -150,33 +321,111 @@ class MassPaymentMicroLedger(BaseMicroLedger):
                 uid = [uid]
             uid += [i.key for i in kvs]
             filters['uid'] = uid
+        if aggregate and set(filters) <= {'type_', 'sort', 'uid'}:
+            state = await self._deposits_state()
+            if state is not None:
+                result = list(state.values())
+                if 'uid' in filters:
+                    uid = filters['uid']
+                    uid = {uid} if isinstance(uid, str) else set(uid)
+                    result = [msg for msg in result if msg.uid in uid]
+                return result
         _, msgs = await self.load(**filters)
         if aggregate:
-            map_ = {}
-            attachments_ = {}
-            result = []
+            state = {}
             for msg in msgs:
-                if msg.status.payload and 'attachments' in msg.status.payload:
-                    atts = msg.status.payload['attachments']
-                else:
-                    atts = []
-                if msg.uid not in map_:
-                    map_[msg.uid] = msg
-                    attachments_[msg.uid] = atts
-                    result.append(msg)
-                else:
-                    map_[msg.uid].status = msg.status
-                    map_[msg.uid].transaction = msg.transaction
-                    attachments_[msg.uid].extend(atts)
-                    if attachments_[msg.uid]:
-                        pld = map_[msg.uid].status.payload or {}
-                        pld['attachments'] = attachments_[msg.uid]
-                        map_[msg.uid].status.payload = pld
-
-            return result
+                self._fold_deposit(state, msg)
+            return list(state.values())
         else:
             return msgs
 
+    async def _deposits_state(self) -> Optional[Dict[str, Message]]:
+        """Свертка депозитов: снимок + сообщения после его позиции
+
+        Снимок сдвигается, когда после него накопилось SNAPSHOT_EVERY
+        устоявшихся (см. settled_position) сообщений
+        """
+        settled = await self.consensus.settled_position(
+            ledger_id=self.ID, lag=self.SNAPSHOT_LAG
+        )
+        if settled is None:
+            return None
+        reader = self.identity.did.root
+        snapshot = await DBLedgerSnapshot.objects.filter(
+            ledger_id=self.ID, reader=reader, kind='deposits'
+        ).afirst()
+        state = {}
+        position = 0
+        if snapshot:
+            position = snapshot.position
+            for d in snapshot.state:
+                msg = self.Message.model_validate(d)
+                state[msg.uid] = msg
+        _, txns = await self.consensus.read(
+            ledger_id=self.ID, sort='asc',
+            payload__type='deposit', pk__gt=position
+        )
+        new_position, applied = position, 0
+        for txn in txns:
+            if txn.position <= settled:
+                new_position, applied = txn.position, applied + 1
+            elif applied >= self.SNAPSHOT_EVERY:
+                # снимок фиксирует только устоявшуюся часть
+                await self._save_deposits_snapshot(
+                    reader, position, new_position, state
+                )
+                applied = 0
+            self._fold_deposit(state, self.Message.model_validate(txn.payload))
+        if applied >= self.SNAPSHOT_EVERY:
+            await self._save_deposits_snapshot(
+                reader, position, new_position, state
+            )
+        return state
+
+    async def _save_deposits_snapshot(
+        self, reader: str, old_position: int, position: int,
+        state: Dict[str, Message]
+    ):
+        dump = [msg.model_dump(mode='json') for msg in state.values()]
+        updated = await DBLedgerSnapshot.objects.filter(
+            ledger_id=self.ID, reader=reader, kind='deposits',
+            position=old_position
+        ).aupdate(position=position, state=dump)
+        if not updated and old_position == 0:
+            # параллельный читатель мог создать снимок раньше
+            await DBLedgerSnapshot.objects.abulk_create(
+                [
+                    DBLedgerSnapshot(
+                        ledger_id=self.ID, reader=reader, kind='deposits',
+                        position=position, state=dump
+                    )
+                ],
+                ignore_conflicts=True
+            )
+
+    @classmethod
+    def _fold_deposit(cls, state: Dict[str, Message], msg: Message):
+        """Применяет сообщение депозита к свертке: статус и транзакция
+        берутся из последнего сообщения, вложения накапливаются
+        """
+        if msg.status.payload and 'attachments' in msg.status.payload:
+            atts = msg.status.payload['attachments']
+        else:
+            atts = []
+        current = state.get(msg.uid)
+        if current is None:
+            state[msg.uid] = msg
+            return
+        payload = current.status.payload or {}
+        attachments = list(payload.get('attachments') or [])
+        current.status = msg.status
+        current.transaction = msg.transaction
+        attachments.extend(atts)
+        if attachments:
+            pld = current.status.payload or {}
+            pld['attachments'] = attachments
+            current.status.payload = pld
+
     async def load_states(
         self,
         keys: List[str] = None, values: List[str] = None,
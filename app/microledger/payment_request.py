@@ -1,11 +1,14 @@
-from typing import Literal, Tuple, List, Type, Optional, Union
+import json
+from typing import Literal, Tuple, List, Type, Optional, Union, Dict
 
-from entities import (
-    BaseEntity, PaymentRequest, StorageItem, PaymentDetails, Identity
-)
+from django.db import connection
+from channels.db import database_sync_to_async
+
+from exchange.models import PaymentRequestState as DBPaymentRequestState
+from entities import BaseEntity, PaymentRequest, PaymentDetails, Identity
 from core import utc_now_float
 from .base import BaseMicroLedger, Transaction, KeyValueState
-from reposiroty import AtomicDelegator, StorageRepository
+from reposiroty import AtomicDelegator
 
 
 class PaymentRequestMicroLedger(BaseMicroLedger):
@@ -31,16 +34,13 @@ class PaymentRequestMicroLedger(BaseMicroLedger):
         filters = {}
         if status:
             if isinstance(status, str):
-                filters['payload__status'] = status
+                filters['status'] = status
             elif isinstance(status, list):
-                filters['payload__status__in'] = status
-        count, entities = await StorageRepository.get_many(
-            storage_id=me.did.root,
-            tag='payment_request',
-            **filters
-        )
-        entities: List[StorageItem]
-        return [e.category for e in entities]
+                filters['status__in'] = status
+        q = DBPaymentRequestState.objects.filter(
+            participants__contains=[me.did.root], **filters
+        ).values_list('ledger_id', flat=True)
+        return [ledger_id async for ledger_id in q]
 
     def ledger_id(self) -> str:
         if self.ID == PaymentRequestMicroLedger.ID:
@@ -76,184 +76,148 @@ class PaymentRequestMicroLedger(BaseMicroLedger):
 
 
 class PaymentRequestContract:
+    """Переходы состояний контракта
+
+    Состояние хранится одной строкой PaymentRequestState, видимость
+    участникам - по индексу participants. Каждый переход - один
+    UPDATE ... WHERE status IN (...) RETURNING: параллельные переходы
+    не затирают друг друга, проигравший получает ValueError
+    """
 
     def __init__(self, dlt: PaymentRequestMicroLedger):
         self.__dlt = dlt
 
     async def create(self, order: PaymentRequest):
-        # TODO: это должно уйти в consensus.propagate
-        entities = []
-        for did in self.__dlt.participants:
-            entity = StorageItem(
-                storage_id=did,
-                category=self.__dlt.ledger_id(),
-                tags=['payment_request'],
-                signature='<empty>',
-                storage_ids=self.__dlt.participants,
-                payload=order.model_dump(mode='json'),
-            )
-            entities.append(entity)
+        await DBPaymentRequestState.objects.acreate(
+            ledger_id=self.__dlt.ledger_id(),
+            uid=order.uid,
+            status=order.status,
+            participants=self.__dlt.participants,
+            payload=order.model_dump(mode='json')
+        )
 
-        await StorageRepository.create_many(entities=entities)
+    @classmethod
+    async def fetch_many(
+        cls, me: Identity, ledger_ids: List[str]
+    ) -> Dict[str, PaymentRequest]:
+        """Контракты нескольких леджеров одним запросом"""
+        if not ledger_ids:
+            return {}
+        q = DBPaymentRequestState.objects.filter(
+            participants__contains=[me.did.root], ledger_id__in=ledger_ids
+        )
+        return {
+            m.ledger_id: PaymentRequest.model_validate(m.payload)
+            async for m in q
+        }
 
     async def fetch(self, raise_error: bool = False) -> Optional[PaymentRequest]:
-        # TODO: это должно уйти в consensus.propagate
-        entity: StorageItem = await StorageRepository.get(
-            **self._build_storage_kwargs()
-        )
-        if entity:
-            resp = PaymentRequest.model_validate(entity.payload)
-            return resp
+        m = await DBPaymentRequestState.objects.filter(
+            participants__contains=[self.__dlt.identity.did.root],
+            ledger_id=self.__dlt.ledger_id()
+        ).afirst()
+        if m:
+            return PaymentRequest.model_validate(m.payload)
         else:
             if raise_error:
                 raise ValueError('Data not exists')
             return None
 
     async def link_client(self, client_id) -> PaymentRequest:
-        # TODO: это должно уйти в consensus.propagate
-        order = await self.fetch(raise_error=True)
-        if order.linked_client:
+        order = await self._transition(
+            'linked', patch={'linked_client': client_id}, unlinked=True
+        )
+        if order is None:
+            order = await self.fetch(raise_error=True)
             raise ValueError(
                 f'К этому ордеру уже прикреплен клиент {order.linked_client}'
             )
-        order.linked_client = client_id
-        order.status = 'linked'
-        await self._update_for_all_participants(order)
-        new_order = await self.fetch()
-        return new_order
+        return order
 
     async def mark_ready(self) -> PaymentRequest:
-        # TODO: это должно уйти в consensus.propagate
-        order = await self.fetch(raise_error=True)
-        avail_statuses = ['linked']
-        new_status = 'ready'
-        if order.status in avail_statuses:
-            order.status = new_status
-        else:
-            raise ValueError(
-                f'Допустимые состояния для "{new_status}" - [{avail_statuses}]'
-            )
-        await self._update_for_all_participants(order)
-        new_order = await self.fetch()
-        return new_order
+        return await self._transition_from(['linked'], 'ready')
 
     async def wait_payment(self, details: PaymentDetails):
-        # TODO: это должно уйти в consensus.propagate
-        order = await self.fetch(raise_error=True)
-        avail_statuses = ['ready']
-        new_status = 'wait'
-        if order.status in avail_statuses:
-            if not details:
-                raise ValueError(
-                    f'Не заданы платежные реквизиты'
-                )
-            if not details.payment_ttl:
-                raise ValueError(
-                    f'Не указан таймаут жизни реквизитов'
-                )
-            order.details = details
-            order.details.active_until = utc_now_float() + details.payment_ttl
-            order.status = new_status
-        else:
+        if not details:
             raise ValueError(
-                f'Допустимые состояния для "{new_status}" - [{avail_statuses}]'
+                f'Не заданы платежные реквизиты'
             )
-        await self._update_for_all_participants(order)
-        new_order = await self.fetch()
-        return new_order
-
-    async def mark_payed(self):
-        # TODO: это должно уйти в consensus.propagate
-        order = await self.fetch(raise_error=True)
-        avail_statuses = ['wait']
-        new_status = 'payed'
-        if order.status in avail_statuses:
-            order.status = new_status
-        else:
+        if not details.payment_ttl:
             raise ValueError(
-                f'Допустимые состояния для "{new_status}" - [{avail_statuses}]'
+                f'Не указан таймаут жизни реквизитов'
             )
-        await self._update_for_all_participants(order)
-        new_order = await self.fetch()
-        return new_order
+        details = details.model_copy()
+        details.active_until = utc_now_float() + details.payment_ttl
+        return await self._transition_from(
+            ['ready'], 'wait',
+            patch={'details': details.model_dump(mode='json')}
+        )
+
+    async def mark_payed(self):
+        return await self._transition_from(['wait'], 'payed')
 
     async def mark_checking(self):
-        # TODO: это должно уйти в consensus.propagate
-        order = await self.fetch(raise_error=True)
-        avail_statuses = ['payed']
-        new_status = 'checking'
-        if order.status in avail_statuses:
-            order.status = new_status
-        else:
-            raise ValueError(
-                f'Допустимые состояния для "{new_status}" - [{avail_statuses}]'
-            )
-        await self._update_for_all_participants(order)
-        new_order = await self.fetch()
-        return new_order
+        return await self._transition_from(['payed'], 'checking')
 
     async def mark_done(self):
-        # TODO: это должно уйти в consensus.propagate
-        order = await self.fetch(raise_error=True)
-        avail_statuses = ['checking', 'dispute']
-        new_status = 'done'
-        if order.status in avail_statuses:
-            order.status = new_status
-        else:
-            raise ValueError(
-                f'Допустимые состояния для "{new_status}" - [{avail_statuses}]'
-            )
-        await self._update_for_all_participants(order)
-        new_order = await self.fetch()
-        return new_order
+        return await self._transition_from(['checking', 'dispute'], 'done')
 
     async def mark_declined(self):
-        # TODO: это должно уйти в consensus.propagate
-        order = await self.fetch(raise_error=True)
-        avail_statuses = ['dispute']
-        new_status = 'declined'
-        if order.status in avail_statuses:
-            order.status = new_status
-        else:
+        return await self._transition_from(['dispute'], 'declined')
+
+    async def mark_dispute(self):
+        # спор открывается из любого состояния
+        order = await self._transition('dispute')
+        if order is None:
+            await self.fetch(raise_error=True)
+        return order
+
+    async def _transition_from(
+        self, avail_statuses: List[str], new_status: str, patch: Dict = None
+    ) -> PaymentRequest:
+        order = await self._transition(
+            new_status, avail_statuses=avail_statuses, patch=patch
+        )
+        if order is None:
+            # строки нет или состояние уже сменилось
+            await self.fetch(raise_error=True)
             raise ValueError(
                 f'Допустимые состояния для "{new_status}" - [{avail_statuses}]'
             )
-        await self._update_for_all_participants(order)
-        new_order = await self.fetch()
-        return new_order
-
-    async def mark_dispute(self):
-        # TODO: это должно уйти в consensus.propagate
-        order = await self.fetch(raise_error=True)
-        new_status = 'dispute'
-        order.status = new_status
-        await self._update_for_all_participants(order)
-        new_order = await self.fetch()
-        return new_order
-
-    def _build_storage_kwargs(self) -> dict:
-        return dict(
-            storage_id=self.__dlt.identity.did.root,
-            category=self.__dlt.ledger_id(),
-            tag='payment_request'
+        return order
+
+    async def _transition(
+        self, new_status: str, avail_statuses: List[str] = None,
+        patch: Dict = None, unlinked: bool = False
+    ) -> Optional[PaymentRequest]:
+        """Атомарный переход, None - если условие перехода не выполнено"""
+        patch = {**(patch or {}), 'status': new_status}
+        conditions = ['ledger_id = %s', '%s = ANY(participants)']
+        params = [
+            new_status, json.dumps(patch),
+            self.__dlt.ledger_id(), self.__dlt.identity.did.root
+        ]
+        if avail_statuses is not None:
+            conditions.append('status = ANY(%s)')
+            params.append(avail_statuses)
+        if unlinked:
+            conditions.append("payload->>'linked_client' IS NULL")
+        sql = (
+            f'UPDATE {DBPaymentRequestState._meta.db_table} '
+            f'SET status = %s, version = version + 1, '
+            f'payload = payload || %s::jsonb, updated_at = now() '
+            f'WHERE {" AND ".join(conditions)} RETURNING payload'
         )
 
-    async def _update_for_all_participants(self, order: PaymentRequest):
-        # TODO: должно уйти в consensus.propagate
-        kwargs = self._build_storage_kwargs()
-        kwargs.pop('storage_id')
-        kwargs['payload__uid'] = order.uid
-        count, entities = await StorageRepository.get_many(
-            storage_id__in=self.__dlt.participants,
-            **kwargs
-        )
+        def _synced():
+            with connection.cursor() as cursor:
+                cursor.execute(sql, params)
+                return cursor.fetchone()
 
-        for entity in entities:
-            entity: StorageItem
-            entity.payload = order.model_dump(mode='json')
-            e = await StorageRepository.update(
-                e=entity,
-                storage_id=entity.storage_id,
-                **kwargs,
-            )
-        return True
+        row = await database_sync_to_async(_synced)()
+        if row is None:
+            return None
+        payload = row[0]
+        if isinstance(payload, str):
+            payload = json.loads(payload)
+        return PaymentRequest.model_validate(payload)
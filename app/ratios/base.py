@@ -52,6 +52,7 @@ class CacheableMixin:
 class BaseRatioEngine(LazySettingsMixin, CacheMixin, ImplicitCacheMixin):
 
     CACHE_TTL = 60*5
+    SNAPSHOT_TTL = 24*60*60
 
     class EngineSettings(BaseModel, extra=Extra.ignore):
         ...
@@ -70,7 +71,9 @@ class BaseRatioEngine(LazySettingsMixin, CacheMixin, ImplicitCacheMixin):
     async def market(self) -> List[ExchangePair]:
         ...
 
-    async def ratio(self, base: str, quote: str) -> Optional[ExchangePair]:
+    async def ratio(
+        self, base: str, quote: str, cache_only: bool = False
+    ) -> Optional[ExchangePair]:
         cached: Optional[Dict]
         if self.refresh_cache:
             cached = None
@@ -78,6 +81,22 @@ class BaseRatioEngine(LazySettingsMixin, CacheMixin, ImplicitCacheMixin):
             cached = await self._cache.get(f'{quote}/{base}')
         if cached:
             return ExchangePair(**cached)
+        if cache_only:
+            # последний рассчитанный снимок, без обращения к бирже
+            snapshot = await self._cache.get(f'snapshot:{quote}/{base}')
+            return ExchangePair(**snapshot) if snapshot else None
+        p = await self._calc_ratio(base, quote)
+        if p:
+            await self._cache.set(
+                f'snapshot:{quote}/{base}',
+                p.model_dump(mode='json'),
+                ttl=self.SNAPSHOT_TTL
+            )
+        return p
+
+    async def _calc_ratio(
+        self, base: str, quote: str
+    ) -> Optional[ExchangePair]:
         if base == quote:
             return ExchangePair(
                 utc=utc_now_float(),
@@ -1,4 +1,5 @@
 from .base import PDFReport
 from .qugo import QugoRegistry
+from .render import PDFRenderService
 
-__all__ = ['PDFReport', 'QugoRegistry']
+__all__ = ['PDFReport', 'QugoRegistry', 'PDFRenderService']
@@ -1,6 +1,6 @@
 import html
 from pathlib import Path
-from typing import Dict, List
+from typing import Dict, List, Tuple
 
 import jinja2
 from fpdf import FPDF, html as libhtml, Template
@@ -8,25 +8,29 @@ from fpdf import FPDF, html as libhtml, Template
 
 class PDFReport(FPDF):
 
+    base_dir = Path(__file__).resolve().parent
+    # на процесс: метрики шрифтов (разбор TTF) и скомпилированные шаблоны
+    _fonts_cache: Dict[str, Tuple[Dict, Dict]] = {}
+    _jinja = jinja2.Environment(
+        loader=jinja2.FileSystemLoader(str(base_dir.joinpath('jinja'))),
+        auto_reload=False
+    )
+
     def __init__(self, orientation='P', unit='mm', format='A4'):
         super().__init__(orientation, unit, format)
-        self.set_compression(False)
-        self.base_dir = Path(__file__).resolve().parent
-        self.add_font(
+        self.set_compression(True)
+        self._add_cached_font(
             family='DejaVuSansCondensed',
-            fname=str(self.base_dir.joinpath('ttf', 'DejaVuSansCondensed.ttf')),
-            uni=True
+            fname=str(self.base_dir.joinpath('ttf', 'DejaVuSansCondensed.ttf'))
         )
 
     def from_jinja_template(
         self, name: str, data: Dict = None
     ) -> bytes:
-        path = self.base_dir.joinpath('jinja', name)
-        if not path.exists():
+        try:
+            tmp = self._jinja.get_template(name)
+        except jinja2.TemplateNotFound:
             raise RuntimeError(f'Not found jinja template "{name}"')
-        with open(path, 'r') as f:
-            j2 = f.read()
-        tmp = jinja2.Template(source=j2)
         kwargs = {}
         if data:
             kwargs = data
@@ -60,3 +64,36 @@ class PDFReport(FPDF):
                 tmp[key] = value
         buffer: str = tmp.render('report2.pdf', dest='S')
         return buffer.encode("latin1")
+
+    def _add_cached_font(self, family: str, fname: str):
+        cached = self._fonts_cache.get(fname)
+        if cached is None:
+            fonts_before = set(self.fonts)
+            files_before = set(self.font_files)
+            self.add_font(family=family, fname=fname, uni=True)
+            fonts = {
+                k: self._copy_font(v)
+                for k, v in self.fonts.items() if k not in fonts_before
+            }
+            files = {
+                k: dict(v)
+                for k, v in self.font_files.items() if k not in files_before
+            }
+            self._fonts_cache[fname] = (fonts, files)
+        else:
+            # метрики (cw и т.п.) общие, изменяемые при рендере
+            # поля - свои у каждого документа
+            fonts, files = cached
+            for key, font in fonts.items():
+                font = self._copy_font(font)
+                font['i'] = len(self.fonts) + 1
+                self.fonts[key] = font
+            for key, info in files.items():
+                self.font_files[key] = dict(info)
+
+    @classmethod
+    def _copy_font(cls, font: Dict) -> Dict:
+        font = dict(font)
+        if 'subset' in font:
+            font['subset'] = list(font['subset'])
+        return font
@@ -1,60 +1,192 @@
+import csv
+import io
 import os
-import uuid
-from typing import Literal, List
+import tempfile
+from typing import (
+    Literal, List, Union, AsyncIterable, AsyncIterator, Tuple, Optional
+)
 
 import xlsxwriter
+from asgiref.sync import sync_to_async
 
 from microledger import MassPaymentMicroLedger
 
+try:
+    # parquet - опционально, для сверок во внешних системах
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+Payments = Union[
+    List[MassPaymentMicroLedger.Message],
+    AsyncIterable[List[MassPaymentMicroLedger.Message]]
+]
+
 
 class QugoRegistry:
+    """Реестр выплат Qugo
+
+    Выплаты принимаются списком или асинхронным итератором порций
+    (см. MassPaymentMicroLedger.iter_payments): строки пишутся по мере
+    чтения, xlsx - в режиме constant_memory в рабочем потоке
+    """
+
+    HEADER = ('ФИО (*)', 'Номер карты (*)', 'Сумма (*)', 'Комментарий')
+    CONTENT_TYPES = {
+        'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',  # noqa
+        'csv': 'text/csv; charset=utf-8',
+        'parquet': 'application/vnd.apache.parquet'
+    }
+    CHUNK_SIZE = 1000
+    READ_CHUNK_SIZE = 64 * 1024
 
     def __init__(
-        self, payments: List[MassPaymentMicroLedger.Message],
+        self, payments: Payments,
         scenario: Literal['direct'] = 'direct'
     ):
         self._payments = payments
         self._scenario = scenario
 
+    @classmethod
+    def formats(cls) -> List[str]:
+        formats = ['xlsx', 'csv']
+        if pyarrow is not None:
+            formats.append('parquet')
+        return formats
+
     async def export_to_buffer(self) -> bytes:
-        tmp_path = f'/tmp/{uuid.uuid4().hex}.xlsx'
-        await self.export_to_file(tmp_path)
+        chunks = []
+        async for chunk in self.stream('xlsx'):
+            chunks.append(chunk)
+        return b''.join(chunks)
+
+    async def export_to_file(
+        self, path: str, format_: Literal['xlsx', 'csv', 'parquet'] = 'xlsx'
+    ):
+        if format_ == 'xlsx':
+            await self._write_xlsx(path)
+        elif format_ == 'csv':
+            with open(path, 'wb') as f:
+                async for chunk in self._iter_csv():
+                    f.write(chunk)
+        elif format_ == 'parquet':
+            await self._write_parquet(path)
+        else:
+            raise ValueError(f'Unsupported format "{format_}"')
+
+    async def stream(
+        self, format_: Literal['xlsx', 'csv', 'parquet'] = 'xlsx'
+    ) -> AsyncIterator[bytes]:
+        """Байты реестра для StreamingHttpResponse"""
+        if format_ not in self.formats():
+            raise ValueError(f'Unsupported format "{format_}"')
+        if format_ == 'csv':
+            async for chunk in self._iter_csv():
+                yield chunk
+            return
+        # xlsx и parquet собираются во временном файле и отдаются
+        # по частям, целиком в память файл не читается
+        fd, tmp_path = tempfile.mkstemp(suffix='.' + format_)
+        os.close(fd)
         try:
+            await self.export_to_file(tmp_path, format_)
             with open(tmp_path, 'rb') as f:
-                return f.read()
+                while True:
+                    chunk = await sync_to_async(
+                        f.read, thread_sensitive=False
+                    )(self.READ_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    yield chunk
         finally:
             os.remove(tmp_path)
 
-    async def export_to_file(self, path: str):
-        workbook = xlsxwriter.Workbook(path)
+    async def _iter_rows(
+        self
+    ) -> AsyncIterator[List[Tuple[str, str, float, Optional[str]]]]:
+        if isinstance(self._payments, list):
+            for n in range(0, len(self._payments), self.CHUNK_SIZE):
+                yield [
+                    self._row(msg)
+                    for msg in self._payments[n:n + self.CHUNK_SIZE]
+                ]
+        else:
+            async for msgs in self._payments:
+                yield [self._row(msg) for msg in msgs]
+
+    @classmethod
+    def _row(
+        cls, msg: MassPaymentMicroLedger.Message
+    ) -> Tuple[str, str, float, Optional[str]]:
+        return (
+            msg.customer.display_name,
+            str(msg.card.number),
+            float(msg.transaction.amount),
+            msg.transaction.description
+        )
+
+    async def _write_xlsx(self, path: str):
+        # constant_memory: строки сбрасываются на диск по мере записи,
+        # поэтому пишем строго по порядку
+        workbook = xlsxwriter.Workbook(path, {'constant_memory': True})
         worksheet = workbook.add_worksheet(name='Реестр выплат')
-        expenses = [
-            ('ФИО (*)', 'Номер карты (*)', 'Сумма (*)', 'Комментарий')
-        ]
         currency_format = workbook.add_format()
         currency_format.set_num_format('#,##0.00')
         text_format = workbook.add_format()
         text_format.set_num_format('@')
 
-        for msg in self._payments:
-            expenses.append(
-                (
-                    msg.customer.display_name,
-                    msg.card.number,
-                    msg.transaction.amount,
-                    msg.transaction.description
+        def _write(start: int, rows: List[Tuple]):
+            for row, (name, card_number, amount, comment) in enumerate(
+                rows, start=start
+            ):
+                worksheet.write(row, 0, name)
+                worksheet.write_string(row, 1, card_number, text_format)
+                worksheet.write_number(row, 2, amount, currency_format)
+                worksheet.write(row, 3, comment)
+
+        for col, title in enumerate(self.HEADER):
+            worksheet.write(0, col, title)
+        row = 1
+        try:
+            async for rows in self._iter_rows():
+                await sync_to_async(_write, thread_sensitive=False)(row, rows)
+                row += len(rows)
+        finally:
+            await sync_to_async(workbook.close, thread_sensitive=False)()
+
+    async def _iter_csv(self) -> AsyncIterator[bytes]:
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(self.HEADER)
+        async for rows in self._iter_rows():
+            writer.writerows(rows)
+            yield buffer.getvalue().encode()
+            buffer.seek(0)
+            buffer.truncate()
+        if buffer.tell():
+            yield buffer.getvalue().encode()
+
+    async def _write_parquet(self, path: str):
+        if pyarrow is None:
+            raise ValueError('Parquet export is not available')
+        schema = pyarrow.schema([
+            ('name', pyarrow.string()),
+            ('card_number', pyarrow.string()),
+            ('amount', pyarrow.float64()),
+            ('comment', pyarrow.string())
+        ])
+        writer = pyarrow.parquet.ParquetWriter(path, schema)
+        try:
+            # одна порция выплат - одна row group
+            async for rows in self._iter_rows():
+                table = pyarrow.Table.from_arrays(
+                    [pyarrow.array(list(col)) for col in zip(*rows)],
+                    schema=schema
                 )
-            )
-
-        for row, tup in enumerate(expenses):
-            name, card_number, amount, comment = tup
-            worksheet.write(row, 0, name)
-            worksheet.write(row, 3, comment)
-            if row > 0:
-                worksheet.write_string(row, 1, str(card_number), text_format)
-                worksheet.write_number(row, 2, float(amount), currency_format)
-            else:
-                worksheet.write(row, 1, card_number)
-                worksheet.write(row, 2, amount)
-
-        workbook.close()
+                await sync_to_async(
+                    writer.write_table, thread_sensitive=False
+                )(table)
+        finally:
+            writer.close()
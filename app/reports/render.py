@@ -0,0 +1,82 @@
+import asyncio
+import hashlib
+import json
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Optional, Tuple
+
+from .base import PDFReport
+
+
+def render_jinja_template(name: str, data: Dict = None) -> bytes:
+    return PDFReport().from_jinja_template(name=name, data=data)
+
+
+def _warm_up():
+    # разбор шрифта в воркере - один раз при старте
+    PDFReport()
+
+
+class PDFRenderService:
+    """Рендер PDF-отчетов вне event-loop
+
+    Документы рендерятся в пуле процессов (шрифты и шаблоны кешируются
+    в каждом воркере), число задач в работе ограничено QUEUE_SIZE.
+    Готовые документы запоминаются по имени шаблона и хешу данных
+    """
+
+    MAX_WORKERS = 2
+    QUEUE_SIZE = 8
+    CACHE_SIZE = 128
+
+    _executor: Optional[ProcessPoolExecutor] = None
+    _slots: Optional[Tuple[asyncio.AbstractEventLoop, asyncio.Semaphore]] = None  # noqa
+    _documents: 'OrderedDict[str, bytes]' = OrderedDict()
+
+    @classmethod
+    async def render(cls, name: str, data: Dict = None) -> bytes:
+        key = cls.document_key(name, data)
+        doc = cls._documents.get(key)
+        if doc is not None:
+            cls._documents.move_to_end(key)
+            return doc
+        async with cls._semaphore():
+            loop = asyncio.get_running_loop()
+            doc = await loop.run_in_executor(
+                cls._pool(), render_jinja_template, name, data
+            )
+        cls._documents[key] = doc
+        while len(cls._documents) > cls.CACHE_SIZE:
+            cls._documents.popitem(last=False)
+        return doc
+
+    @classmethod
+    def document_key(cls, name: str, data: Dict = None) -> str:
+        raw = json.dumps(
+            [name, data or {}], sort_keys=True, default=str
+        ).encode()
+        return hashlib.sha256(raw).hexdigest()
+
+    @classmethod
+    def shutdown(cls):
+        if cls._executor is not None:
+            cls._executor.shutdown(wait=True)
+            cls._executor = None
+        cls._slots = None
+        cls._documents.clear()
+
+    @classmethod
+    def _pool(cls) -> ProcessPoolExecutor:
+        if cls._executor is None:
+            cls._executor = ProcessPoolExecutor(
+                max_workers=cls.MAX_WORKERS, initializer=_warm_up
+            )
+        return cls._executor
+
+    @classmethod
+    def _semaphore(cls) -> asyncio.Semaphore:
+        # семафор привязан к event-loop, в котором создан
+        loop = asyncio.get_running_loop()
+        if cls._slots is None or cls._slots[0] is not loop:
+            cls._slots = (loop, asyncio.Semaphore(cls.QUEUE_SIZE))
+        return cls._slots[1]
@@ -2,6 +2,7 @@ from .base import (
     BaseEntityRepository, EntityRetrieveMixin, EntityUpdateMixin,
     EntityCreateMixin, EntityDeleteMixin, CacheMixin, AtomicDelegator
 )
+from .loader import DataLoader
 from .repos import (
     CurrencyRepository, NetworkRepository, AccountRepository,
     PaymentMethodRepository, CorrectionRepository, DirectionRepository,
@@ -11,6 +12,7 @@ from .repos import (
 from .config import ExchangeConfigRepository
 from .kyc import KYCPhotoRepository
 from .storage import StorageRepository
+from .blobs import BlobRepository
 
 __all__ = [
     "BaseEntityRepository", "EntityRetrieveMixin", "EntityUpdateMixin",
@@ -20,5 +22,5 @@ __all__ = [
     "CacheMixin", "ExchangeConfigRepository", "KYCPhotoRepository",
     "CashMethodRepository", "AccountCredentialRepository",
     "AccountSessionRepository", "StorageRepository", "AtomicDelegator",
-    "LedgerRepository"
+    "LedgerRepository", "DataLoader", "BlobRepository"
 ]
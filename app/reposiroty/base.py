@@ -1,13 +1,15 @@
+import asyncio
 from abc import ABC, abstractmethod
 from typing import Type, List, Tuple, Optional, Dict, Union, Any
 
 import pydantic
 from channels.db import database_sync_to_async
-from django.db import models, transaction
+from django.db import models, transaction, router, connections
 from django.forms.models import model_to_dict
 
 from entities import BaseEntity
 from cache import ImplicitCacheMixin
+from .loader import DataLoader
 
 
 class AtomicDelegator(ABC):
@@ -24,6 +26,12 @@ class BaseEntityRepository(ImplicitCacheMixin, ABC):
 
     Model: Type[models.Model] = None
     Entity: Type[BaseEntity] = None
+    # чтение через .values() и model_construct без валидации: включать
+    # только если строки БД не требуют приведения типов сущности
+    _fast_materialize: bool = False
+    # update_or_create одним INSERT ... ON CONFLICT, если фильтры
+    # совпадают с уникальным ограничением модели
+    _native_upsert: bool = True
 
     def __init_subclass__(cls, **kwargs):
         if not cls.Entity:
@@ -32,12 +40,48 @@ class BaseEntityRepository(ImplicitCacheMixin, ABC):
 
     @classmethod
     async def _get_one(cls, **filters) -> Optional[Entity]:
-        m = await cls.Model.objects.filter(**cls._prepare_filters(**filters)).afirst()
+        q = cls.Model.objects.filter(**cls._prepare_filters(**filters))
+        if cls._fast_materialize:
+            row = await q.values(*cls._columns()).afirst()
+            return cls._row_to_entity(row) if row else None
+        m = await q.afirst()
         if m:
             return cls.Entity(**cls._model_to_dict(m))
         else:
             return None
 
+    @classmethod
+    async def load(cls, **filters) -> Optional[Entity]:
+        """Поиск по одному полю через DataLoader текущего запроса
+
+        Вызовы из параллельных корутин одного запроса объединяются
+        в один запрос к БД. Вне контекста запроса - обычный _get_one
+        """
+        if len(filters) != 1:
+            raise RuntimeError('Expected exactly one filter')
+        (field, value), = filters.items()
+        loader = DataLoader.for_context(cls, field)
+        if loader is None:
+            return await cls._get_one(**filters)
+        return await loader.load(value)
+
+    @classmethod
+    async def load_many(cls, **filters) -> List[Optional[Entity]]:
+        (field, values), = filters.items()
+        return list(
+            await asyncio.gather(*[cls.load(**{field: v}) for v in values])
+        )
+
+    @classmethod
+    async def load_batch(cls, field: str, values: List) -> Dict[Any, Entity]:
+        q = cls.Model.objects.filter(**{f'{field}__in': list(values)})
+        result = {}
+        async for m in q.all():
+            key = getattr(m, field)
+            if key not in result:
+                result[key] = cls.Entity(**cls._model_to_dict(m))
+        return result
+
     @classmethod
     async def _get_many(
         cls, order_by: Any = None, limit: int = None,
@@ -51,15 +95,36 @@ class BaseEntityRepository(ImplicitCacheMixin, ABC):
             else:
                 q = q.order_by(order_by)
         ms = []
+        if cls._fast_materialize:
+            async for row in q.values(*cls._columns())[offset:limit]:
+                ms.append(cls._row_to_entity(row))
+            return total, ms
         async for m in q.all()[offset:limit]:
             ms.append(cls.Entity(**cls._model_to_dict(m)))
         return total, ms
 
+    @classmethod
+    def _columns(cls) -> Tuple[str, ...]:
+        # список колонок вычисляется один раз на класс репозитория
+        columns = cls.__dict__.get('_columns_cache')
+        if columns is None:
+            columns = tuple(
+                f.attname for f in cls.Model._meta.concrete_fields
+            )
+            cls._columns_cache = columns
+        return columns
+
+    @classmethod
+    def _row_to_entity(cls, row: Dict) -> Entity:
+        return cls.Entity.model_construct(**row)
+
     @classmethod
     async def _create_one(
         cls, atomic: AtomicDelegator = None, **kwargs
     ) -> Entity:
 
+        DataLoader.clear_for(cls)
+
         def _synced() -> cls.Entity:
             with transaction.atomic():
                 m = cls.Model.objects.create(**cls._entity_to_dict(kwargs))
@@ -76,6 +141,8 @@ class BaseEntityRepository(ImplicitCacheMixin, ABC):
         if not entities:
             return []
 
+        DataLoader.clear_for(cls)
+
         def _sync():
             create_kwargs = [cls._entity_to_dict(e) for e in entities]
             with transaction.atomic():
@@ -94,6 +161,7 @@ class BaseEntityRepository(ImplicitCacheMixin, ABC):
     async def _update_one(
         cls, e: Entity, atomic: AtomicDelegator = None, **filters
     ) -> Optional[Entity]:
+        DataLoader.clear_for(cls)
         d = cls._entity_to_dict(e)
         for k in filters.keys():
             if k in d:
@@ -110,10 +178,80 @@ class BaseEntityRepository(ImplicitCacheMixin, ABC):
         await database_sync_to_async(_synced)()
         return await cls._get_one(**filters)
 
+    @classmethod
+    def _conflict_columns(cls, filters: Dict) -> Optional[Tuple[str, ...]]:
+        """Колонки уникального ограничения, в точности совпадающего с filters
+
+        NULL в ключе ON CONFLICT не срабатывает - такие фильтры не подходят
+        """
+        if not cls._native_upsert or not cls.Model or not filters:
+            return None
+        if any(v is None for v in filters.values()):
+            return None
+        if set(cls._prepare_filters(**filters)) != set(filters):
+            return None
+        opts = cls.Model._meta
+        candidates = [
+            (f.name,) for f in opts.concrete_fields
+            if f.unique and not f.primary_key
+        ] + [tuple(fields) for fields in opts.unique_together]
+        for fields in candidates:
+            if set(fields) == set(filters):
+                return tuple(opts.get_field(n).column for n in fields)
+        return None
+
+    @classmethod
+    async def _upsert_one(
+        cls, conflict: Tuple[str, ...], data: Dict,
+        atomic: AtomicDelegator = None
+    ) -> Entity:
+        DataLoader.clear_for(cls)
+        opts = cls.Model._meta
+        d = cls._entity_to_dict(data)
+        known = {f.name for f in opts.concrete_fields}
+        # экземпляр модели дает python-default значения для INSERT
+        m = cls.Model(**{k: v for k, v in d.items() if k in known})
+        insert_fields = [f for f in opts.concrete_fields if not f.primary_key]
+        # при конфликте обновляем только переданные поля, как _update_one
+        update_fields = [
+            f for f in insert_fields
+            if f.column not in conflict and (
+                f.name in d or getattr(f, 'auto_now', False)
+            )
+        ]
+        db = router.db_for_write(cls.Model)
+
+        def _synced():
+            conn = connections[db]
+            qn = conn.ops.quote_name
+            params = [
+                f.get_db_prep_save(f.pre_save(m, add=True), conn)
+                for f in insert_fields
+            ]
+            assignments = ', '.join(
+                f'{qn(f.column)} = EXCLUDED.{qn(f.column)}'
+                for f in update_fields or [opts.get_field(conflict[0])]
+            )
+            sql = (
+                f'INSERT INTO {qn(opts.db_table)} '
+                f'({", ".join(qn(f.column) for f in insert_fields)}) '
+                f'VALUES ({", ".join(["%s"] * len(insert_fields))}) '
+                f'ON CONFLICT ({", ".join(qn(c) for c in conflict)}) '
+                f'DO UPDATE SET {assignments} RETURNING *'
+            )
+            with transaction.atomic(using=db):
+                row, = cls.Model.objects.raw(sql, params, using=db)
+                if atomic:
+                    atomic()
+                return cls.Entity(**cls._model_to_dict(row))
+
+        return await database_sync_to_async(_synced)()
+
     @classmethod
     async def _delete_one(
         cls, atomic: AtomicDelegator = None, **filters
     ) -> int:
+        DataLoader.clear_for(cls)
 
         def _synced():
             count, *extra = cls.Model.objects.filter(
@@ -200,6 +338,11 @@ class EntityUpdateMixin:
         atomic: AtomicDelegator = None,
         **filters
     ) -> BaseEntityRepository.Entity:
+        conflict = cls._conflict_columns(filters)
+        if conflict:
+            return await cls._upsert_one(
+                conflict, e.model_dump() | filters, atomic
+            )
         exists = await cls._get_one(**filters)
         if exists:
             ee = e.model_copy()
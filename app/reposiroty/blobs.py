@@ -0,0 +1,83 @@
+import hashlib
+from typing import Optional, AsyncIterator, Tuple
+
+from django.db import models
+from django.db.models import F, Func, Value
+
+from exchange.models import Blob as DBBlob
+from entities import Blob
+from .base import BaseEntityRepository, EntityRetrieveMixin
+
+
+class BlobRepository(EntityRetrieveMixin, BaseEntityRepository):
+    """Контентно-адресуемое хранилище: ключ - SHA-256 содержимого
+
+    Одинаковые данные хранятся один раз, сколько бы сообщений
+    леджера (и копий участников) на них ни ссылалось
+    """
+
+    Model = DBBlob
+    Entity = Blob
+    # метаданные читаются без колонки data
+    _fast_materialize = True
+    CHUNK_SIZE = 256 * 1024
+
+    @classmethod
+    async def put(cls, data: bytes, mime_type: str = None) -> Blob:
+        digest = hashlib.sha256(data).hexdigest()
+        exists = await DBBlob.objects.filter(digest=digest).aexists()
+        if not exists:
+            # параллельная запись того же содержимого - не ошибка
+            await DBBlob.objects.abulk_create(
+                [
+                    DBBlob(
+                        digest=digest, size=len(data),
+                        mime_type=mime_type, data=data
+                    )
+                ],
+                ignore_conflicts=True
+            )
+        return Blob(digest=digest, size=len(data), mime_type=mime_type)
+
+    @classmethod
+    async def read(
+        cls, digest: str, start: int = 0, length: int = None
+    ) -> Optional[bytes]:
+        q = DBBlob.objects.filter(digest=digest)
+        if start == 0 and length is None:
+            data = await q.values_list('data', flat=True).afirst()
+        else:
+            args = [F('data'), Value(start + 1)]
+            if length is not None:
+                args.append(Value(length))
+            data = await q.annotate(
+                chunk=Func(
+                    *args, function='substr',
+                    output_field=models.BinaryField()
+                )
+            ).values_list('chunk', flat=True).afirst()
+        return bytes(data) if data is not None else None
+
+    @classmethod
+    async def iter_chunks(
+        cls, digest: str, byte_range: Tuple[int, int] = None
+    ) -> AsyncIterator[bytes]:
+        """Байты blob (или диапазона [start, end] включительно) по чанкам"""
+        if byte_range is None:
+            blob = await cls.get(digest=digest)
+            if blob is None or blob.size == 0:
+                return
+            byte_range = (0, blob.size - 1)
+        pos, end = byte_range
+        while pos <= end:
+            chunk = await cls.read(
+                digest, pos, min(cls.CHUNK_SIZE, end - pos + 1)
+            )
+            if not chunk:
+                return
+            yield chunk
+            pos += len(chunk)
+
+    @classmethod
+    def _columns(cls) -> Tuple[str, ...]:
+        return 'digest', 'size', 'mime_type', 'created_at'
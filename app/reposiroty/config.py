@@ -1,24 +1,38 @@
 import os.path
-from typing import Dict, Optional
+import json
+import time
+from hashlib import sha1
+from typing import Dict, Optional, List, Tuple, Type
 
+from channels.db import database_sync_to_async
+from django.db import models, transaction
 from pydantic import BaseModel, Extra
 from pydantic_yaml import parse_yaml_file_as
 
-from entities import (
-    Currency, PaymentMethod, Network, BasePaymentMethod, Correction, Payment,
-    ExchangeConfig, CashMethod
-)
+from entities import PaymentMethod, Network, ExchangeConfig, CashMethod
 from exchange.models import AppSettings as DBAppSettings
 from reposiroty import (
     CurrencyRepository, PaymentMethodRepository, NetworkRepository,
     CorrectionRepository, DirectionRepository, PaymentRepository,
-    BaseEntityRepository, CacheMixin, CashMethodRepository
+    BaseEntityRepository, CacheMixin, CashMethodRepository, DataLoader
 )
 
 
 class ExchangeConfigRepository(CacheMixin, BaseEntityRepository):
 
     Entity = ExchangeConfig
+    # как часто процесс сверяет свою копию конфига с ключом версии в кеше
+    CHECK_INTERVAL_SEC = 1.0
+
+    _repositories = [
+        CurrencyRepository, PaymentMethodRepository, NetworkRepository,
+        CashMethodRepository, CorrectionRepository, PaymentRepository,
+        DirectionRepository
+    ]
+
+    # копия конфига, разделяемая всеми запросами процесса
+    _current: Optional[ExchangeConfig] = None
+    _current_checked_at: float = 0
 
     class AnyCfg(BaseModel, extra=Extra.allow):
         ...
@@ -79,75 +93,170 @@ class ExchangeConfigRepository(CacheMixin, BaseEntityRepository):
             directions=directions,
             **extra
         )
+        cfg.version = cls._build_version(cfg)
         await cls._cache.set(
             'config', cfg.model_dump(mode='json'), ttl=cfg.cache_timeout_sec
         )
+        await cls._cache.set(
+            'config:version', cfg.version, ttl=cfg.cache_timeout_sec
+        )
         return cfg
 
     @classmethod
-    async def set(cls, cfg: ExchangeConfig):
-        symbol_to_cur: Dict[str, Currency] = {}
-        uid_to_meth: Dict[str, BasePaymentMethod] = {}
-        uid_to_corr: Dict[str, Correction] = {}
-        code_to_pay: Dict[str, Payment] = {}
-
-        await ExchangeConfigRepository.invalidate_cache()
-        await cls.AppSettings.set(
-            {
-                'refresh_timeout_sec': cfg.refresh_timeout_sec,
-                'cache_timeout_sec': cfg.cache_timeout_sec,
-                'merchants': cfg.merchants,
-                'paths': cfg.paths.model_dump(mode='json'),
-                'identity': cfg.identity.model_dump(mode='json') if cfg.identity else None,  # noqa
-                'reports': cfg.reports.model_dump(mode='json') if cfg.reports else None  # noqa
-            }
-        )
+    async def current(cls) -> ExchangeConfig:
+        """Конфиг для обработки запроса
 
-        for cur in cfg.currencies:
-            await CurrencyRepository.update_or_create(
-                cur, symbol=cur.symbol
-            )
-            symbol_to_cur[cur.symbol] = cur
-        for code, meth in cfg.methods.items():
-            if isinstance(meth, PaymentMethod):
-                meth.code = code
-                await PaymentMethodRepository.update_or_create(
-                    meth, uid=code
-                )
-            elif isinstance(meth, Network):
-                meth.code = code
-                await NetworkRepository.update_or_create(
-                    meth, uid=code
-                )
-            elif isinstance(meth, CashMethod):
-                meth.code = code
-                await CashMethodRepository.update_or_create(
-                    meth, uid=code
+        Провалидированный конфиг держится в памяти процесса. Не чаще
+        раза в CHECK_INTERVAL_SEC сверяется короткий ключ версии в кеше,
+        полная загрузка выполняется только при смене версии
+        """
+        cfg = cls._current
+        now = time.monotonic()
+        if cfg is not None and now - cls._current_checked_at < cls.CHECK_INTERVAL_SEC:  # noqa
+            return cfg
+        version = await cls._cache.get('config:version')
+        if cfg is None or version is None or version != cfg.version:
+            cfg = await cls.get()
+            cls._current = cfg
+        cls._current_checked_at = now
+        return cfg
+
+    @classmethod
+    async def invalidate_cache(cls):
+        cls._current = None
+        await super().invalidate_cache()
+
+    @classmethod
+    def _build_version(cls, cfg: ExchangeConfig) -> str:
+        dump = cfg.model_dump(mode='json', exclude={'version'})
+        return sha1(
+            json.dumps(dump, sort_keys=True).encode()
+        ).hexdigest()
+
+    @classmethod
+    async def set(cls, cfg: ExchangeConfig, prune: bool = False):
+        """Сохраняет конфиг в БД одной транзакцией
+
+        Текущее состояние таблиц читается за один проход, затем
+        применяется только разница: новые строки - bulk_create, измененные
+        - bulk_update. С prune=True удаляются строки, которых нет в cfg.
+        Кеш конфига (и его версия) сбрасывается один раз после коммита
+        """
+        app_settings = {
+            'refresh_timeout_sec': cfg.refresh_timeout_sec,
+            'cache_timeout_sec': cfg.cache_timeout_sec,
+            'merchants': cfg.merchants,
+            'paths': cfg.paths.model_dump(mode='json'),
+            'identity': cfg.identity.model_dump(mode='json') if cfg.identity else None,  # noqa
+            'reports': cfg.reports.model_dump(mode='json') if cfg.reports else None  # noqa
+        }
+        tables = cls._build_rows(cfg)
+
+        def _synced():
+            with transaction.atomic():
+                DBAppSettings.objects.update_or_create(
+                    defaults={'storage': app_settings}
                 )
-            else:
-                raise RuntimeError(f'Unexpected method type {meth}')
-            uid_to_meth[code] = meth
-        for uid, corr in cfg.costs.items():
-            await CorrectionRepository.update_or_create(
-                corr, uid=uid
-            )
-            uid_to_corr[uid] = corr
+                for model, keys, rows in tables:
+                    cls._apply_diff(model, keys, rows, prune)
+
+        await database_sync_to_async(_synced)()
+        for repo in cls._repositories:
+            DataLoader.clear_for(repo)
+        await cls.invalidate_cache()
+
+    @classmethod
+    def _build_rows(
+        cls, cfg: ExchangeConfig
+    ) -> List[Tuple[Type[models.Model], Tuple[str, ...], List[Dict]]]:
+        # валидация ссылок до любых записей в БД
+        symbols = {cur.symbol for cur in cfg.currencies}
         for payment in cfg.payments:
-            if payment.cur not in symbol_to_cur:
+            if payment.cur not in symbols:
                 raise RuntimeError(f'Unknown payment cur: {payment.cur}')
-            if payment.method not in uid_to_meth:
+            if payment.method not in cfg.methods:
                 raise RuntimeError(f'Unknown payment meth: {payment.method}')
             for cost in (payment.costs.outcome or []) + (
                     payment.costs.income or []):
-                if cost not in uid_to_corr:
+                if cost not in cfg.costs:
                     raise RuntimeError(f'Unknown cost: {cost}')
-            await PaymentRepository.update_or_create(payment,
-                                                     code=payment.code)
-            code_to_pay[payment.code] = payment
-        for direction in cfg.directions:
-            await DirectionRepository.update_or_create(
-                direction, src=direction.src, dest=direction.dest
+
+        methods = {
+            PaymentMethod: (PaymentMethodRepository, []),
+            Network: (NetworkRepository, []),
+            CashMethod: (CashMethodRepository, []),
+        }
+        for code, meth in cfg.methods.items():
+            if type(meth) not in methods:
+                raise RuntimeError(f'Unexpected method type {meth}')
+            meth.code = code
+            repo, rows = methods[type(meth)]
+            rows.append(dict(repo._entity_to_dict(meth), uid=code))
+
+        tables = [
+            (
+                CurrencyRepository.Model, ('symbol', 'owner_did'),
+                [CurrencyRepository._entity_to_dict(cur) for cur in cfg.currencies]  # noqa
             )
+        ]
+        for repo, rows in methods.values():
+            tables.append((repo.Model, ('uid',), rows))
+        tables.append((
+            CorrectionRepository.Model, ('uid',),
+            [
+                dict(CorrectionRepository._entity_to_dict(corr), uid=uid)
+                for uid, corr in cfg.costs.items()
+            ]
+        ))
+        tables.append((
+            PaymentRepository.Model, ('code',),
+            [PaymentRepository._entity_to_dict(p) for p in cfg.payments]
+        ))
+        tables.append((
+            DirectionRepository.Model, ('src', 'dest'),
+            [DirectionRepository._entity_to_dict(d) for d in cfg.directions]
+        ))
+        return tables
+
+    @classmethod
+    def _apply_diff(
+        cls, model: Type[models.Model], keys: Tuple[str, ...],
+        rows: List[Dict], prune: bool
+    ):
+        fields = {
+            f.name for f in model._meta.concrete_fields if not f.primary_key
+        }
+        existing = {}
+        for m in model.objects.all():
+            existing.setdefault(tuple(getattr(m, k) for k in keys), m)
+        # как и при последовательном update_or_create, побеждает последняя
+        new_rows = {}
+        for row in rows:
+            row = {k: v for k, v in row.items() if k in fields}
+            new_rows[tuple(row.get(k) for k in keys)] = row
+
+        to_create, to_update, update_fields = [], [], set()
+        for key, row in new_rows.items():
+            m = existing.get(key)
+            if m is None:
+                to_create.append(model(**row))
+                continue
+            changed = [k for k, v in row.items() if getattr(m, k) != v]
+            if changed:
+                for k in changed:
+                    setattr(m, k, row[k])
+                update_fields.update(changed)
+                to_update.append(m)
+        if to_create:
+            model.objects.bulk_create(to_create)
+        if to_update:
+            model.objects.bulk_update(to_update, sorted(update_fields))
+        if prune:
+            stale = [
+                m.pk for key, m in existing.items() if key not in new_rows
+            ]
+            if stale:
+                model.objects.filter(pk__in=stale).delete()
 
     @classmethod
     async def init_from_yaml(
@@ -0,0 +1,78 @@
+import asyncio
+from typing import Any, Dict, List, Optional, Type
+
+from context import context
+
+
+class DataLoader:
+    """Пакетная загрузка сущностей репозитория в пределах запроса
+
+    Вызовы load(), сделанные в одном такте event-loop, собираются в один
+    запрос `<field>__in`, повторные ключи не запрашиваются повторно.
+    Экземпляр живет в контексте запроса (см. for_context)
+    """
+
+    def __init__(self, repository: Type, field: str = 'uid'):
+        self.repository = repository
+        self.field = field
+        self._futures: Dict[Any, asyncio.Future] = {}
+        self._queue: List[Any] = []
+
+    @classmethod
+    def for_context(
+        cls, repository: Type, field: str = 'uid'
+    ) -> Optional['DataLoader']:
+        memo = cls._memo()
+        if memo is None:
+            return None
+        key = (repository.__name__, field)
+        loader = memo.get(key)
+        if loader is None:
+            loader = cls(repository, field)
+            memo[key] = loader
+        return loader
+
+    @classmethod
+    def clear_for(cls, repository: Type):
+        memo = cls._memo()
+        if memo:
+            for key in [k for k in memo if k[0] == repository.__name__]:
+                del memo[key]
+
+    async def load(self, key: Any) -> Optional[Any]:
+        fut = self._futures.get(key)
+        if fut is None:
+            loop = asyncio.get_running_loop()
+            fut = loop.create_future()
+            self._futures[key] = fut
+            if not self._queue:
+                loop.call_soon(self._dispatch)
+            self._queue.append(key)
+        value = await asyncio.shield(fut)
+        # результат разделяется между вызовами, отдаем копию
+        return value.model_copy() if value is not None else None
+
+    async def load_many(self, keys: List[Any]) -> List[Optional[Any]]:
+        return list(await asyncio.gather(*[self.load(k) for k in keys]))
+
+    def _dispatch(self):
+        keys, self._queue = self._queue, []
+        asyncio.ensure_future(self._fetch(keys))
+
+    async def _fetch(self, keys: List[Any]):
+        try:
+            found = await self.repository.load_batch(self.field, keys)
+        except Exception as e:
+            for k in keys:
+                self._futures.pop(k).set_exception(e)
+            return
+        for k in keys:
+            self._futures[k].set_result(found.get(k))
+
+    @classmethod
+    def _memo(cls) -> Optional[Dict]:
+        try:
+            return context.memo.setdefault(cls.__name__, {})
+        except ValueError:
+            # вне контекста запроса
+            return None
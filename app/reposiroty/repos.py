@@ -1,10 +1,15 @@
+import uuid
 import base64
-from typing import Union, Dict, List, Optional, Tuple
+import asyncio
+import logging
+from typing import Union, Dict, List, Optional, Tuple, Set
 
 from django.db import transaction
+from django.db.models import Subquery, Q
 from channels.db import database_sync_to_async
 
-from core.utils import utc_now_float, float_to_datetime
+from context import context
+from core.utils import utc_now_float, float_to_datetime, datetime_to_float
 from exchange.models import (
     Currency as DBCurrency, Network as DBNetwork,
     Account as DBAccount, PaymentMethod as DBPaymentMethod,
@@ -25,6 +30,7 @@ from .base import (
     BaseEntityRepository, EntityRetrieveMixin, EntityUpdateMixin,
     EntityCreateMixin, EntityDeleteMixin
 )
+from .loader import DataLoader
 
 
 class CurrencyRepository(
@@ -116,10 +122,16 @@ class AccountRepository(
     _cache_merchants_ttl = 5*60
     _cache_merchants_key = 'merchants'
     _cache_anonymous_ttl = 60*60
+    _cache_accounts_ttl = 5*60
+    # extra-поля сливаются с сохраненными, ON CONFLICT перезапишет колонку
+    _native_upsert = False
 
     @classmethod
     async def get(cls, **filters) -> Optional[BaseEntityRepository.Entity]:
-        acc = await super().get(**filters)
+        if len(filters) == 1 and ('uid' in filters or 'did' in filters):
+            acc = await cls._get_cached(**filters)
+        else:
+            acc = await super().get(**filters)
         if acc:
             return acc
         else:
@@ -130,6 +142,120 @@ class AccountRepository(
             else:
                 return None
 
+    @classmethod
+    async def _get_cached(
+        cls, uid: str = None, did: str = None
+    ) -> Optional[Account]:
+        """Read-through чтение аккаунта по uid или did
+
+        Записи в кеше помечены версией аккаунта, которая меняется при
+        каждой записи в репозиторий: запись, прочитанная из БД до смены
+        версии, не будет отдана. Внутри запроса результат мемоизируется
+        в контексте
+        """
+        memo = cls._memo()
+        memo_key = f'uid:{uid}' if uid else f'did:{did}'
+        if memo is not None and memo_key in memo:
+            cached = memo[memo_key]
+            return cached.model_copy(deep=True)
+
+        acc: Optional[Account] = None
+        cache = cls._cache.namespace('accounts')
+        if did:
+            ref = await cache.get(f'did:{did}')
+            if ref:
+                uid = ref['uid']
+            else:
+                acc = await super().get(did=did)
+                if acc:
+                    await cache.set(
+                        f'did:{did}', {'uid': acc.uid},
+                        ttl=cls._cache_accounts_ttl
+                    )
+        if uid:
+            # версия читается до обращения к БД
+            values = await cache.get([f'ver:{uid}', f'uid:{uid}'])
+            version, entry = values[f'ver:{uid}'], values[f'uid:{uid}']
+            if entry and entry['ver'] == version:
+                acc = Account.model_validate(entry['account'])
+            else:
+                acc = await super().get(uid=uid)
+                if acc:
+                    await cache.set(
+                        f'uid:{uid}',
+                        {
+                            'ver': version,
+                            'account': acc.model_dump(mode='json')
+                        },
+                        ttl=cls._cache_accounts_ttl
+                    )
+            if did and acc and cls._did(acc) != did:
+                # did переназначен другому аккаунту
+                await cache.delete(f'did:{did}')
+                acc = await super().get(did=did)
+        if memo is not None and acc:
+            memo[memo_key] = acc.model_copy(deep=True)
+        return acc
+
+    @classmethod
+    async def _invalidate_accounts(cls, *uids: Optional[str]):
+        uids = [uid for uid in set(uids) if uid]
+        if not uids:
+            return
+        cache = cls._cache.namespace('accounts')
+        for uid in uids:
+            # новая версия отсекает записи, прочитанные до изменения
+            await cache.set(
+                f'ver:{uid}', uuid.uuid4().hex,
+                ttl=cls._cache_accounts_ttl * 2
+            )
+        DataLoader.clear_for(cls)
+        memo = cls._memo()
+        if memo is not None:
+            # did мог указывать на любой из измененных аккаунтов
+            for key in [k for k in memo if k.startswith('did:')]:
+                del memo[key]
+            for uid in uids:
+                memo.pop(f'uid:{uid}', None)
+
+    @classmethod
+    async def load_batch(cls, field: str, values: List) -> Dict[str, Account]:
+        if field != 'did':
+            return await super().load_batch(field, values)
+        q = DBAccount.objects.filter(
+            merchant_meta__identity__did__root__in=list(values)
+        )
+        result = {}
+        async for m in q.all():
+            acc = cls.Entity(**cls._model_to_dict(m))
+            result.setdefault(cls._did(acc), acc)
+        return result
+
+    @classmethod
+    def _memo(cls) -> Optional[Dict]:
+        try:
+            return context.memo.setdefault(cls.__name__, {})
+        except ValueError:
+            # вне контекста запроса
+            return None
+
+    @classmethod
+    def _did(cls, account: Account) -> Optional[str]:
+        meta = account.merchant_meta or {}
+        return ((meta.get('identity') or {}).get('did') or {}).get('root')
+
+    @classmethod
+    async def get_by_credential_digest(cls, digest: str) -> Optional[Account]:
+        # один запрос: аккаунт по индексу дайджеста учетных данных
+        cred_uid = DBCredential.objects.filter(
+            digest=digest
+        ).values('account_uid')[:1]
+        m = await DBAccount.objects.filter(uid=Subquery(cred_uid)).afirst()
+        if m:
+            return cls.Entity(**cls._model_to_dict(m))
+        else:
+            return None
+
     @classmethod
     async def update_kyc(
         cls, kyc: AccountKYC, account: Union[str, Account]
@@ -159,6 +285,7 @@ class AccountRepository(
         await DBAccount.objects.filter(uid=account_uid).aupdate(
             is_verified=True
         )
+        await cls._invalidate_accounts(account_uid)
         kyc = await cls.load_kyc(account)
         return kyc
 
@@ -321,6 +448,7 @@ class AccountRepository(
     @classmethod
     async def create(cls, **kwargs) -> BaseEntityRepository.Entity:
         await cls._cache.delete(key=cls._cache_merchants_key)
+        await cls._invalidate_accounts(kwargs.get('uid'))
         return await super().create(**kwargs)
 
     @classmethod
@@ -331,7 +459,9 @@ class AccountRepository(
             return await cls.save_anonymous_account(e)
         else:
             await cls._cache.delete(key=cls._cache_merchants_key)
-            return await super().update(e, **filters)
+            upd = await super().update(e, **filters)
+            await cls._invalidate_accounts(e.uid, filters.get('uid'))
+            return upd
 
     @classmethod
     async def update_or_create(
@@ -341,7 +471,9 @@ class AccountRepository(
             return await cls.save_anonymous_account(e)
         else:
             await cls._cache.delete(key=cls._cache_merchants_key)
-            return await super().update_or_create(e, **filters)
+            upd = await super().update_or_create(e, **filters)
+            await cls._invalidate_accounts(e.uid, filters.get('uid'))
+            return upd
 
     @classmethod
     async def load_anonymous_account(cls, uid) -> Optional[AnonymousAccount]:
@@ -369,7 +501,6 @@ class AccountRepository(
     @classmethod
     async def delete(cls, **filters) -> int:
 
-        await cls._cache.delete(key=cls._cache_merchants_key)
         _, many = await cls.get_many(**filters)
         if many:
             for a in many:
@@ -383,7 +514,13 @@ class AccountRepository(
             with transaction.atomic():
                 return cls.sync_delete(**filters)
 
-        return await database_sync_to_async(__atomic_delete)()
+        count = await database_sync_to_async(__atomic_delete)()
+        # кеш сбрасываем после коммита: иначе конкурентное чтение
+        # успеет закешировать удаляемый аккаунт под новой версией
+        await cls._cache.delete(key=cls._cache_merchants_key)
+        if many:
+            await cls._invalidate_accounts(*[a.uid for a in many])
+        return count
 
     @classmethod
     def sync_delete(cls, **filters) -> int:
@@ -443,6 +580,20 @@ class AccountCredentialRepository(
     Model = DBCredential
     Entity = Credential
 
+    @classmethod
+    def _model_to_dict(cls, model: DBCredential) -> Dict:
+        d = super()._model_to_dict(model)
+        d.pop('digest', None)
+        return d
+
+    @classmethod
+    def _entity_to_dict(cls, e: Union[Credential, Dict]) -> Dict:
+        d = super()._entity_to_dict(e)
+        # всегда выводится из payload, чтобы не разойтись с ним
+        token = (d.get('payload') or {}).get('token')
+        d['digest'] = token if isinstance(token, str) else None
+        return d
+
     @classmethod
     def _prepare_filters(cls, **filters) -> dict:
         d = super()._prepare_filters(**filters)
@@ -461,27 +612,40 @@ class AccountSessionRepository(
     Model = DBSession
     Entity = Session
     _cache_read_ttl = 60
+    # last_access_utc пишется в БД пачками не чаще раза в интервал.
+    # Хука остановки под Daphne нет: при завершении процесса теряются
+    # обращения не более чем за один интервал
+    ACCESS_FLUSH_INTERVAL_SEC = 30
+
+    # uid сессии -> время последнего обращения, еще не записанное в БД
+    _pending_access: Dict[str, float] = {}
+    # фоновая запись накопленного, живет пока есть что писать
+    _access_flusher: Optional[asyncio.Task] = None
 
     @classmethod
     async def get(cls, **filters) -> Optional[BaseEntityRepository.Entity]:
         uid = filters.get('uid')
         access_by_id = uid and len(filters) == 1
+        e: Optional[Session] = None
         if access_by_id:
             cached = await cls._cache.get(key=uid)
             if cached:
                 try:
-                    return Session.model_validate(cached)
+                    e = Session.model_validate(cached)
                 except ValueError:
                     await cls._cache.delete(key=uid)
-        e: Session = await super().get(**filters)
-        if e:
-            await cls._update_timestamps(e, store_db=True)
-            if access_by_id:
+        if e is None:
+            e = await super().get(**filters)
+            if e and access_by_id:
                 await cls._cache.set(
                     key=uid,
                     value=e.model_dump(mode='json'),
                     ttl=cls._cache_read_ttl
                 )
+        if e:
+            if cls._is_expired(e):
+                return None
+            await cls._track_access(e.uid)
         return e
 
     @classmethod
@@ -489,20 +653,76 @@ class AccountSessionRepository(
         _, many = await cls.get_many(**filters)
         if many:
             await cls._cache.delete(key=[e.uid for e in many])
+            for e in many:
+                cls._pending_access.pop(e.uid, None)
         return await super().delete(**filters)
 
+    @classmethod
+    async def flush_access(cls) -> int:
+        """Записывает накопленные обращения к сессиям одним UPDATE
+
+        Вызывается фоновой задачей раз в ACCESS_FLUSH_INTERVAL_SEC
+        """
+        pending, cls._pending_access = cls._pending_access, {}
+        if not pending:
+            return 0
+
+        def _synced():
+            with transaction.atomic():
+                sessions = list(
+                    DBSession.objects.filter(uid__in=list(pending.keys()))
+                )
+                for obj in sessions:
+                    obj.last_access_utc = float_to_datetime(pending[obj.uid])
+                DBSession.objects.bulk_update(sessions, ['last_access_utc'])
+                return len(sessions)
+
+        try:
+            return await database_sync_to_async(_synced)()
+        except Exception:
+            # возвращаем обращения, если с тех пор не было более свежих
+            for uid, utc in pending.items():
+                if cls._pending_access.get(uid, 0) < utc:
+                    cls._pending_access[uid] = utc
+            raise
+
+    @classmethod
+    async def _track_access(cls, uid: str):
+        cls._pending_access[uid] = utc_now_float()
+        loop = asyncio.get_running_loop()
+        flusher = cls._access_flusher
+        if flusher is None or flusher.done() or flusher.get_loop() is not loop:  # noqa
+            cls._access_flusher = loop.create_task(cls._flush_periodically())
+
+    @classmethod
+    async def _flush_periodically(cls):
+        while cls._pending_access:
+            await asyncio.sleep(cls.ACCESS_FLUSH_INTERVAL_SEC)
+            try:
+                await cls.flush_access()
+            except Exception:
+                logging.exception('Session access flush failed')
+
+    @classmethod
+    def _is_expired(cls, e: Session) -> bool:
+        if e.kill_after_utc is None:
+            return False
+        kill = e.kill_after_utc
+        ts = kill.timestamp() if kill.tzinfo else datetime_to_float(kill)
+        return ts < utc_now_float()
+
     @classmethod
     async def update(
         cls, e: BaseEntityRepository.Entity, **filters
     ) -> Optional[BaseEntityRepository.Entity]:
-        upd = await cls._update_timestamps(e, store_db=False)
+        upd = await cls._update_timestamps(e)
         return await super().update(upd, **filters)
 
     @classmethod
     async def update_or_create(
         cls, e: BaseEntityRepository.Entity, **filters
     ) -> BaseEntityRepository.Entity:
-        upd = await cls._update_timestamps(e, store_db=False)
+        upd = await cls._update_timestamps(e)
         return await super().update_or_create(upd, **filters)
 
     @classmethod
@@ -514,13 +734,13 @@ class AccountSessionRepository(
         return d
 
     @classmethod
-    async def _update_timestamps(
-        cls, e: Session, store_db: bool = False
-    ) -> Session:
+    async def _update_timestamps(cls, e: Session) -> Session:
         upd = Session.model_validate(e.model_dump())
         upd.last_access_utc = float_to_datetime(utc_now_float())
-        if store_db:
-            await cls.update(e=upd, uid=e.uid)
+        # запись ниже свежее накопленного обращения, а кеш
+        # не должен пережить смену kill_after_utc
+        cls._pending_access.pop(e.uid, None)
+        await cls._cache.delete(key=e.uid)
         return upd
 
 
@@ -626,6 +846,7 @@ class LedgerRepository(BaseEntityRepository):
     Entity = Ledger
 
     _category = 'identity-ledgers'
+    _cache_ledgers_ttl = 5*60
 
     @classmethod
     async def ensure_exists(
@@ -634,49 +855,102 @@ class LedgerRepository(BaseEntityRepository):
     ):
         storage_id = identity.did.root
 
-        def _sync():
+        def _sync() -> Tuple[List[Ledger], Set[str]]:
+            removed = []
+            previous = set()
             with transaction.atomic():
+                # прежние участники: исключенный из леджера DID
+                # тоже должен сбросить свой кеш
+                for members in DBStorageItem.objects.filter(
+                    storage_id=storage_id, category=cls._category,
+                    uid__in=[i.id for i in ledgers]
+                ).values_list('storage_ids', flat=True):
+                    previous |= set(members or [])
                 for ledger in ledgers:
                     rec = DBStorageItem.objects.update_or_create(
                         defaults={
-                            'payload': ledger.model_dump(mode='json')
+                            'payload': ledger.model_dump(mode='json'),
+                            # индекс участников для load()
+                            'storage_ids': cls._members(ledger)
                         },
                         storage_id=storage_id, category=cls._category,
                         uid=ledger.id
                     )
                 if remove_others:
-                    DBStorageItem.objects.filter(
+                    others = DBStorageItem.objects.filter(
                         storage_id=storage_id, category=cls._category,
                     ).exclude(
                         uid__in=[i.id for i in ledgers]
-                    ).delete()
-
-        await database_sync_to_async(_sync)()
+                    )
+                    for m in others:
+                        removed.append(Ledger.model_validate(m.payload))
+                        previous |= set(m.storage_ids or [])
+                    others.delete()
+            return removed, previous
+
+        removed, affected = await database_sync_to_async(_sync)()
+        affected.add(storage_id)
+        for ledger in list(ledgers) + removed:
+            affected |= set(cls._members(ledger))
+            # has_participant также учитывает префикс ID леджера:
+            # сбрасываем все префиксы, без обхода ключей кеша
+            affected |= {
+                ledger.id[:n] for n in range(1, len(ledger.id) + 1)
+            }
+        await cls._ledgers_cache().delete(list(affected))
 
     @classmethod
     async def load(
         cls, identity: Identity, tag: str = None,
         id_: Union[str, List[str]] = None
     ) -> List[Ledger]:
-        filters = {}
+        ledgers = await cls._load_for(identity.did.root)
         if tag:
-            filters['payload__tags__contains'] = [tag]
+            ledgers = [ledger for ledger in ledgers if tag in ledger.tags]
         if id_:
             if isinstance(id_, str):
-                filters['payload__id'] = id_
-            elif isinstance(id_, list):
-                filters['payload__id__in'] = id_
+                id_ = [id_]
+            ledgers = [ledger for ledger in ledgers if ledger.id in id_]
+        return ledgers
+
+    @classmethod
+    async def _load_for(cls, did: str) -> List[Ledger]:
+        """Леджеры участника: по индексу storage_ids или префиксу ID,
+        результат кешируется до ensure_exists
+        """
+        cache = cls._ledgers_cache()
+        cached = await cache.get(did)
+        if cached is not None:
+            try:
+                return [Ledger.model_validate(i) for i in cached]
+            except ValueError:
+                await cache.delete(did)
         q = DBStorageItem.objects.filter(
-            category=cls._category, **filters
-        )
+            Q(storage_ids__contains=[did]) | Q(uid__startswith=did),
+            category=cls._category
+        ).order_by('pk')
         result = []
-        did = identity.did.root
         exists_ids = set()
         async for m in q.all():
             m: DBStorageItem
             ledger = Ledger.model_validate(m.payload)
-            if m.id == did or ledger.has_participant(did):
+            if ledger.has_participant(did):
                 if ledger.id not in exists_ids:
                     result.append(ledger)
                     exists_ids.add(ledger.id)
+        await cache.set(
+            did, [i.model_dump(mode='json') for i in result],
+            ttl=cls._cache_ledgers_ttl
+        )
         return result
+
+    @classmethod
+    def _ledgers_cache(cls):
+        return cls._cache.namespace('participant')
+
+    @classmethod
+    def _members(cls, ledger: Ledger) -> List[str]:
+        members = set()
+        for dids in ledger.participants.values():
+            members |= set(dids)
+        return sorted(members)
@@ -16,6 +16,8 @@ class StorageRepository(
 ):
     Model = DBStorageItem
     Entity = StorageItem
+    # строки хранилища - плоские колонки и JSON, валидация не нужна
+    _fast_materialize = True
 
     @classmethod
     def _model_to_dict(cls, model: DBStorageItem) -> Dict:
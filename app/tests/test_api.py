@@ -1,17 +1,23 @@
 import os
 import base64
+import json
 import asyncio
+import time
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 from typing import List
+from unittest.mock import patch
 from uuid import uuid4
 
 import magic
+import pytest
 import requests
 from pydantic import BaseModel, Extra
 from pydantic_yaml import parse_yaml_file_as
 
 from django.conf import settings
-from django.test import LiveServerTestCase, override_settings
+from django.db import connection, transaction
+from django.test import LiveServerTestCase, RequestFactory, override_settings
 
 from entities import (
     KYCPhoto, VerifiedDocument, VerifyMetadata, Biometrics,
@@ -19,15 +25,21 @@ from entities import (
     PaymentRequest
 )
 from reposiroty import (
-    ExchangeConfigRepository, AccountRepository
+    ExchangeConfigRepository, AccountRepository, AccountSessionRepository
 )
 from exchange.models import (
     KYCPhoto as DBKYCPhoto, Account as DBAccount,
-    StorageItem as DBStorageItem
+    MassPaymentBalance, Blob as DBBlob,
+    LedgerTransaction as DBLedgerTransaction,
+    LedgerParticipant as DBLedgerParticipant
 )
 from kyc.base import BaseKYCProvider
-from merchants import update_merchants_config
+from merchants import (
+    update_merchants_config, load_directions, MerchantRatios, EngineVariable
+)
 from reposiroty.utils import create_superuser, TokenAuth
+from api.auth import BaseAuth, authenticate
+from api.mass_payment import MassPaymentAssetsResource, MassPaymentController
 from .binaries import DATA_URL_JPG, DATA_URL_PDF, DATA_URI_XLS, DATA_URI_DOCX
 
 
@@ -1191,6 +1203,9 @@ class TestMassPayments(LiveServerTestCase):
         asyncio.run(
             update_merchants_config(self.cfg)
         )
+        asyncio.run(
+            MassPaymentAssetsResource.invalidate_cache()
+        )
 
     @property
     def headers(self) -> dict:
@@ -1361,10 +1376,12 @@ class TestMassPayments(LiveServerTestCase):
         assert create.status_code == 200
         assert len(create.json()) == 2
 
-        si = list(DBStorageItem.objects.filter(
+        txns = list(DBLedgerTransaction.objects.filter(
             payload__transaction__order_id__in=[order_id1, order_id2]
         ).all())
-        assert len(si) == 4  # по 1 записи для мерчанта и для оператора платежей
+        assert len(txns) == 2
+        # видимость для мерчанта и для оператора платежей
+        assert DBLedgerParticipant.objects.filter(txn__in=txns).count() == 4
 
         read = requests.get(
             url, headers=self.headers
@@ -1866,6 +1883,81 @@ class TestMassPayments(LiveServerTestCase):
         assert resp.status_code == 200
         assert resp.headers.get('Content-Type') == 'application/vnd.openxmlformats-officedocument.wordprocessingml.document'
 
+    def test_attachments_blob_store(self):
+        root_token = uuid.uuid4().hex
+        asyncio.run(
+            create_superuser(
+                uid='test:root:blobs',
+                credentials=[
+                    TokenAuth.TokenCredential(
+                        token=root_token
+                    )
+                ]
+            )
+        )
+        root_access_header = {
+            'Token': root_token
+        }
+        uid1, uid2 = uuid4().hex, uuid4().hex
+        resp = requests.post(
+            self.live_server_url + f'/api/control-panel/{self.merchant.identity.did.root}/mass-payments/attachments',
+            json=[
+                {'uid': uid1, 'name': 'Image.jpeg', 'data': DATA_URL_JPG},
+                {'uid': uid2, 'name': 'Copy.jpeg', 'data': DATA_URL_JPG}
+            ],
+            headers=root_access_header
+        )
+        assert resp.status_code == 200
+        assert all(a['data'] == DATA_URL_JPG for a in resp.json())
+
+        # одинаковое содержимое хранится один раз, в леджере - только хеш
+        expected = base64.b64decode(DATA_URL_JPG.split('base64,', 1)[1])
+        blobs = list(DBBlob.objects.all())
+        assert len(blobs) == 1
+        assert bytes(blobs[0].data) == expected
+        for item in DBLedgerTransaction.objects.filter(
+            payload__type='attachment'
+        ):
+            payload = item.payload['status']['payload']
+            assert 'data' not in payload
+            assert payload['digest'] == blobs[0].digest
+            assert payload['size'] == len(expected)
+
+        url = self.live_server_url + f'/api/control-panel/{self.merchant.identity.did.root}/mass-payments/{uid2}/file'
+        resp = requests.get(url, headers=root_access_header)
+        assert resp.status_code == 200
+        assert resp.content == expected
+        resp = requests.get(
+            url, headers=dict(root_access_header, Range='bytes=10-19')
+        )
+        assert resp.status_code == 206
+        assert resp.content == expected[10:20]
+        assert resp.headers['Content-Range'] == f'bytes 10-19/{len(expected)}'
+        resp = requests.get(
+            url, headers=dict(root_access_header, Range='bytes=-5')
+        )
+        assert resp.status_code == 206
+        assert resp.content == expected[-5:]
+        resp = requests.get(
+            url,
+            headers=dict(root_access_header, Range=f'bytes={len(expected)}-')
+        )
+        assert resp.status_code == 416
+        # синтаксически неверный диапазон игнорируется
+        resp = requests.get(
+            url, headers=dict(root_access_header, Range='bytes=20-10')
+        )
+        assert resp.status_code == 200
+        assert resp.content == expected
+        # большой диапазон отдается потоком
+        with patch.object(MassPaymentController, 'STREAM_THRESHOLD', 16):
+            resp = requests.get(
+                url, headers=dict(root_access_header, Range='bytes=0-')
+            )
+        assert resp.status_code == 206
+        assert resp.content == expected
+        assert resp.headers['Content-Length'] == str(len(expected))
+
     def test_attachments_last_attachment(self):
         root_token = uuid.uuid4().hex
         asyncio.run(
@@ -2550,6 +2642,191 @@ class TestMassPayments(LiveServerTestCase):
         assert balances3['deposit'] == 10000.0 - 1000.0
         assert balances3['reserved'] == 0.0
 
+        # 3. Balance matches ledger projection
+        merchant = self._load_merchant_account()
+        stored, projected = asyncio.run(
+            MassPaymentAssetsResource.verify_balances(merchant)
+        )
+        assert stored == projected == MassPaymentAssetsResource.to_fixed(9000)
+
+    def test_concurrent_balance_updates(self):
+        merchant = self._load_merchant_account()
+        MassPaymentAssetsResource.set_balances(merchant, 0, 0)
+        workers, repeats = 16, 25
+
+        def _pay():
+            try:
+                for _ in range(repeats):
+                    with transaction.atomic():
+                        MassPaymentAssetsResource.update_balances(
+                            merchant, 0.1, 0.01
+                        )
+            finally:
+                connection.close()
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(_pay) for _ in range(workers)]
+            for fut in futures:
+                fut.result()
+
+        recs = {
+            rec.type: rec.value
+            for rec in MassPaymentBalance.objects.filter(
+                account_uid=merchant.uid
+            )
+        }
+        total = workers * repeats
+        # без потерянных обновлений и без накопленной ошибки float
+        assert recs[MassPaymentAssetsResource.TYPE_DEPOSIT] == MassPaymentAssetsResource.to_fixed('0.1') * total  # noqa
+        assert recs[MassPaymentAssetsResource.TYPE_RESERVED] == MassPaymentAssetsResource.to_fixed('0.01') * total  # noqa
+
+    def test_assets_cache(self):
+        merchant = self._load_merchant_account()
+        MassPaymentAssetsResource.set_balances(merchant, 100, 10)
+        asyncio.run(MassPaymentAssetsResource.invalidate_assets(merchant))
+
+        def _read_assets() -> dict:
+            resp = requests.get(
+                self.live_server_url + f'/api/mass-payments/assets',
+                headers=self.headers
+            )
+            assert resp.status_code == 200
+            return resp.json()
+
+        assets1 = _read_assets()
+        assert assets1['deposit'] == 100.0
+        assert assets1['reserved'] == 10.0
+        assert assets1['balance'] == 90.0
+        # изменение мимо API не видно до истечения TTL или инвалидации
+        MassPaymentAssetsResource.update_balances(merchant, 50, 0)
+        assert _read_assets()['deposit'] == 100.0
+        asyncio.run(MassPaymentAssetsResource.invalidate_assets(merchant))
+        assert _read_assets()['deposit'] == 150.0
+
+    def test_status_bulk(self):
+        root_token = uuid.uuid4().hex
+        asyncio.run(
+            create_superuser(
+                uid='test:root:status_bulk',
+                credentials=[TokenAuth.TokenCredential(token=root_token)]
+            )
+        )
+        root_access_header = {'Token': root_token}
+        count = 300
+        create = requests.post(
+            self.live_server_url + f'/api/mass-payments',
+            json=[
+                {
+                    'transaction': {
+                        'order_id': uuid.uuid4().hex,
+                        'description': 'Bulk',
+                        'amount': 1000.0,
+                        'currency': 'RUB'
+                    },
+                    'customer': {
+                        'identifier': f'user-{n}@example.com',
+                        'display_name': f'User {n}'
+                    },
+                    'card': {
+                        'number': '22001112200005555',
+                        'expiration_date': '10/30'
+                    }
+                } for n in range(count)
+            ],
+            headers=self.headers
+        )
+        assert create.status_code == 200
+        uids = [i['uid'] for i in create.json()]
+        base_url = self.live_server_url + f'/api/control-panel/{self.merchant.identity.did.root}/mass-payments'  # noqa
+
+        lines = [
+            json.dumps({'uid': uid, 'status': 'processing'}) for uid in uids
+        ]
+        lines.append(json.dumps({'uid': 'unknown', 'status': 'error'}))
+        lines.append('{"uid": "broken"')
+        started = time.perf_counter()
+        resp = requests.post(
+            base_url + '/status-bulk', data='\n'.join(lines).encode(),
+            headers={**root_access_header, 'Content-type': 'application/x-ndjson'}  # noqa
+        )
+        bulk_time = time.perf_counter() - started
+        assert resp.status_code == 200
+        rows = [json.loads(line) for line in resp.content.splitlines()]
+        assert [r['line'] for r in rows] == list(range(1, count + 3))
+        assert all(r['success'] for r in rows[:count])
+        assert rows[0]['status']['status'] == 'processing'
+        assert rows[0]['status']['order_id']
+        assert not rows[count]['success']
+        assert rows[count]['error'] == 'Payment not found'
+        assert not rows[count + 1]['success']
+
+        resp = requests.get(
+            base_url + f'/{uids[-1]}/status', headers=root_access_header
+        )
+        assert resp.json()['status'] == 'processing'
+
+        # вложения в payload статуса - в том же виде, что и у /status
+        attach_uid = uuid4().hex
+        resp = requests.post(
+            base_url + '/attachments',
+            json=[{'uid': attach_uid, 'name': 'Image.jpeg', 'data': DATA_URL_JPG}],  # noqa
+            headers=root_access_header
+        )
+        assert resp.status_code == 200
+        attachments = {'attachments': [{'uid': attach_uid}]}
+        resp = requests.post(
+            base_url + '/status-bulk',
+            data=json.dumps({
+                'uid': uids[0], 'status': 'processing', 'payload': attachments
+            }).encode(),
+            headers={**root_access_header, 'Content-type': 'application/x-ndjson'}  # noqa
+        )
+        assert json.loads(resp.content)['success']
+        resp = requests.post(
+            base_url + '/status',
+            json={'uid': uids[1], 'status': 'processing', 'payload': attachments},  # noqa
+            headers=root_access_header
+        )
+        assert resp.status_code == 200
+        shapes = [
+            txn.payload['status']['payload']['attachments']
+            for txn in DBLedgerTransaction.objects.filter(
+                payload__type='status', payload__uid__in=uids[:2],
+                payload__status__payload__isnull=False
+            )
+        ]
+        assert len(shapes) == 2
+        for shape in shapes:
+            assert len(shape) == 1
+            assert shape[0]['uid'] == attach_uid
+            assert shape[0]['name'] == 'Image.jpeg'
+            assert shape[0]['mime_type'] == 'image/jpeg'
+        assert set(shapes[0][0].keys()) == set(shapes[1][0].keys())
+
+        # прежний путь: один статус на запрос
+        started = time.perf_counter()
+        for uid in uids[:50]:
+            resp = requests.post(
+                base_url + '/status',
+                json={'uid': uid, 'status': 'success'},
+                headers=root_access_header
+            )
+            assert resp.status_code == 200
+        single_time = (time.perf_counter() - started) / 50
+        print(
+            f'status bulk: {count / bulk_time:.0f} rows/s, '
+            f'single: {1 / single_time:.0f} rows/s'
+        )
+
+    def _load_merchant_account(self):
+        merchants = asyncio.run(
+            AccountRepository.get_merchants(ignore_cache=True)
+        )
+        return [
+            m for m in merchants
+            if m.meta.identity.did.root == self.merchant.identity.did.root
+        ][0]
+
     def test_deposits_filtering(self):
         # Allocate root tokens
         root_token = uuid.uuid4().hex
@@ -2723,6 +3000,21 @@ class TestMassPayments(LiveServerTestCase):
             headers=root_access_header
         )
         assert export.status_code == 200
+        assert export.content[:2] == b'PK'
+
+        export = requests.get(
+            self.live_server_url + f'/api/control-panel/{self.merchant.identity.did.root}/mass-payments/export?engine=qugo&format=csv',
+            headers=root_access_header
+        )
+        assert export.status_code == 200
+        assert export.text.splitlines()[0].startswith('ФИО (*)')
+        assert 'attachment' in export.headers['Content-Disposition']
+
+        export = requests.get(
+            self.live_server_url + f'/api/control-panel/{self.merchant.identity.did.root}/mass-payments/export?engine=qugo&format=xml',
+            headers=root_access_header
+        )
+        assert export.status_code == 400
 
 
 class TestPaymentRequest(ExchangeLiveMixin, LiveServerTestCase):
@@ -3052,3 +3344,99 @@ class TestDirections(ExchangeLiveMixin, LiveServerTestCase):
             headers={'Token': root_token}
         )
         assert resp.status_code == 404
+
+
+class TestExternalRatios(ExchangeLiveMixin, LiveServerTestCase):
+
+    def setUp(self):
+        super().setUp()
+        direction = load_directions(self.cfg)[0]
+        ratio = EngineVariable(
+            id='test', rate=95.5, scope='forex', engine='ratios.ForexEngine',
+            src=direction.src.cur.symbol, dest=direction.dest.cur.symbol,
+            src_method=direction.src.code, dest_method=direction.dest.code,
+            direction=direction, utc=1700000000.0
+        )
+        engine = MerchantRatios(settings=MerchantRatios.Settings())
+        asyncio.run(engine._cache.set(
+            MerchantRatios.CACHE_KEY_RATIOS, [ratio.model_dump(mode='json')]
+        ))
+        asyncio.run(engine._cache.set(
+            MerchantRatios.CACHE_KEY_VERSION, uuid.uuid4().hex
+        ))
+
+    def test_etag(self):
+        for path in ['external', 'external.xml']:
+            url = self.live_server_url + f'/api/ratios/{path}'
+            resp = requests.get(url)
+            assert resp.status_code == 200
+            etag = resp.headers['ETag']
+            assert etag
+            assert resp.headers['Content-Encoding'] == 'gzip'
+
+            resp2 = requests.get(url, headers={'Accept-Encoding': 'identity'})
+            assert resp2.status_code == 200
+            assert resp2.content == resp.content
+            assert 'Content-Encoding' not in resp2.headers
+
+            resp3 = requests.get(url, headers={'If-None-Match': etag})
+            assert resp3.status_code == 304
+            assert resp3.headers['ETag'] == etag
+
+            resp4 = requests.get(url, headers={'If-None-Match': 'W/"other"'})
+            assert resp4.status_code == 200
+
+
+@pytest.mark.asyncio
+@pytest.mark.django_db
+class TestAuthDispatch:
+
+    ITERATIONS = 100
+
+    @classmethod
+    async def _legacy(cls, request):
+        # прежний перебор всех аутентификаторов
+        for auth in BaseAuth.Descendants:
+            account, session = await auth.auth(request)
+            if account:
+                return account, session
+        return None, None
+
+    async def test_benchmark(self):
+        account = Account(uid='auth-bench-' + uuid.uuid4().hex)
+        await AccountRepository.update_or_create(e=account, uid=account.uid)
+        token = uuid.uuid4().hex
+        await TokenAuth.register(account, {'token': token})
+        session = await AccountSessionRepository.create(
+            uid=uuid.uuid4().hex, class_name='LoginAuth',
+            account_uid=account.uid
+        )
+        anonymous = await AccountSessionRepository.create(
+            uid=uuid.uuid4().hex, class_name='AnonymousAuth',
+            account_uid=None
+        )
+        factory = RequestFactory()
+        cases = {
+            'none': factory.get('/'),
+            'token': factory.get('/', HTTP_TOKEN=token),
+            'session': factory.get('/'),
+            'anonymous': factory.get('/'),
+        }
+        cases['session'].COOKIES[BaseAuth.COOKIE_NAME] = session.uid
+        cases['anonymous'].COOKIES[BaseAuth.COOKIE_NAME] = anonymous.uid
+
+        for name, request in cases.items():
+            expected = await self._legacy(request)
+            actual = await authenticate(request)
+            assert (actual[0] and actual[0].uid) == (expected[0] and expected[0].uid)  # noqa
+
+            timings = {}
+            for label, func in [('legacy', self._legacy), ('dispatch', authenticate)]:  # noqa
+                started = time.perf_counter()
+                for _ in range(self.ITERATIONS):
+                    await func(request)
+                timings[label] = (time.perf_counter() - started) / self.ITERATIONS  # noqa
+            print(
+                f'auth {name}: legacy {timings["legacy"] * 1000:.3f} ms, '
+                f'dispatch {timings["dispatch"] * 1000:.3f} ms'
+            )
@@ -7,7 +7,9 @@ from entities import Currency, CashMethod
 from merchants.entities import (
     load_directions, Direction, Payment
 )
-from merchants import MerchantRatios, update_merchants_config
+from merchants import (
+    MerchantRatios, update_merchants_config, AggregationSettings, aggregate
+)
 
 
 @pytest.mark.asyncio
@@ -114,3 +116,56 @@ class TestMerchantUtils:
         await update_merchants_config(exchange_config)
         # check update side-effects
         await update_merchants_config(exchange_config)
+
+
+class TestAggregation:
+
+    @pytest.fixture
+    def prices(self) -> list:
+        return [100.0, 101.0, 102.0, 103.0, 1000.0]
+
+    def test_methods(self, prices: list):
+        mean = aggregate(prices, AggregationSettings(method='mean'))
+        assert mean == sum(prices) / len(prices)
+        median = aggregate(prices, AggregationSettings(method='median'))
+        assert median == 102.0
+        trimmed = aggregate(
+            prices, AggregationSettings(method='trimmed', trim=0.2)
+        )
+        assert trimmed == 102.0
+        # выброс с большим объемом отсекается до взвешивания
+        vwap = aggregate(
+            prices, AggregationSettings(method='vwap', trim=0.2),
+            weights=[1.0, 1.0, 3.0, 1.0, 100.0]
+        )
+        assert vwap == 102.0
+        # без весов vwap равен усеченному среднему
+        vwap = aggregate(
+            prices, AggregationSettings(method='vwap', trim=0.2)
+        )
+        assert vwap == trimmed
+        assert aggregate([1.0, 2.0, 3.0, 4.0], AggregationSettings(method='median')) == 2.5  # noqa
+        assert aggregate([], AggregationSettings(method='median')) is None
+
+    def test_settings(self):
+        settings = MerchantRatios.Settings.model_validate(
+            {'p2p': {'aggregation': {'method': 'median'}}}
+        )
+        assert settings.p2p.aggregation.method == 'median'
+        assert settings.forex.aggregation.method == 'mean'
+
+    def test_twenty_quotes(self):
+        # 20 котировок с одним выбросом, объем - только у выброса и у 4.0
+        prices = [float(v) for v in range(1, 20)] + [100.0]
+        volumes = [1.0] * 20
+        volumes[3] = 5.0
+        volumes[-1] = 100.0
+        results = {
+            method: aggregate(
+                prices, AggregationSettings(method=method), weights=volumes
+            )
+            for method in ['mean', 'median', 'trimmed', 'vwap']
+        }
+        assert results == {
+            'mean': 14.5, 'median': 10.5, 'trimmed': 10.5, 'vwap': 9.2
+        }
@@ -1,23 +1,99 @@
+import asyncio
+import time
+import uuid
+
 import pytest
 
 from entities import ExchangeConfig
 
 from context import Context
+from exchange.models import MassPaymentPayout as DBMassPaymentPayout, \
+    StorageItem as DBStorageItem, LedgerTransaction as DBLedgerTransaction, \
+    LedgerParticipant as DBLedgerParticipant, \
+    LedgerCheckpoint as DBLedgerCheckpoint, \
+    LedgerSnapshot as DBLedgerSnapshot, \
+    PaymentRequestState as DBPaymentRequestState
 from entities import Currency, CashMethod
 from merchants.entities import (
     load_directions, Direction, Payment
 )
 from merchants import MerchantRatios, update_merchants_config
 from microledger import (
-    MassPaymentMicroLedger, DatabasePaymentConsensus
+    MassPaymentMicroLedger, DatabasePaymentConsensus,
+    IndexedPaymentConsensus, ChainedPaymentConsensus, KeyRing, Signer,
+    PaymentRequestMicroLedger, PaymentRequestContract
+)
+from microledger.chain import (
+    GENESIS_HASH, BatchVerifier, entry_hash, merkle_root
 )
 from entities import (
     ExchangeConfig, Account, MerchantMeta, Identity, DIDSettings,
-    mass_payment
+    mass_payment, PaymentRequest, PaymentDetails, CardDetails
 )
 from context import Context
 
 
+class TestHashChain:
+    """Офлайн-стенд: цепочка и подписи без БД"""
+
+    @staticmethod
+    def _build_chain(signer: Signer, count: int):
+        prev, entries = GENESIS_HASH, []
+        for seq in range(count):
+            payload = {'uid': f'p-{seq}', 'amount': seq * 1.5}
+            h = entry_hash(prev, seq, 'ledger', 'did:web:a', [], payload)
+            entries.append((signer.verkey, signer.sign(h.encode()), h))
+            prev = h
+        return entries
+
+    def test_chain_and_merkle(self):
+        signer = Signer.generate()
+        entries = self._build_chain(signer, 5)
+        hashes = [h for _, _, h in entries]
+        # хеш зависит от предыдущей записи и содержимого
+        assert hashes[1] == entry_hash(
+            hashes[0], 1, 'ledger', 'did:web:a', [],
+            {'uid': 'p-1', 'amount': 1.5}
+        )
+        assert hashes[1] != entry_hash(
+            hashes[0], 1, 'ledger', 'did:web:a', [],
+            {'uid': 'p-1', 'amount': 2.5}
+        )
+        assert merkle_root(hashes) == merkle_root(list(hashes))
+        assert merkle_root(hashes) != merkle_root(hashes[:4])
+        assert Signer.from_seed(signer.seed).verkey == signer.verkey
+
+        verifier = BatchVerifier()
+        items = [(v, sig, h.encode()) for v, sig, h in entries]
+        assert verifier.verify(items) is None
+        forged = Signer.generate()
+        items[3] = (
+            signer.verkey, forged.sign(hashes[3].encode()), items[3][2]
+        )
+        assert verifier.verify(items) == 3
+
+    def test_sign_verify_throughput(self):
+        signer = Signer.generate()
+        count = 2000
+        started = time.perf_counter()
+        entries = self._build_chain(signer, count)
+        sign_time = time.perf_counter() - started
+        started = time.perf_counter()
+        failed = BatchVerifier().verify(
+            (v, sig, h.encode()) for v, sig, h in entries
+        )
+        verify_time = time.perf_counter() - started
+        assert failed is None
+        started = time.perf_counter()
+        merkle_root([h for _, _, h in entries])
+        merkle_time = time.perf_counter() - started
+        print(
+            f'hash+sign {count / sign_time:.0f}/s, '
+            f'verify {count / verify_time:.0f}/s, '
+            f'merkle root of {count} in {merkle_time * 1000:.2f} ms'
+        )
+
+
 @pytest.mark.asyncio
 @pytest.mark.django_db
 class TestMassPaymentMicroledgers:
@@ -197,3 +273,483 @@ class TestMassPaymentMicroledgers:
             count, payments = await ledger.load_payments()
             assert count == 1
             assert payments[0].status.status == 'success'
+
+    async def test_projection_runs_once(
+        self, exchange_config: ExchangeConfig,
+        merchant: Account, me: Identity,
+        msg1: MassPaymentMicroLedger.Message, monkeypatch
+    ):
+        calls = []
+        atomic = MassPaymentMicroLedger.PayoutsProjection.atomic
+
+        def _counted(self, *args, **kwargs):
+            calls.append(len(self.txns))
+            atomic(self, *args, **kwargs)
+
+        monkeypatch.setattr(
+            MassPaymentMicroLedger.PayoutsProjection, 'atomic', _counted
+        )
+        with Context.create_context(config=exchange_config, user=merchant):
+            # длинный ID на основе DID укладывается в проекцию
+            ledger = MassPaymentMicroLedger.create_type_for(
+                id_=me.did.root + ':' + 'x' * 300
+            )(participants=[me.did.root, 'did:web:ruswift.ru'],
+              consensus_cls=DatabasePaymentConsensus)
+            msgs = []
+            for n in range(3):
+                msg = msg1.model_copy(deep=True)
+                msg.uid = f'p-{n}'
+                msgs.append(msg)
+            # проекция пишется один раз на пакет, с состояниями и без
+            await ledger.send_batch(
+                msgs=msgs, states={m.uid: 'pending' for m in msgs}
+            )
+            assert calls == [3]
+            msg = msg1.model_copy(deep=True)
+            msg.uid = 'p-3'
+            await ledger.send_batch(msgs=[msg])
+            assert calls == [3, 1]
+            count, _ = await ledger.load_payments()
+            assert count == 4
+
+    async def test_payouts_projection(
+        self, exchange_config: ExchangeConfig,
+        merchant: Account, me: Identity
+    ):
+        def _payout(uid: str, order_id: str, identifier: str):
+            return MassPaymentMicroLedger.Message(
+                uid=uid,
+                transaction=mass_payment.PaymentTransaction(
+                    order_id=order_id, amount=1000, currency='RUB'
+                ),
+                customer=mass_payment.PaymentCustomer(
+                    identifier=identifier, display_name=identifier
+                ),
+                card=mass_payment.PaymentCard(
+                    number='2200111144445555', expiration_date='11/30'
+                )
+            )
+
+        def _status(uid: str, status: str):
+            return MassPaymentMicroLedger.Message(
+                uid=uid, type='status',
+                status=mass_payment.PaymentStatus(status=status)
+            )
+
+        with Context.create_context(config=exchange_config, user=merchant):
+            ledger = MassPaymentMicroLedger(
+                participants=[
+                    me.did.root, 'did:web:ruswift.ru'
+                ],
+                consensus_cls=DatabasePaymentConsensus
+            )
+            await ledger.send_batch(
+                msgs=[
+                    _payout('p1', 'order-1', 'a@example.com'),
+                    _payout('p2', 'order-2', 'b@example.com'),
+                    _status('p1', 'processing')
+                ]
+            )
+            await ledger.send_batch(msgs=[_status('p2', 'success')])
+            # attachment не меняет текущий статус
+            await ledger.send_batch(msgs=[_status('p2', 'attachment')])
+
+            rows = {
+                r.uid: r async for r in DBMassPaymentPayout.objects.filter(
+                    ledger_id=ledger.ID
+                )
+            }
+            assert rows['p1'].status == 'processing'
+            assert rows['p2'].status == 'success'
+            assert rows['p2'].order_id == 'order-2'
+            assert rows['p2'].identifier == 'b@example.com'
+            assert rows['p2'].amount == 1000
+
+            count, payments = await ledger.load_payments(sort='desc')
+            assert count == 2
+            assert [p.uid for p in payments] == ['p2', 'p1']
+            assert payments[0].status.status == 'success'
+            count, payments = await ledger.load_payments(status='processing')
+            assert count == 1
+            assert payments[0].uid == 'p1'
+            count, payments = await ledger.load_payments(
+                identifier='b@example.com'
+            )
+            assert count == 1
+            assert payments[0].transaction.order_id == 'order-2'
+            count, payments = await ledger.load_payments(
+                order_id=['order-1', 'order-2'], limit=1
+            )
+            assert count == 2
+            assert len(payments) == 1
+
+    async def test_indexed_consensus(
+        self, exchange_config: ExchangeConfig,
+        merchant: Account, me: Identity,
+        msg1: MassPaymentMicroLedger.Message,
+        msg2: MassPaymentMicroLedger.Message,
+        status2: MassPaymentMicroLedger.Message
+    ):
+        participants = [me.did.root, 'did:web:ruswift.ru']
+        with Context.create_context(config=exchange_config, user=merchant):
+            ledger = MassPaymentMicroLedger(
+                participants=participants,
+                consensus_cls=IndexedPaymentConsensus
+            )
+            await ledger.send_batch(msgs=[msg1, msg2])
+            await ledger.send_batch(msgs=[status2])
+
+            # каждая транзакция хранится один раз, копий по участникам нет
+            assert await DBLedgerTransaction.objects.filter(
+                ledger_id=ledger.ID
+            ).acount() == 3
+            assert await DBStorageItem.objects.filter(
+                category=ledger.ID
+            ).acount() == 0
+            members = await DBLedgerParticipant.objects.filter(
+                txn__ledger_id=ledger.ID
+            ).values_list('did', flat=True).distinct().acount()
+            assert members >= len(participants)
+
+            count, items = await ledger.load(type_='payout')
+            assert count == 2
+            assert items[0].transaction.order_id == msg2.transaction.order_id
+            assert items[1].transaction.order_id == msg1.transaction.order_id
+            count, items = await ledger.load(
+                order_id=msg1.transaction.order_id
+            )
+            assert count == 1
+            count, items = await ledger.load(identifier='demo@example.com')
+            assert count == 1
+
+            # транзакции видны только участникам леджера
+            outsider = IndexedPaymentConsensus(
+                me='did:web:outsider', participants=[]
+            )
+            count, _ = await outsider.read(ledger_id=ledger.ID)
+            assert count == 0
+            visitor = IndexedPaymentConsensus(
+                me='did:web:ruswift.ru', participants=[]
+            )
+            count, _ = await visitor.read(ledger_id=ledger.ID)
+            assert count == 3
+
+    async def test_consensus_benchmark(
+        self, exchange_config: ExchangeConfig,
+        merchant: Account, me: Identity,
+        msg1: MassPaymentMicroLedger.Message
+    ):
+        participants = [me.did.root, 'did:web:ruswift.ru', 'did:web:guarantor']
+        batches, batch_size = 20, 50
+        ledger_ids = {}
+        with Context.create_context(config=exchange_config, user=merchant):
+            for consensus_cls in [
+                DatabasePaymentConsensus, IndexedPaymentConsensus
+            ]:
+                ledger = MassPaymentMicroLedger.create_type_for(
+                    id_=uuid.uuid4().hex
+                )(participants=participants, consensus_cls=consensus_cls)
+                started = time.perf_counter()
+                for n in range(batches):
+                    msgs = []
+                    for i in range(batch_size):
+                        msg = msg1.model_copy(deep=True)
+                        msg.uid = f'{n}-{i}'
+                        msgs.append(msg)
+                    await ledger.send_batch(msgs=msgs)
+                write_time = time.perf_counter() - started
+                started = time.perf_counter()
+                for _ in range(10):
+                    count, items = await ledger.load(limit=100)
+                    assert count == batches * batch_size
+                read_time = (time.perf_counter() - started) / 10
+                ledger_ids[consensus_cls.__name__] = ledger.ID
+                total = batches * batch_size
+                print(
+                    f'{consensus_cls.__name__}: '
+                    f'write {total / write_time:.0f} txn/s, '
+                    f'read page of 100 {read_time * 1000:.2f} ms'
+                )
+        # индексированный леджер хранит транзакцию один раз
+        payload_rows = await DBLedgerTransaction.objects.filter(
+            ledger_id=ledger_ids['IndexedPaymentConsensus']
+        ).acount()
+        assert payload_rows == batches * batch_size
+
+    async def test_chained_consensus(
+        self, exchange_config: ExchangeConfig,
+        merchant: Account, me: Identity,
+        msg1: MassPaymentMicroLedger.Message,
+        monkeypatch
+    ):
+        monkeypatch.setattr(ChainedPaymentConsensus, 'CHECKPOINT_SIZE', 4)
+        KeyRing.register(me.did.root, Signer.generate())
+        with Context.create_context(config=exchange_config, user=merchant):
+            ledger = MassPaymentMicroLedger(
+                participants=[me.did.root, 'did:web:ruswift.ru'],
+                consensus_cls=ChainedPaymentConsensus
+            )
+            for n in range(3):
+                msgs = []
+                for i in range(3):
+                    msg = msg1.model_copy(deep=True)
+                    msg.uid = f'{n}-{i}'
+                    msgs.append(msg)
+                await ledger.send_batch(msgs=msgs)
+            count, _ = await ledger.load()
+            assert count == 9
+
+            seqs = [
+                seq async for seq in DBLedgerTransaction.objects.filter(
+                    ledger_id=ledger.ID
+                ).order_by('pk').values_list('seq', flat=True)
+            ]
+            assert seqs == list(range(9))
+            checkpoints = [
+                cp.seq_to async for cp in DBLedgerCheckpoint.objects.filter(
+                    ledger_id=ledger.ID
+                ).order_by('seq_to')
+            ]
+            assert checkpoints == [3, 7]
+
+            consensus: ChainedPaymentConsensus = ledger.consensus
+            assert await consensus.verify(ledger.ID) == (True, None, 8)
+            assert await consensus.verify(ledger.ID, full=True) == (True, None, 8)  # noqa
+
+            # подмена содержимого в хвосте ломает цепочку
+            row = await DBLedgerTransaction.objects.aget(
+                ledger_id=ledger.ID, seq=8
+            )
+            row.payload['transaction']['amount'] = 1
+            await row.asave()
+            ok, err, verified = await consensus.verify(ledger.ID)
+            assert not ok and verified == 7
+            assert 'seq 8' in err
+
+            # подмена в истории видна только при полной проверке
+            row = await DBLedgerTransaction.objects.aget(
+                ledger_id=ledger.ID, seq=1
+            )
+            row.payload['transaction']['amount'] = 1
+            await row.asave()
+            ok, err, verified = await consensus.verify(ledger.ID, full=True)
+            assert not ok and verified == 0
+
+            # без зарегистрированного ключа записать нельзя
+            stranger = ChainedPaymentConsensus(
+                me='did:web:stranger', participants=[]
+            )
+            ok, err = await stranger.propagate([])
+            assert ok
+            txns = (await consensus.read(ledger_id=ledger.ID, limit=1))[1]
+            ok, err = await stranger.propagate(txns)
+            assert not ok and 'not registered' in err
+
+    async def test_deposits_snapshot(
+        self, exchange_config: ExchangeConfig,
+        merchant: Account, me: Identity, monkeypatch
+    ):
+        monkeypatch.setattr(MassPaymentMicroLedger, 'SNAPSHOT_EVERY', 3)
+        monkeypatch.setattr(MassPaymentMicroLedger, 'SNAPSHOT_LAG', 0)
+
+        def _deposit(uid: str, status: str, attachment: str = None):
+            msg = MassPaymentMicroLedger.Message(
+                uid=uid, type='deposit',
+                transaction=mass_payment.PaymentTransaction(
+                    order_id=uid, amount=100, currency='USDT'
+                ),
+                status=mass_payment.PaymentStatus(status=status)
+            )
+            if attachment:
+                msg.status.payload = {
+                    'attachments': [{'uid': attachment, 'name': attachment}]
+                }
+            return msg
+
+        def _full_fold(msgs):
+            state = {}
+            for msg in msgs:
+                MassPaymentMicroLedger._fold_deposit(state, msg)
+            return [m.model_dump(mode='json') for m in state.values()]
+
+        with Context.create_context(config=exchange_config, user=merchant):
+            ledger = MassPaymentMicroLedger(
+                participants=[me.did.root, 'did:web:ruswift.ru'],
+                consensus_cls=IndexedPaymentConsensus
+            )
+            await ledger.send_batch(
+                msgs=[
+                    _deposit('d1', 'pending', 'a1'),
+                    _deposit('d2', 'pending'),
+                    _deposit('d1', 'attachment', 'a2'),
+                    _deposit('d3', 'pending')
+                ],
+                states={'d1': 'attachment', 'd2': 'pending', 'd3': 'pending'}
+            )
+            deposits = await ledger.load_deposits(aggregate=True)
+            assert [d.uid for d in deposits] == ['d1', 'd2', 'd3']
+            assert [
+                a['uid'] for a in deposits[0].status.payload['attachments']
+            ] == ['a1', 'a2']
+            snapshot = await DBLedgerSnapshot.objects.aget(
+                ledger_id=ledger.ID, reader=me.did.root, kind='deposits'
+            )
+            first_position = snapshot.position
+            assert len(snapshot.state) == 3
+
+            # после снимка применяются только новые сообщения
+            await ledger.send_batch(
+                msgs=[
+                    _deposit('d2', 'success', 'a3'),
+                    _deposit('d1', 'success')
+                ],
+                states={'d1': 'success', 'd2': 'success'}
+            )
+            deposits = await ledger.load_deposits(aggregate=True)
+            raw = await ledger.load_deposits(aggregate=False)
+            assert [
+                d.model_dump(mode='json') for d in deposits
+            ] == _full_fold(raw)
+            assert deposits[0].status.status == 'success'
+            assert [
+                a['uid'] for a in deposits[0].status.payload['attachments']
+            ] == ['a1', 'a2']
+            snapshot = await DBLedgerSnapshot.objects.aget(
+                ledger_id=ledger.ID, reader=me.did.root, kind='deposits'
+            )
+            assert snapshot.position == first_position
+
+            deposits = await ledger.load_deposits(aggregate=True, uid='d2')
+            assert len(deposits) == 1
+            assert deposits[0].status.status == 'success'
+            deposits = await ledger.load_deposits(
+                aggregate=True, status='pending'
+            )
+            assert [d.uid for d in deposits] == ['d3']
+
+    async def test_load_many_ledgers(
+        self, exchange_config: ExchangeConfig,
+        merchant: Account, me: Identity,
+        msg1: MassPaymentMicroLedger.Message,
+        msg2: MassPaymentMicroLedger.Message
+    ):
+        participants = [me.did.root, 'did:web:ruswift.ru']
+        with Context.create_context(config=exchange_config, user=merchant):
+            ledgers = []
+            for n in range(3):
+                ledger = MassPaymentMicroLedger.create_type_for(
+                    id_=f'batch-{n}-' + uuid.uuid4().hex
+                )(participants=list(participants),
+                  consensus_cls=IndexedPaymentConsensus)
+                payout1 = msg1.model_copy(deep=True)
+                payout1.uid = f'p1-{n}'
+                payout1.status.status = 'processing'
+                payout2 = msg2.model_copy(deep=True)
+                payout2.uid = f'p2-{n}'
+                deposit = MassPaymentMicroLedger.Message(
+                    uid=f'd-{n}', type='deposit',
+                    transaction=mass_payment.PaymentTransaction(
+                        order_id=f'd-{n}', amount=10, currency='USDT'
+                    ),
+                    status=mass_payment.PaymentStatus(status='pending')
+                )
+                await ledger.send_batch(
+                    msgs=[payout1, payout2, deposit],
+                    states={deposit.uid: 'pending'}
+                )
+                ledgers.append(ledger)
+            ids = [ledger.ID for ledger in ledgers]
+
+            payments = await MassPaymentMicroLedger.load_payments_many(
+                ledger_ids=ids, status='processing'
+            )
+            deposits = await MassPaymentMicroLedger.load_deposits_many(
+                ledgers[0].consensus, ledger_ids=ids, status='pending'
+            )
+            messages = await MassPaymentMicroLedger.load_many(
+                ledgers[0].consensus,
+                uid={i: [p.uid for p in items] for i, items in payments.items()}
+            )
+            for ledger in ledgers:
+                _, expected = await ledger.load_payments(status='processing')
+                assert [p.uid for p in payments[ledger.ID]] == [
+                    p.uid for p in expected
+                ]
+                expected = await ledger.load_deposits(
+                    aggregate=True, status='pending'
+                )
+                assert [
+                    d.model_dump(mode='json') for d in deposits[ledger.ID]
+                ] == [d.model_dump(mode='json') for d in expected]
+                _, expected = await ledger.load(
+                    uid=[p.uid for p in payments[ledger.ID]]
+                )
+                assert len(messages[ledger.ID]) == len(expected) == 1
+
+
+@pytest.mark.asyncio
+@pytest.mark.django_db
+class TestPaymentRequestContract:
+
+    @pytest.fixture
+    def me(self) -> Identity:
+        return Identity(did=DIDSettings(root='did:web:ruswift.ru:test'))
+
+    async def test_transitions(self, me: Identity):
+        dlt = PaymentRequestMicroLedger.create_type_for(uuid.uuid4().hex)(
+            participants=['did:web:ruswift.ru'],
+            consensus_cls=DatabasePaymentConsensus, me=me
+        )
+        order = PaymentRequest(
+            uid=uuid.uuid4().hex, id='1', customer='Customer',
+            amount=1000, currency='RUB',
+            details=PaymentDetails(payment_ttl=60)
+        )
+        await dlt.contract.create(order)
+        state = await DBPaymentRequestState.objects.aget(
+            ledger_id=dlt.ledger_id()
+        )
+        assert sorted(state.participants) == sorted(dlt.participants)
+        assert state.version == 1
+
+        linked = await dlt.contract.link_client('client')
+        assert linked.status == 'linked'
+        assert linked.linked_client == 'client'
+        with pytest.raises(ValueError):
+            await dlt.contract.link_client('other')
+        with pytest.raises(ValueError):
+            await dlt.contract.mark_payed()
+
+        # конкурентные переходы: выигрывает ровно один
+        results = await asyncio.gather(
+            dlt.contract.mark_ready(), dlt.contract.mark_ready(),
+            return_exceptions=True
+        )
+        assert len([r for r in results if isinstance(r, ValueError)]) == 1
+
+        waiting = await dlt.contract.wait_payment(
+            PaymentDetails(
+                payment_ttl=60, card=CardDetails(number='4111111111111111')
+            )
+        )
+        assert waiting.status == 'wait'
+        assert waiting.details.active_until > waiting.details.payment_ttl
+        assert (await dlt.contract.fetch()).model_dump() == waiting.model_dump()  # noqa
+        state = await DBPaymentRequestState.objects.aget(
+            ledger_id=dlt.ledger_id()
+        )
+        assert state.status == 'wait'
+        assert state.version == 4
+
+        ids = await PaymentRequestMicroLedger.fetch_ledger_ids(
+            me=me, status=['wait']
+        )
+        assert dlt.ledger_id() in ids
+        many = await PaymentRequestContract.fetch_many(
+            me, [dlt.ledger_id()]
+        )
+        assert many[dlt.ledger_id()].status == 'wait'
+        stranger = Identity(did=DIDSettings(root='did:web:stranger'))
+        assert await PaymentRequestContract.fetch_many(
+            stranger, [dlt.ledger_id()]
+        ) == {}
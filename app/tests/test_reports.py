@@ -1,6 +1,6 @@
 import pytest
 
-from reports import QugoRegistry
+from reports import QugoRegistry, PDFReport, PDFRenderService
 from microledger import MassPaymentMicroLedger
 
 
@@ -31,3 +31,42 @@ class TestReports:
 
         buffer = await reporter.export_to_buffer()
         assert buffer
+        assert buffer[:2] == b'PK'
+
+        async def _chunks():
+            yield payments[:1]
+            yield payments[1:]
+
+        reporter = QugoRegistry(payments=_chunks())
+        csv_ = b''.join([chunk async for chunk in reporter.stream('csv')])
+        lines = csv_.decode().splitlines()
+        assert len(lines) == 3
+        assert lines[1] == 'Ivan Sidorov,22001112200005555,10000.0,Test description'  # noqa
+
+    async def test_pdf_render_memoized(self, monkeypatch):
+        name = 'deposit.mass-payments.j2'
+        data = {'title': 'Счет #1'}
+        calls = []
+
+        def _pool(cls):
+            calls.append(cls)
+            # executor event-loop по умолчанию, без пула процессов
+            return None
+
+        PDFRenderService.shutdown()
+        monkeypatch.setattr(PDFRenderService, '_pool', classmethod(_pool))
+        try:
+            doc = await PDFRenderService.render(name, data=data)
+            assert doc.startswith(b'%PDF')
+            assert len(calls) == 1
+            key = PDFRenderService.document_key(name, data)
+            assert key in PDFRenderService._documents
+
+            again = await PDFRenderService.render(name, data=dict(data))
+            assert again == doc
+            assert len(calls) == 1
+
+            with pytest.raises(RuntimeError):
+                PDFReport().from_jinja_template('unknown.j2')
+        finally:
+            PDFRenderService.shutdown()
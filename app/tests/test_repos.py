@@ -1,4 +1,6 @@
 import asyncio
+import datetime
+import time
 import uuid
 from typing import Optional, Tuple, List, Any
 
@@ -9,18 +11,22 @@ from django.db import IntegrityError
 from cache import Cache
 from core import utc_now_float
 from exchange.models import (
-    Currency as DBCurrency, KYCPhoto as DBKYCPhoto
+    Currency as DBCurrency, KYCPhoto as DBKYCPhoto, Session as DBSession,
+    Credential as DBCredential, Account as DBAccount,
+    StorageItem as DBStorageItem
 )
 from entities import (
     Currency, Account, DocumentPhoto, SelfiePhoto, Session,
-    StorageItem, AccountKYC, VerifiedDocument
+    StorageItem, AccountKYC, VerifiedDocument, Identity, Ledger, DIDSettings
 )
 from reposiroty import (
     BaseEntityRepository, ExchangeConfigRepository,
     CorrectionRepository, PaymentRepository, KYCPhotoRepository,
     AccountRepository, AccountSessionRepository, AccountCredentialRepository,
-    StorageRepository, CurrencyRepository
+    StorageRepository, CurrencyRepository, LedgerRepository
 )
+from api.auth import TokenAuth
+from context import Context
 
 
 class TestEntityRepository(BaseEntityRepository):
@@ -174,6 +180,125 @@ class TestConfigRepo:
         for n in range(3):
             await ExchangeConfigRepository.get()
 
+    async def test_config_version(self):
+        await ExchangeConfigRepository.invalidate_cache()
+        await ExchangeConfigRepository.init_from_yaml(
+            '/workspaces/ruswift/tests/files/init.example.yml', 'exchange'
+        )
+        cfg1 = await ExchangeConfigRepository.get()
+        assert cfg1.version
+        # из кеша приходит тот же отпечаток
+        cfg2 = await ExchangeConfigRepository.get()
+        assert cfg2.version == cfg1.version
+
+        await ExchangeConfigRepository.invalidate_cache()
+        await CurrencyRepository.update_or_create(
+            e=cfg1.currencies[0].model_copy(update={'icon': 'changed'}),
+            symbol=cfg1.currencies[0].symbol
+        )
+        cfg3 = await ExchangeConfigRepository.get()
+        assert cfg3.version != cfg1.version
+
+    async def test_set_diff(self):
+        await ExchangeConfigRepository.invalidate_cache()
+        await ExchangeConfigRepository.init_from_yaml(
+            '/workspaces/ruswift/tests/files/init.example.yml', 'exchange'
+        )
+        cfg1 = await ExchangeConfigRepository.get()
+
+        # повторная запись того же конфига ничего не меняет
+        await ExchangeConfigRepository.set(cfg1.model_copy(deep=True))
+        cfg2 = await ExchangeConfigRepository.get()
+        assert cfg2.version == cfg1.version
+
+        cfg = cfg1.model_copy(deep=True)
+        changed = cfg.currencies[0]
+        changed.icon = 'changed'
+        removed = cfg.directions.pop()
+        await ExchangeConfigRepository.set(cfg)
+        cfg3 = await ExchangeConfigRepository.get()
+        assert cfg3.version != cfg1.version
+        assert [
+            c.icon for c in cfg3.currencies
+            if (c.symbol, c.owner_did) == (changed.symbol, changed.owner_did)
+        ] == ['changed']
+        # без prune отсутствующие в конфиге строки остаются
+        assert len(cfg3.directions) == len(cfg1.directions)
+
+        await ExchangeConfigRepository.set(cfg, prune=True)
+        cfg4 = await ExchangeConfigRepository.get()
+        assert len(cfg4.directions) == len(cfg1.directions) - 1
+        assert (removed.src, removed.dest) not in {
+            (d.src, d.dest) for d in cfg4.directions
+        }
+
+        cfg.payments[0].cur = 'UNKNOWN'
+        with pytest.raises(RuntimeError):
+            await ExchangeConfigRepository.set(cfg)
+
+    async def test_current_config(self):
+        await ExchangeConfigRepository.invalidate_cache()
+        await ExchangeConfigRepository.init_from_yaml(
+            '/workspaces/ruswift/tests/files/init.example.yml', 'exchange'
+        )
+        cfg1 = await ExchangeConfigRepository.current()
+        cfg2 = await ExchangeConfigRepository.current()
+        # в пределах интервала проверки отдается тот же объект
+        assert cfg2 is cfg1
+
+        # версия не менялась - объект переиспользуется и после проверки
+        ExchangeConfigRepository._current_checked_at = 0
+        cfg3 = await ExchangeConfigRepository.current()
+        assert cfg3 is cfg1
+
+        await ExchangeConfigRepository.invalidate_cache()
+        cfg4 = await ExchangeConfigRepository.current()
+        assert cfg4 is not cfg1
+        assert cfg4.version == cfg1.version
+
+
+@pytest.mark.asyncio
+@pytest.mark.django_db
+class TestDataLoader:
+
+    async def test_batching(self, monkeypatch):
+        uids = [uuid.uuid4().hex for _ in range(3)]
+        await AccountRepository.create_many([Account(uid=u) for u in uids])
+
+        calls = []
+        load_batch = AccountRepository.load_batch
+
+        async def _counted(field, values):
+            calls.append(list(values))
+            return await load_batch(field, values)
+
+        monkeypatch.setattr(AccountRepository, 'load_batch', _counted)
+
+        with Context.create_context(config=None):
+            keys = uids + uids[:2] + ['unknown']
+            loaded = await AccountRepository.load_many(uid=keys)
+            assert [a.uid if a else None for a in loaded] == uids + uids[:2] + [None]  # noqa
+            # один запрос, ключи без повторов
+            assert len(calls) == 1
+            assert sorted(calls[0]) == sorted(uids + ['unknown'])
+
+            # повторное чтение из загрузчика
+            acc = await AccountRepository.load(uid=uids[0])
+            assert acc.uid == uids[0]
+            assert len(calls) == 1
+
+            # запись сбрасывает загрузчик репозитория
+            acc.is_active = False
+            await AccountRepository.update(acc, uid=acc.uid)
+            acc = await AccountRepository.load(uid=uids[0])
+            assert acc.is_active is False
+            assert len(calls) == 2
+
+        # вне контекста запроса - обычное чтение
+        acc = await AccountRepository.load(uid=uids[1])
+        assert acc.uid == uids[1]
+        assert len(calls) == 2
+
 
 @pytest.mark.asyncio
 @pytest.mark.django_db
@@ -259,6 +384,37 @@ class TestKYCPhotoRepo:
 @pytest.mark.django_db
 class TestAccountRepo:
 
+    async def test_read_through_cache(self):
+        uid = uuid.uuid4().hex
+        await AccountRepository.update_or_create(e=Account(uid=uid), uid=uid)
+        e1 = await AccountRepository.get(uid=uid)
+        assert e1.is_verified is False
+
+        # запись в обход репозитория не видна, пока жив кеш
+        await DBAccount.objects.filter(uid=uid).aupdate(is_verified=True)
+        e2 = await AccountRepository.get(uid=uid)
+        assert e2.is_verified is False
+
+        # запись через репозиторий меняет версию
+        e2.is_active = False
+        await AccountRepository.update(e2, uid=uid)
+        e3 = await AccountRepository.get(uid=uid)
+        assert e3.is_active is False
+        assert e3.is_verified is True
+
+        with Context.create_context(config=None):
+            e4 = await AccountRepository.get(uid=uid)
+            await DBAccount.objects.filter(uid=uid).aupdate(is_active=True)
+            await AccountRepository._cache.namespace('accounts').delete(
+                f'uid:{uid}'
+            )
+            # повторное чтение в запросе отдается из мемо
+            e5 = await AccountRepository.get(uid=uid)
+            assert e5.is_active == e4.is_active is False
+
+        await AccountRepository.delete(uid=uid)
+        assert await AccountRepository.get(uid=uid) is None
+
     async def test_sane(self):
         e1: Account = await AccountRepository.update_or_create(
             e=Account(
@@ -393,6 +549,61 @@ class TestAccountSessionRepo:
         session = await AccountSessionRepository.get(uid=session2.uid)
         assert session is None
 
+    async def test_access_write_behind(self, account: Account, monkeypatch):
+        await AccountRepository.update_or_create(
+            e=account, uid=account.uid
+        )
+        session: Session = await AccountSessionRepository.create(
+            uid='session-id' + uuid.uuid4().hex,
+            class_name='auth',
+            account_uid=account.uid
+        )
+        await AccountSessionRepository.flush_access()
+        await asyncio.sleep(0.5)
+        for n in range(5):
+            assert await AccountSessionRepository.get(uid=session.uid)
+        # чтения не пишут в БД, обращения копятся в памяти
+        stored = await DBSession.objects.aget(uid=session.uid)
+        assert stored.last_access_utc == session.last_access_utc
+        assert session.uid in AccountSessionRepository._pending_access
+
+        count = await AccountSessionRepository.flush_access()
+        assert count == 1
+        stored = await DBSession.objects.aget(uid=session.uid)
+        assert stored.last_access_utc > session.last_access_utc
+
+        # неудачная запись возвращает обращения в очередь
+        assert await AccountSessionRepository.get(uid=session.uid)
+        pending = AccountSessionRepository._pending_access[session.uid]
+
+        def _failed(*args, **kwargs):
+            raise RuntimeError('db is down')
+
+        monkeypatch.setattr(DBSession.objects, 'bulk_update', _failed)
+        with pytest.raises(RuntimeError):
+            await AccountSessionRepository.flush_access()
+        monkeypatch.undo()
+        assert AccountSessionRepository._pending_access[session.uid] == pending
+        assert await AccountSessionRepository.flush_access() == 1
+
+        # фоновая задача пишет обращения без участия чтений
+        AccountSessionRepository._access_flusher.cancel()
+        AccountSessionRepository._access_flusher = None
+        monkeypatch.setattr(
+            AccountSessionRepository, 'ACCESS_FLUSH_INTERVAL_SEC', 0.1
+        )
+        assert await AccountSessionRepository.get(uid=session.uid)
+        await asyncio.sleep(0.5)
+        assert AccountSessionRepository._pending_access == {}
+        assert AccountSessionRepository._access_flusher.done()
+        monkeypatch.undo()
+
+        # просроченная сессия не отдается, в т.ч. из кеша
+        session.kill_after_utc = datetime.datetime.utcnow() - datetime.timedelta(seconds=1)  # noqa
+        await AccountSessionRepository.update(e=session, uid=session.uid)
+        assert await AccountSessionRepository.get(uid=session.uid) is None
+        await AccountSessionRepository.delete(uid=session.uid)
+
 
 @pytest.mark.asyncio
 @pytest.mark.django_db
@@ -433,11 +644,120 @@ class TestAccountCredRepo:
         )
         assert count2 == 2
 
+    async def test_token_digest_benchmark(self, account: Account):
+        await AccountRepository.update_or_create(
+            e=account, uid=account.uid
+        )
+        token = uuid.uuid4().hex
+        cred = await TokenAuth.register(account, {'token': token})
+        stored = await DBCredential.objects.aget(account_uid=account.uid)
+        assert stored.digest == cred.payload['token']
+
+        async def _measure(iterations: int = 50) -> float:
+            started = time.perf_counter()
+            for _ in range(iterations):
+                await TokenAuth.invalidate_cache()
+                found, _ = await TokenAuth.auth({'token': token})
+                assert found and found.uid == account.uid
+            return (time.perf_counter() - started) / iterations
+
+        small = await _measure()
+        await DBCredential.objects.abulk_create([
+            DBCredential(
+                class_name='TokenAuth', account_uid=f'bench-{n}', schema={},
+                payload={'token': f'md5:{n}'}, digest=f'md5:{n}'
+            ) for n in range(10000)
+        ])
+        large = await _measure()
+        print(
+            f'token auth: {small * 1000:.3f} ms with 1 credential, '
+            f'{large * 1000:.3f} ms with 10k credentials'
+        )
+
+        # повторные и неверные токены обслуживаются из кеша
+        await TokenAuth.invalidate_cache()
+        await TokenAuth.auth({'token': token})
+        await TokenAuth.auth({'token': 'invalid'})
+        started = time.perf_counter()
+        for _ in range(1000):
+            await TokenAuth.auth({'token': token})
+            found, _ = await TokenAuth.auth({'token': 'invalid'})
+            assert found is None
+        cached = (time.perf_counter() - started) / 2000
+        print(f'token auth cached: {cached * 1000:.4f} ms')
+
+        # отзыв токена виден сразу, без ожидания TTL кеша
+        await TokenAuth.clean(account, only_sessions=False)
+        found, _ = await TokenAuth.auth({'token': token})
+        assert found is None
+        # деактивация аккаунта - тоже
+        await TokenAuth.register(account, {'token': token})
+        assert (await TokenAuth.auth({'token': token}))[0]
+        account.is_active = False
+        await AccountRepository.update(e=account, uid=account.uid)
+        found, _ = await TokenAuth.auth({'token': token})
+        assert found is not None and found.is_active is False
+
 
 @pytest.mark.asyncio
 @pytest.mark.django_db
 class TestStorageRepo:
 
+    async def test_materialize_benchmark(self, monkeypatch):
+        category = 'bench-' + uuid.uuid4().hex
+        await DBStorageItem.objects.abulk_create([
+            DBStorageItem(
+                uid=uuid.uuid4().hex, storage_id='bench', category=category,
+                tags=['a', 'b'], storage_ids=['bench'], signature='<empty>',
+                payload={'n': n, 'data': {'amount': n * 1.5, 'cur': 'RUB'}}
+            ) for n in range(10000)
+        ])
+
+        async def _measure():
+            started = time.perf_counter()
+            count, items = await StorageRepository.get_many(
+                order_by='pk', category=category
+            )
+            return time.perf_counter() - started, count, items
+
+        fast_time, count, fast = await _measure()
+        monkeypatch.setattr(StorageRepository, '_fast_materialize', False)
+        slow_time, _, slow = await _measure()
+        print(
+            f'10k StorageItem get_many: values+model_construct '
+            f'{fast_time:.3f} s, model_to_dict+validate {slow_time:.3f} s'
+        )
+        assert count == 10000
+        assert [e.model_dump() for e in fast] == [e.model_dump() for e in slow]
+
+    async def test_native_upsert(self, monkeypatch):
+        async def _forbidden(**filters):
+            raise AssertionError('unexpected select')
+
+        monkeypatch.setattr(StorageRepository, '_get_one', _forbidden)
+        uid = uuid.uuid4().hex
+        item = StorageItem(
+            uid=uid, storage_id='upsert', category='check', payload={'n': 1}
+        )
+        created = await StorageRepository.update_or_create(item, uid=uid)
+        assert created.uid == uid
+        assert created.payload == {'n': 1}
+        assert created.created_at
+
+        item.payload = {'n': 2}
+        item.tags = ['x']
+        updated = await StorageRepository.update_or_create(item, uid=uid)
+        assert updated.payload == {'n': 2}
+        assert updated.tags == ['x']
+        rows = [m async for m in DBStorageItem.objects.filter(uid=uid)]
+        assert len(rows) == 1
+        assert rows[0].payload == {'n': 2}
+
+        # фильтры без уникального ограничения - прежний путь через select
+        assert StorageRepository._conflict_columns({'category': 'check'}) is None  # noqa
+        assert StorageRepository._conflict_columns({'uid': None}) is None
+        assert AccountRepository._conflict_columns({'uid': uid}) is None
+
     async def test_sane(self):
         create = StorageItem(
             storage_id='babapay',
@@ -529,6 +849,75 @@ class TestStorageRepo:
         assert loaded.storage_ids == ['did:ruswift:merchant:babapay', 'did:ruswift:exchange']  # noqa
 
 
+@pytest.mark.asyncio
+@pytest.mark.django_db
+class TestLedgerRepo:
+
+    @staticmethod
+    def _identity(did: str) -> Identity:
+        return Identity(did=DIDSettings(root=did))
+
+    async def test_load_by_participant(self):
+        owner = self._identity('did:web:ruswift.ru:' + uuid.uuid4().hex)
+        processing = self._identity('did:web:processing:' + uuid.uuid4().hex)
+        stranger = self._identity('did:web:stranger:' + uuid.uuid4().hex)
+        ledger1 = Ledger(
+            id=owner.did.root + ':ledger1', tags=['payments'],
+            participants={
+                'owner': [owner.did.root], 'processing': [processing.did.root]
+            }
+        )
+        ledger2 = Ledger(
+            id=owner.did.root + ':ledger2', tags=['payment-request'],
+            participants={'owner': [owner.did.root]}
+        )
+        await LedgerRepository.ensure_exists(owner, [ledger1, ledger2])
+        row = await DBStorageItem.objects.aget(
+            category='identity-ledgers', uid=ledger1.id
+        )
+        assert row.storage_ids == sorted(
+            [owner.did.root, processing.did.root]
+        )
+
+        loaded = await LedgerRepository.load(owner)
+        assert [i.id for i in loaded] == [ledger1.id, ledger2.id]
+        loaded = await LedgerRepository.load(processing)
+        assert [i.id for i in loaded] == [ledger1.id]
+        assert await LedgerRepository.load(stranger) == []
+        loaded = await LedgerRepository.load(owner, tag='payment-request')
+        assert [i.id for i in loaded] == [ledger2.id]
+        loaded = await LedgerRepository.load(owner, id_=[ledger1.id])
+        assert [i.id for i in loaded] == [ledger1.id]
+
+        # повторное чтение из кеша без обращения к БД
+        await DBStorageItem.objects.filter(
+            category='identity-ledgers', uid=ledger2.id
+        ).aupdate(payload={})
+        loaded = await LedgerRepository.load(owner)
+        assert [i.id for i in loaded] == [ledger1.id, ledger2.id]
+
+        # ensure_exists сбрасывает кеш всех затронутых участников
+        ledger1.participants['guarantor'] = [stranger.did.root]
+        await LedgerRepository.ensure_exists(
+            owner, [ledger1], remove_others=True
+        )
+        loaded = await LedgerRepository.load(owner)
+        assert [i.id for i in loaded] == [ledger1.id]
+        loaded = await LedgerRepository.load(stranger)
+        assert [i.id for i in loaded] == [ledger1.id]
+        loaded = await LedgerRepository.load(processing)
+        assert loaded[0].participants_by_role('guarantor') == [
+            stranger.did.root
+        ]
+
+        # исключенный участник больше не видит леджер
+        del ledger1.participants['processing']
+        await LedgerRepository.ensure_exists(owner, [ledger1])
+        assert await LedgerRepository.load(processing) == []
+        loaded = await LedgerRepository.load(stranger)
+        assert [i.id for i in loaded] == [ledger1.id]
+
+
 @pytest.mark.asyncio
 @pytest.mark.django_db
 class TestIntegrity:
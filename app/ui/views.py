@@ -17,7 +17,7 @@ from entities import (
     MerchantMeta, Account, ExchangeConfig, Session, AnonymousAccount,
     MerchantAccount, Identity
 )
-from api.auth import BaseAuth, AnonymousAuth
+from api.auth import BaseAuth, AnonymousAuth, authenticate
 from reposiroty import (
     AccountSessionRepository, ExchangeConfigRepository, AccountRepository,
     StorageRepository
@@ -56,7 +56,7 @@ class BaseExchangeView(View):
     async def _build_context(
         cls, request: HttpRequest
     ) -> Tuple[Optional[ExchangeConfig], Optional[Account], Optional[Session]]:
-        cfg = await ExchangeConfigRepository.get()
+        cfg = await ExchangeConfigRepository.current()
         user, session = None, None
         return cfg, user, session
 
@@ -102,11 +102,7 @@ class AuthExchangeView(ContextMixin, BaseExchangeView):
     ) -> Tuple[Optional[ExchangeConfig], Optional[Account], Optional[Session]]:
         cfg, user, session = await super()._build_context(request)
         if user is None:
-            for auth in BaseAuth.Descendants:
-                auth: BaseAuth
-                user, session = await auth.auth(request)
-                if user or session:  # в анонимной сессии user м.б. пуст
-                    break
+            user, session = await authenticate(request)
         return cfg, user, session
 
     async def _after(self, resp: HttpResponse = None, fail: Exception = None):